@@ -37,6 +37,7 @@ import os
 import stat
 import time
 import CGAT.Experiment as E
+from CGATPipelines.Pipeline import Jobs as Jobs
 
 try:
     import drmaa
@@ -323,8 +324,14 @@ def collectSingleJobFromCluster(session, job_id,
                                 statement,
                                 stdout_path, stderr_path,
                                 job_path,
-                                ignore_errors=False):
-    '''runs a single job on the cluster.'''
+                                ignore_errors=False,
+                                job_info=None):
+    '''runs a single job on the cluster.
+
+    If *job_info* is given, the job is recorded in the job database
+    (see :mod:`Pipeline.Jobs`) with the fields in *job_info* and the
+    resource usage reported by the queue manager.
+    '''
     try:
         retval = session.wait(
             job_id, drmaa.Session.TIMEOUT_WAIT_FOREVER)
@@ -337,6 +344,14 @@ def collectSingleJobFromCluster(session, job_id,
             raise
         retval = None
 
+    if job_info is not None:
+        data = dict(job_info)
+        data["end_time"] = time.time()
+        data.update(dict([(x, y) for x, y in
+                          Jobs.getClusterUsage(retval).items()
+                          if y is not None]))
+        Jobs.recordJob(statement, engine="cluster", **data)
+
     stdout, stderr = getStdoutStderr(stdout_path, stderr_path)
 
     if retval and retval.exitStatus != 0 and not ignore_errors:
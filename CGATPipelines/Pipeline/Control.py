@@ -29,17 +29,17 @@ functionality for particular pipeline commands.
 
 :class:`MultiLineFormatter` improves the formatting
 of long log messages, while
-:class:`LoggingFilterRabbitMQ` intercepts ruffus log
-messages and sends event information to a rabbitMQ message exchange
-for task process monitoring.
+:class:`LoggingFilterEvents` intercepts ruffus log
+messages and emits task events to the pipeline event stream
+(see :mod:`Pipeline.Events`) for task process monitoring.
 
 Reference
 ---------
 
 """
 
+import ast
 import inspect
-import json
 import logging
 import os
 import re
@@ -55,13 +55,6 @@ except ImportError:
 
 from multiprocessing.pool import ThreadPool
 
-# talking to RabbitMQ
-try:
-    import pika
-    HAS_PIKA = True
-except ImportError:
-    HAS_PIKA = False
-
 # talking to a cluster
 try:
     import drmaa
@@ -79,9 +72,17 @@ from CGAT import Requirements as Requirements
 
 from CGATPipelines.Pipeline.Utils import isTest, getCaller, getCallerLocals
 from CGATPipelines.Pipeline.Execution import execute, startSession,\
-    closeSession
+    closeSession, getLocalExecutor
+from CGATPipelines.Pipeline import Jobs as Jobs
+from CGATPipelines.Pipeline import Events as Events
+from CGATPipelines.Pipeline.FileCache import startFileCache, \
+    closeFileCache, installFileCache
+from CGATPipelines.Pipeline.Workers import startWorkerPool, \
+    closeWorkerPool
 from CGATPipelines.Pipeline.Local import getProjectName, getPipelineName
-from CGATPipelines.Pipeline.Parameters import inputValidation
+from CGATPipelines.Pipeline.Parameters import inputValidation, \
+    getParameterFiles, getParameterHash, getCachedParameters, \
+    cacheParameters
 # Set from Pipeline.py
 PARAMS = {}
 
@@ -359,27 +360,45 @@ def peekParameters(workingdir,
         else:
             return {}
 
-    statement = "python %s -f -v 0 dump" % pipeline
-    process = subprocess.Popen(statement,
-                               cwd=workingdir,
-                               shell=True,
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-
-    # process.stdin.close()
-    stdout, stderr = process.communicate()
-
-    if process.returncode != 0:
-        raise OSError(
-            ("Child was terminated by signal %i: \n"
-             "The stderr was: \n%s\n") %
-            (-process.returncode, stderr))
+    # parameters are cached using the contents of the pipeline script
+    # and its configuration files as a key
+    workingdir = os.path.abspath(workingdir)
+    key = getParameterHash(
+        [pipeline] + getParameterFiles(
+            ["%s/pipeline.ini" % os.path.splitext(pipeline)[0],
+             os.path.join(workingdir, "..", "pipeline.ini"),
+             os.path.join(workingdir, "pipeline.ini")]),
+        workingdir)
+
+    dump = getCachedParameters(key)
+    if dump is None:
+        statement = "python %s -f -v 0 dump" % pipeline
+        process = subprocess.Popen(statement,
+                                   cwd=workingdir,
+                                   shell=True,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+
+        # process.stdin.close()
+        stdout, stderr = process.communicate()
+
+        if process.returncode != 0:
+            raise OSError(
+                ("Child was terminated by signal %i: \n"
+                 "The stderr was: \n%s\n") %
+                (-process.returncode, stderr))
+
+        for line in stdout.split("\n"):
+            if line.startswith("dump = "):
+                dump = ast.literal_eval(line[len("dump = "):])
+
+        if dump is None:
+            raise ValueError(
+                "could not read parameters from %s" % pipeline)
 
-    dump = None
-    for line in stdout.split("\n"):
-        if line.startswith("dump"):
-            exec(line)
+        cacheParameters(key, dump)
 
     # update interface
     if update_interface:
@@ -411,11 +430,8 @@ class MultiLineFormatter(logging.Formatter):
         return s
 
 
-class LoggingFilterRabbitMQ(logging.Filter):
-    """pass event information to a rabbitMQ message queue.
-
-    This is a log filter which detects messages from ruffus_ and sends
-    them to a rabbitMQ message queue.
+def getTaskPlan(ruffus_text):
+    """return tasks and jobs that ruffus will consider.
 
     A :term:`task` is a ruffus_ decorated function, which will execute
     one or more :term:`jobs`.
@@ -424,203 +440,109 @@ class LoggingFilterRabbitMQ(logging.Filter):
 
     update
        task/job needs updating
-    completed
-       task/job completed successfully
-    failed
-       task/job failed
-    running
-       task/job is running
     ignore
        ignore task/job (is up-to-date)
 
     Arguments
     ---------
     ruffus_text : string
-        Log messages from ruffus.pipeline_printout. These are used
-        to collect all tasks that will be executed during pipeline
-        executation.
-    project_name : string
-        Name of the project
-    pipeline_name : string
-        Name of the pipeline
-    host : string
-        RabbitMQ host name
-    exchange : string
-        RabbitMQ exchange name
+        Log messages from ruffus.pipeline_printout at verbosity 5.
 
+    Returns
+    -------
+    tasks : list
+        List of tuples (task_name, task_status, jobs), where jobs
+        is a list of tuples (job_name, job_status).
     """
 
-    def __init__(self, ruffus_text,
-                 project_name,
-                 pipeline_name,
-                 host="localhost",
-                 exchange="ruffus_pipelines"):
-
-        self.project_name = project_name
-        self.pipeline_name = pipeline_name
-        self.exchange = exchange
-
-        # dictionary of jobs to run
-        self.jobs = {}
-        self.tasks = {}
-
-        if not HAS_PIKA:
-            self.connected = False
-            return
-
-        def split_by_job(text):
-            text = "".join(text)
-            job_message = ""
-            # ignore first entry which is the docstring
-            for line in text.split(" Job  = ")[1:]:
-                try:
-                    # long file names cause additional wrapping and
-                    # additional white-space characters
-                    job_name = re.search(
-                        "\[.*-> ([^\]]+)\]", line).groups()
-                except AttributeError:
-                    raise AttributeError("could not parse '%s'" % line)
-                job_status = "ignore"
-                if "Job needs update" in line:
-                    job_status = "update"
-
-                yield job_name, job_status, job_message
-
-        def split_by_task(text):
-            block, task_name = [], None
-            task_status = None
-            for line in text.split("\n"):
-                line = line.strip()
-
-                if line.startswith("Tasks which will be run"):
-                    task_status = "update"
-                elif line.startswith("Tasks which are up-to-date"):
-                    task_status = "ignore"
-
-                if line.startswith("Task = "):
-                    if task_name:
-                        yield task_name, task_status, list(split_by_job(block))
-                    block = []
-                    task_name = re.match("Task = (.*)", line).groups()[0]
-                    continue
-                if line:
-                    block.append(line)
-            if task_name:
-                yield task_name, task_status, list(split_by_job(block))
-
-        # create connection
-        try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(
-                host=host))
-            self.connected = True
-        except pika.exceptions.AMQPConnectionError:
-            self.connected = False
-            return
-
-        self.channel = connection.channel()
-        self.channel.exchange_declare(
-            exchange=self.exchange,
-            type='topic')
-
-        # populate with initial messages
-        for task_name, task_status, jobs in split_by_task(ruffus_text):
-            if task_name.startswith("(mkdir"):
+    def split_by_job(text):
+        text = " " + " ".join(text)
+        # ignore first entry which is the docstring
+        for line in text.split(" Job  = ")[1:]:
+            try:
+                # long file names cause additional wrapping and
+                # additional white-space characters
+                job_name = re.search(
+                    r"\[.*-> ([^\]]+)\]", line).groups()[0]
+            except AttributeError:
+                raise AttributeError("could not parse '%s'" % line)
+            job_status = "ignore"
+            if "Job needs update" in line:
+                job_status = "update"
+
+            yield job_name, job_status
+
+    def split_by_task(text):
+        block, task_name = [], None
+        task_status = None
+        for line in text.split("\n"):
+            line = line.strip()
+
+            if line.startswith("Tasks which will be run"):
+                task_status = "update"
+            elif line.startswith("Tasks which are up-to-date"):
+                task_status = "ignore"
+
+            if line.startswith("Task = "):
+                if task_name:
+                    yield task_name, task_status, list(split_by_job(block))
+                block = []
+                task_name = re.match("Task = (.*)", line).groups()[0]
                 continue
+            if line:
+                block.append(line)
+        if task_name:
+            yield task_name, task_status, list(split_by_job(block))
 
-            to_run = 0
-            for job_name, job_status, job_message in jobs:
-                self.jobs[job_name] = (task_name, job_name)
-                if job_status == "update":
-                    to_run += 1
+    # ignore the mkdir, etc tasks
+    return [x for x in split_by_task(ruffus_text)
+            if not x[0].startswith("(mkdir")]
 
-            self.tasks[task_name] = [task_status, len(jobs),
-                                     len(jobs) - to_run]
-            self.send_task(task_name)
 
-    def send_task(self, task_name):
-        '''send task status.'''
+class LoggingFilterEvents(logging.Filter):
+    """emit task events from ruffus log messages.
 
-        if not self.connected:
-            return
+    This is a log filter which detects task state changes in messages
+    from ruffus_ and emits them as ``task_started``,
+    ``task_completed`` and ``task_uptodate`` events to the pipeline
+    event stream. The queued tasks are emitted as ``task_queued``
+    events when the filter is created.
 
-        task_status, task_total, task_completed = self.tasks[task_name]
-
-        data = {}
-        data['created_at'] = time.time()
-        data['pipeline'] = self.pipeline_name
-        data['task_name'] = task_name
-        data['task_status'] = task_status
-        data['task_total'] = task_total
-        data['task_completed'] = task_completed
-
-        key = "%s.%s.%s" % (self.project_name, self.pipeline_name, task_name)
-        try:
-            self.channel.basic_publish(exchange=self.exchange,
-                                       routing_key=key,
-                                       body=json.dumps(data))
-        except pika.exceptions.ConnectionClosed:
-            E.warn("could not send message - connection closed")
-        except Exception as e:
-            E.warn("could not send message: %s" % str(e))
-
-    def send_error(self, task_name, job, error=None, msg=None):
+    Arguments
+    ---------
+    ruffus_text : string
+        Log messages from ruffus.pipeline_printout. These are used
+        to collect all tasks that will be executed during pipeline
+        executation.
+    """
 
-        if not self.connected:
-            return
+    events = {"Task enters queue": "task_started",
+              "Completed Task": "task_completed",
+              "Uptodate Task": "task_uptodate"}
 
-        try:
-            task_status, task_total, task_completed = self.tasks[task_name]
-        except KeyError:
-            E.warn("could not get task information for %s, no message sent" %
-                   task_name)
-            return
-
-        data = {}
-        data['created_at'] = time.time()
-        data['pipeline'] = self.pipeline_name
-        data['task_name'] = task_name
-        data['task_status'] = 'failed'
-        data['task_total'] = task_total
-        data['task_completed'] = task_completed
-
-        key = "%s.%s.%s" % (self.project_name, self.pipeline_name, task_name)
+    def __init__(self, ruffus_text):
 
-        try:
-            self.channel.basic_publish(exchange=self.exchange,
-                                       routing_key=key,
-                                       body=json.dumps(data))
-        except pika.exceptions.ConnectionClosed:
-            E.warn("could not send message - connection closed")
-        except Exception as e:
-            E.warn("could not send message: %s" % str(e))
+        self.tasks = set()
+        for task_name, task_status, jobs in getTaskPlan(ruffus_text):
+            to_run = len([x for x in jobs if x[1] == "update"])
+            self.tasks.add(task_name)
+            Events.emit("task_queued",
+                        task=task_name,
+                        status=task_status,
+                        total=len(jobs),
+                        completed=len(jobs) - to_run)
 
     def filter(self, record):
 
-        if not self.connected:
-            return True
-
         # filter ruffus logging messages
         if record.filename.endswith("task.py"):
             try:
                 before, task_name = record.msg.strip().split(" = ")
-            except ValueError:
+            except (ValueError, AttributeError):
                 return True
 
-            # ignore the mkdir, etc tasks
-            if task_name not in self.tasks:
-                return True
-
-            if before == "Task enters queue":
-                self.tasks[task_name][0] = "running"
-            elif before == "Completed Task":
-                self.tasks[task_name][0] = "completed"
-            elif before == "Uptodate Task":
-                self.tasks[task_name][0] = "uptodate"
-            else:
-                return True
-
-            # send new task status out
-            self.send_task(task_name)
+            if task_name in self.tasks and before in self.events:
+                Events.emit(self.events[before], task=task_name)
 
         return True
 
@@ -665,6 +587,10 @@ regenerate
 check
    check if requirements (external tool dependencies) are satisfied.
 
+jobs
+   summarize the job database, listing the slowest and most
+   memory-hungry tasks.
+
 clone <source>
    create a clone of a pipeline in <source> in the current
    directory. The cloning process aims to use soft linking to files
@@ -711,7 +637,7 @@ def main(args=sys.argv):
                       type="choice",
                       choices=(
                           "make", "show", "plot", "dump", "config", "clone",
-                          "check", "regenerate", "printconfig"),
+                          "check", "regenerate", "printconfig", "jobs"),
                       help="action to take [default=%default].")
 
     parser.add_option("--pipeline-format", dest="pipeline_format",
@@ -770,12 +696,14 @@ def main(args=sys.argv):
 
     parser.add_option("--rabbitmq-exchange", dest="rabbitmq_exchange",
                       type="string",
-                      help="RabbitMQ exchange to send log messages to "
+                      help="RabbitMQ exchange to send task events to if "
+                      "events_sinks contains rabbitmq "
                       "[default=%default].")
 
     parser.add_option("--rabbitmq-host", dest="rabbitmq_host",
                       type="string",
-                      help="RabbitMQ host to send log messages to "
+                      help="RabbitMQ host to send task events to if "
+                      "events_sinks contains rabbitmq "
                       "[default=%default].")
 
     parser.add_option("--input-validation", dest="input_validation",
@@ -884,28 +812,35 @@ def main(args=sys.argv):
                 '%(asctime)s %(levelname)s %(module)s.%(funcName)s.%(lineno)d %(message)s'))
         logger = logging.getLogger()
         logger.addHandler(handler)
-        messenger = None
+        events = None
+        filecache = None
 
         try:
-            if options.pipeline_action == "make":
+            if options.pipeline_action in ("make", "show", "touch"):
+                # stat files in parallel for up-to-date checks
+                filecache = startFileCache()
 
-                # get tasks to be done. This essentially replicates
-                # the state information within ruffus.
-                stream = StringIO()
-                pipeline_printout(
-                    stream,
-                    options.pipeline_targets,
-                    verbose=5,
-                    checksum_level=options.ruffus_checksums_level)
+            if options.pipeline_action == "make":
 
-                messenger = LoggingFilterRabbitMQ(
-                    stream.getvalue(),
+                events = Events.startEventStream(
                     project_name=getProjectName(),
                     pipeline_name=getPipelineName(),
-                    host=options.rabbitmq_host,
-                    exchange=options.rabbitmq_exchange)
-
-                logger.addFilter(messenger)
+                    rabbitmq_host=options.rabbitmq_host,
+                    rabbitmq_exchange=options.rabbitmq_exchange)
+
+                if events is not None:
+                    # get tasks to be done. This essentially replicates
+                    # the state information within ruffus.
+                    stream = StringIO()
+                    with installFileCache(filecache):
+                        pipeline_printout(
+                            stream,
+                            options.pipeline_targets,
+                            verbose=5,
+                            checksum_level=options.ruffus_checksums_level)
+                    logger.addFilter(LoggingFilterEvents(stream.getvalue()))
+                    Events.emit("pipeline_started",
+                                targets=options.pipeline_targets)
 
                 if not options.without_cluster:
                     global task
@@ -919,6 +854,15 @@ def main(args=sys.argv):
                     # create the session proxy
                     startSession()
 
+                elif getLocalExecutor() is not None or events is not None:
+                    # local jobs are admitted against a shared cpu
+                    # and memory budget and events are queued in this
+                    # process, both of which require threads
+                    task.Pool = ThreadPool
+
+                # start warm workers for python functions
+                startWorkerPool()
+
                 #
                 #   make sure we are not logging at the same time in
                 #   different processes
@@ -928,33 +872,36 @@ def main(args=sys.argv):
                 E.info("code location: %s" % PARAMS["pipeline_scriptsdir"])
                 E.info("Working directory is: %s" % PARAMS["workingdir"])
 
-                pipeline_run(
-                    options.pipeline_targets,
-                    multiprocess=options.multiprocess,
-                    logger=logger,
-                    verbose=options.loglevel,
-                    log_exceptions=options.log_exceptions,
-                    exceptions_terminate_immediately=options.exceptions_terminate_immediately,
-                    checksum_level=options.ruffus_checksums_level,
-                )
+                with installFileCache(filecache):
+                    pipeline_run(
+                        options.pipeline_targets,
+                        multiprocess=options.multiprocess,
+                        logger=logger,
+                        verbose=options.loglevel,
+                        log_exceptions=options.log_exceptions,
+                        exceptions_terminate_immediately=options.exceptions_terminate_immediately,
+                        checksum_level=options.ruffus_checksums_level,
+                    )
 
                 E.info(E.GetFooter())
 
-                closeSession()
+                Events.emit("pipeline_finished")
 
             elif options.pipeline_action == "show":
-                pipeline_printout(
-                    options.stdout,
-                    options.pipeline_targets,
-                    verbose=options.loglevel,
-                    checksum_level=options.ruffus_checksums_level)
+                with installFileCache(filecache):
+                    pipeline_printout(
+                        options.stdout,
+                        options.pipeline_targets,
+                        verbose=options.loglevel,
+                        checksum_level=options.ruffus_checksums_level)
 
             elif options.pipeline_action == "touch":
-                pipeline_run(
-                    options.pipeline_targets,
-                    touch_files_only=True,
-                    verbose=options.loglevel,
-                    checksum_level=options.ruffus_checksums_level)
+                with installFileCache(filecache):
+                    pipeline_run(
+                        options.pipeline_targets,
+                        touch_files_only=True,
+                        verbose=options.loglevel,
+                        checksum_level=options.ruffus_checksums_level)
 
             elif options.pipeline_action == "regenerate":
                 pipeline_run(
@@ -981,6 +928,8 @@ def main(args=sys.argv):
 
         except ruffus_exceptions.RethrownJobError as value:
 
+            Events.emit("pipeline_failed", errors=len(value.args))
+
             if not options.debug:
                 E.error("%i tasks with errors, please see summary below:" %
                         len(value.args))
@@ -997,8 +946,8 @@ def main(args=sys.argv):
                         task = re.sub("__main__.", "", task)
                         job = re.sub("\s", "", job)
 
-                    if messenger:
-                        messenger.send_error(task, job, error, msg)
+                    Events.emit("task_failed", task=task, job=job,
+                                error=str(error), message=msg)
 
                     # display only single line messages
                     if len([x for x in msg.split("\n") if x != ""]) > 1:
@@ -1024,6 +973,15 @@ def main(args=sys.argv):
             else:
                 raise
 
+        finally:
+            # shut down workers and the cluster session also if the
+            # pipeline failed
+            closeWorkerPool()
+            closeSession()
+            # send remaining events
+            Events.closeEventStream()
+            closeFileCache()
+
     elif options.pipeline_action == "dump":
         # convert to normal dictionary (not defaultdict) for parsing purposes
         # do not change this format below as it is exec'd in peekParameters()
@@ -1035,6 +993,9 @@ def main(args=sys.argv):
             print(k, "=", PARAMS[k])
         printConfigFiles()
 
+    elif options.pipeline_action == "jobs":
+        Jobs.printJobSummary(options.stdout)
+
     elif options.pipeline_action == "config":
         f = sys._getframe(1)
         caller = inspect.getargvalues(f).locals["__file__"]
@@ -33,7 +33,7 @@ import sqlite3
 from CGAT import Database as Database
 import CGAT.Experiment as E
 
-from CGAT.IOTools import touchFile, snip
+from CGAT.IOTools import touchFile, snip, openFile
 
 from CGATPipelines.Pipeline.Execution import buildStatement, run
 from CGATPipelines.Pipeline.Files import getTempFile
@@ -681,3 +681,109 @@ def importFromIterator(
          options=indices)
 
     os.unlink(tmpfile.name)
+
+
+def _convertValue(value):
+    '''convert a string *value* to int or float if possible.'''
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def loadTables(dbhandle, tables, outfile=None, convert=True,
+               chunk_size=10000):
+    '''load several tables from iterators into the database in a
+    single transaction.
+
+    In contrast to :func:`load`, the data are inserted from within
+    the pipeline process without writing temporary files or starting
+    :doc:`csv2db`. Existing tables are replaced. If an error occurs,
+    the database is left unchanged.
+
+    This method is currently only implemented for sqlite databases.
+
+    Arguments
+    ---------
+    dbhandle :
+        A database handle.
+    tables : list
+        List of tuples (tablename, columns, iterator, indices) with
+        the column names of each table, an iterator yielding rows as
+        lists or tuples and a list of indices to create. Each index is
+        a string of comma-separated column names.
+    outfile : string
+        If given, the number of rows loaded into each table is written
+        to this file.
+    convert : bool
+        If True, convert string values to numbers where possible.
+    chunk_size : int
+        Number of rows to insert at a time.
+
+    Returns
+    -------
+    counts : list
+        Number of rows loaded into each table.
+    '''
+
+    isolation_level = dbhandle.isolation_level
+    # manage the transaction explicitly, otherwise the sqlite3 module
+    # commits before each CREATE/DROP statement
+    dbhandle.isolation_level = None
+    cc = dbhandle.cursor()
+    counts = []
+    try:
+        cc.execute("BEGIN")
+        for tablename, columns, iterator, indices in tables:
+            cc.execute("DROP TABLE IF EXISTS %s" % tablename)
+            cc.execute("CREATE TABLE %s (%s)" % (
+                tablename, ", ".join(['"%s"' % x for x in columns])))
+
+            statement = "INSERT INTO %s VALUES (%s)" % (
+                tablename, ",".join(["?"] * len(columns)))
+
+            nrows, rows = 0, []
+            for row in iterator:
+                if convert:
+                    row = [_convertValue(x) for x in row]
+                rows.append(row)
+                if len(rows) >= chunk_size:
+                    cc.executemany(statement, rows)
+                    nrows += len(rows)
+                    rows = []
+            if rows:
+                cc.executemany(statement, rows)
+                nrows += len(rows)
+
+            for index in indices or []:
+                fields = [x.strip() for x in index.split(",")]
+                cc.execute(
+                    "CREATE INDEX %s_%s_index ON %s (%s)" % (
+                        tablename,
+                        re.sub("[^a-zA-Z0-9_]", "_", "_".join(fields)),
+                        tablename,
+                        ", ".join(['"%s"' % x for x in fields])))
+
+            E.info("loaded %i rows into %s" % (nrows, tablename))
+            counts.append(nrows)
+
+        cc.execute("COMMIT")
+    except Exception:
+        cc.execute("ROLLBACK")
+        raise
+    finally:
+        cc.close()
+        dbhandle.isolation_level = isolation_level
+
+    if outfile:
+        with openFile(outfile, "w") as outf:
+            outf.write("table\trows\n")
+            for table, nrows in zip(tables, counts):
+                outf.write("%s\t%i\n" % (table[0], nrows))
+
+    return counts
@@ -0,0 +1,380 @@
+##########################################################################
+#
+#   MRC FGU Computational Genomics Group
+#
+#   $Id$
+#
+#   Copyright (C) 2009 Andreas Heger
+#
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation; either version 2
+#   of the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+##########################################################################
+"""Events.py - Structured event stream for pipeline monitoring
+===============================================================
+
+Pipelines emit events for the pipeline as a whole, for tasks and
+for jobs:
+
++----------------------+-------------------------------------------+
+|event                 |emitted                                    |
++----------------------+-------------------------------------------+
+|pipeline_started      |before ruffus starts running tasks         |
++----------------------+-------------------------------------------+
+|pipeline_finished     |after all tasks have completed             |
++----------------------+-------------------------------------------+
+|pipeline_failed       |if a task has failed                       |
++----------------------+-------------------------------------------+
+|task_queued           |for each task that will be run or is       |
+|                      |up-to-date, with the number of jobs        |
++----------------------+-------------------------------------------+
+|task_started          |when ruffus starts a task                  |
++----------------------+-------------------------------------------+
+|task_completed        |when ruffus has completed a task           |
++----------------------+-------------------------------------------+
+|task_uptodate         |when ruffus skips an up-to-date task       |
++----------------------+-------------------------------------------+
+|task_failed           |if a job within a task has failed          |
++----------------------+-------------------------------------------+
+|job_submitted         |when a job is sent to the cluster or the   |
+|                      |local executor                             |
++----------------------+-------------------------------------------+
+|job_started           |when a local job starts running            |
++----------------------+-------------------------------------------+
+|job_finished          |when a job has finished, with its exit     |
+|                      |status and resource usage                  |
++----------------------+-------------------------------------------+
+
+Each event is a dictionary with the fields ``event``, ``time``,
+``pipeline`` and ``project`` and event specific fields.
+
+Events are queued by :func:`emit` without blocking and sent in
+batches by a background thread to one or more sinks. As the queue
+lives in the main process, ruffus jobs are run in threads whenever
+an event stream has been started. Sinks are
+configured with the option ``events_sinks``, a comma-separated list
+of:
+
+``file:<filename>``
+   append events as lines of JSON to a file.
+``sqlite:<filename>``
+   insert events into the table ``events`` of an sqlite database.
+``socket:<address>``
+   send batches of events to a :mod:`multiprocessing.connection`
+   listener at ``<host>:<port>`` or a unix socket. Useful for
+   testing and for local monitoring tools.
+``rabbitmq``
+   publish task events to a RabbitMQ exchange using the options
+   ``--rabbitmq-host`` and ``--rabbitmq-exchange``.
+
+Reference
+---------
+
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from multiprocessing.connection import Client
+
+import CGAT.Experiment as E
+
+# talking to RabbitMQ
+try:
+    import pika
+    HAS_PIKA = True
+except ImportError:
+    HAS_PIKA = False
+
+# Set from Pipeline.py
+PARAMS = {}
+
+# global event stream
+GLOBAL_STREAM = None
+
+
+class FileSink(object):
+    '''append events as lines of JSON to *filename*.'''
+
+    def __init__(self, filename):
+        self.outfile = open(filename, "a")
+
+    def send(self, events):
+        for event in events:
+            self.outfile.write(json.dumps(event) + "\n")
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+
+class SQLiteSink(object):
+    '''insert events into the table ``events`` of the sqlite
+    database *filename*.
+
+    Fields common to all events are stored in columns, the complete
+    event is stored as JSON in the column ``data``.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.dbhandle = None
+
+    def send(self, events):
+        # connect in the sending thread
+        if self.dbhandle is None:
+            self.dbhandle = sqlite3.connect(self.filename, timeout=60)
+            self.dbhandle.execute(
+                "CREATE TABLE IF NOT EXISTS events "
+                "(time REAL, event TEXT, task TEXT, job TEXT, data TEXT)")
+        self.dbhandle.executemany(
+            "INSERT INTO events VALUES (?, ?, ?, ?, ?)",
+            [(x["time"], x["event"], x.get("task"), x.get("job"),
+              json.dumps(x)) for x in events])
+        self.dbhandle.commit()
+
+    def close(self):
+        if self.dbhandle is not None:
+            self.dbhandle.close()
+
+
+class SocketSink(object):
+    '''send batches of events to a :mod:`multiprocessing.connection`
+    listener at *address*.'''
+
+    def __init__(self, address, authkey=None):
+        if ":" in address:
+            host, port = address.split(":")
+            address = (host, int(port))
+        self.address = address
+        self.authkey = authkey
+        self.connection = None
+
+    def send(self, events):
+        if self.connection is None:
+            self.connection = Client(self.address, authkey=self.authkey)
+        self.connection.send(events)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class RabbitMQSink(object):
+    '''publish task events to a RabbitMQ exchange.
+
+    Messages have the same format as previously sent by the ruffus
+    log filter: task name, status, number of jobs and number of
+    completed jobs, keyed by ``project.pipeline.task``.
+    '''
+
+    status = {"task_queued": None,
+              "task_started": "running",
+              "task_completed": "completed",
+              "task_uptodate": "uptodate",
+              "task_failed": "failed"}
+
+    def __init__(self, host="localhost", exchange="ruffus_pipelines"):
+        self.host = host
+        self.exchange = exchange
+        self.channel = None
+        self.tasks = {}
+
+    def send(self, events):
+        if self.channel is None:
+            connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=self.host))
+            self.channel = connection.channel()
+            self.channel.exchange_declare(exchange=self.exchange,
+                                          type='topic')
+
+        for event in events:
+            if event["event"] not in self.status:
+                continue
+            task_name = event["task"]
+            if event["event"] == "task_queued":
+                self.tasks[task_name] = [event["status"],
+                                         event["total"],
+                                         event["completed"]]
+            elif task_name in self.tasks:
+                self.tasks[task_name][0] = self.status[event["event"]]
+            else:
+                continue
+
+            task_status, task_total, task_completed = self.tasks[task_name]
+            data = {'created_at': event["time"],
+                    'pipeline': event["pipeline"],
+                    'task_name': task_name,
+                    'task_status': task_status,
+                    'task_total': task_total,
+                    'task_completed': task_completed}
+            key = "%s.%s.%s" % (event["project"], event["pipeline"],
+                                task_name)
+            self.channel.basic_publish(exchange=self.exchange,
+                                       routing_key=key,
+                                       body=json.dumps(data))
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+
+
+class EventStream(object):
+    '''queue events and send them in batches to *sinks*.
+
+    Events are sent by a background thread once *batch_size* events
+    have accumulated or after *interval* seconds. A sink that fails
+    is disabled with a warning, so that monitoring problems never
+    stop the pipeline.
+
+    Arguments
+    ---------
+    sinks : list
+        List of sink objects with methods ``send`` and ``close``.
+    project_name : string
+        Name of the project.
+    pipeline_name : string
+        Name of the pipeline.
+    batch_size : int
+        Maximum number of events to send at once.
+    interval : float
+        Maximum number of seconds an event is held back.
+    '''
+
+    def __init__(self, sinks, project_name="", pipeline_name="",
+                 batch_size=1000, interval=1.0):
+        self.sinks = list(sinks)
+        self.project_name = project_name
+        self.pipeline_name = pipeline_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, event, **kwargs):
+        '''queue an event.'''
+        kwargs["event"] = event
+        kwargs["time"] = time.time()
+        kwargs["pipeline"] = self.pipeline_name
+        kwargs["project"] = self.project_name
+        kwargs["pid"] = os.getpid()
+        self.queue.put(kwargs)
+
+    def _send(self, events):
+        for sink in list(self.sinks):
+            try:
+                sink.send(events)
+            except Exception as msg:
+                E.warn("event sink %s failed and has been disabled: %s" %
+                       (sink.__class__.__name__, msg))
+                self.sinks.remove(sink)
+
+    def _run(self):
+        finished = False
+        while not finished:
+            events = []
+            deadline = time.time() + self.interval
+            while len(events) < self.batch_size:
+                try:
+                    event = self.queue.get(
+                        timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if event is None:
+                    finished = True
+                    break
+                events.append(event)
+            if events:
+                self._send(events)
+
+    def close(self):
+        '''send remaining events and close all sinks.'''
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                pass
+
+
+def buildSinks(sinks, rabbitmq_host=None, rabbitmq_exchange=None):
+    '''build sink objects from a comma-separated list of sink
+    definitions, see module documentation.'''
+
+    result = []
+    for sink in [x.strip() for x in sinks.split(",") if x.strip()]:
+        method, _, argument = sink.partition(":")
+        if method == "file":
+            result.append(FileSink(argument))
+        elif method == "sqlite":
+            result.append(SQLiteSink(argument))
+        elif method == "socket":
+            result.append(SocketSink(argument))
+        elif method == "rabbitmq":
+            if HAS_PIKA:
+                result.append(RabbitMQSink(rabbitmq_host, rabbitmq_exchange))
+            else:
+                E.warn("pika not available, rabbitmq sink disabled")
+        else:
+            raise ValueError("unknown event sink '%s'" % sink)
+    return result
+
+
+def startEventStream(project_name, pipeline_name,
+                     rabbitmq_host=None, rabbitmq_exchange=None):
+    '''start the global event stream with the sinks configured in
+    ``events_sinks``. Returns None if no sinks are configured.'''
+
+    global GLOBAL_STREAM
+    sinks = buildSinks(str(PARAMS.get("events_sinks", "") or ""),
+                       rabbitmq_host=rabbitmq_host,
+                       rabbitmq_exchange=rabbitmq_exchange)
+    if not sinks:
+        return None
+
+    GLOBAL_STREAM = EventStream(
+        sinks,
+        project_name=project_name,
+        pipeline_name=pipeline_name,
+        batch_size=int(PARAMS.get("events_batch_size", 1000)),
+        interval=float(PARAMS.get("events_interval", 1.0)))
+    return GLOBAL_STREAM
+
+
+def closeEventStream():
+    '''flush and close the global event stream.'''
+
+    global GLOBAL_STREAM
+    if GLOBAL_STREAM is not None:
+        GLOBAL_STREAM.close()
+        GLOBAL_STREAM = None
+
+
+def emit(event, **kwargs):
+    '''emit an event to the global event stream.
+
+    This is a no-op if no event stream has been started.
+    '''
+    if GLOBAL_STREAM is not None:
+        GLOBAL_STREAM.emit(event, **kwargs)
@@ -35,12 +35,19 @@ Reference
 """
 
 import importlib
+import multiprocessing
 import os
 import pickle
 import pipes
 import re
+import resource
+import signal
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 import CGAT.Experiment as E
 import CGAT.IOTools as IOTools
@@ -50,6 +57,10 @@ from CGATPipelines.Pipeline.Utils import getCallerLocals
 from CGATPipelines.Pipeline.Parameters import substituteParameters
 from CGATPipelines.Pipeline.Files import getTempFilename, getTempFile
 from CGATPipelines.Pipeline.Cluster import *
+from CGATPipelines.Pipeline.Workers import getWorkerPool
+from CGATPipelines.Pipeline import Jobs as Jobs
+from CGATPipelines.Pipeline import Events as Events
+from CGATPipelines.Pipeline import Scratch as Scratch
 
 # talking to a cluster
 try:
@@ -64,6 +75,9 @@ PARAMS = {}
 # global drmaa session
 GLOBAL_SESSION = None
 
+# global scheduler for jobs run on the local host
+GLOBAL_EXECUTOR = None
+
 
 def _pickle_args(args, kwargs):
     ''' Pickle a set of function arguments. Removes any kwargs that are
@@ -106,6 +120,177 @@ def closeSession():
         GLOBAL_SESSION.exit()
 
 
+class LocalExecutor(object):
+    '''admit jobs on the local host against cpu and memory budgets.
+
+    Jobs request a number of threads and an amount of memory. A job
+    waits until enough resources are free. A job requesting more than
+    the budget is started once no other job is running.
+
+    Arguments
+    ---------
+    max_threads : int
+        Number of threads available. If 0, use the number of cpus.
+    max_memory : string
+        Amount of memory available, e.g. ``64G``. If not set, memory
+        is not budgeted and not limited.
+    '''
+
+    def __init__(self, max_threads=0, max_memory=None):
+        self.max_threads = int(max_threads) or multiprocessing.cpu_count()
+        if max_memory and str(max_memory) != "0":
+            self.max_memory = IOTools.human2bytes(max_memory)
+        else:
+            self.max_memory = None
+        self.used_threads = 0
+        self.used_memory = 0
+        self.njobs = 0
+        self.condition = threading.Condition()
+
+    def _fits(self, threads, memory):
+        if self.njobs == 0:
+            return True
+        if self.used_threads + threads > self.max_threads:
+            return False
+        if self.max_memory is not None and \
+           self.used_memory + memory > self.max_memory:
+            return False
+        return True
+
+    def acquire(self, threads, memory):
+        '''wait until *threads* and *memory* (bytes) are available.
+
+        Returns the time in seconds spent waiting.
+        '''
+        start = time.time()
+        with self.condition:
+            while not self._fits(threads, memory):
+                self.condition.wait(60)
+            self.used_threads += threads
+            self.used_memory += memory
+            self.njobs += 1
+        return time.time() - start
+
+    def release(self, threads, memory):
+        '''return *threads* and *memory* to the budget.'''
+        with self.condition:
+            self.used_threads -= threads
+            self.used_memory -= memory
+            self.njobs -= 1
+            self.condition.notify_all()
+
+    def execute(self, statement, job_threads=1, job_memory=None,
+                cwd=None, job_name="job", task_name=None):
+        '''run *statement* once resources are available.
+
+        The statement is run in its own process group. If memory is
+        budgeted, the virtual memory of the job is limited to
+        *job_memory* as for jobs on the cluster.
+
+        Returns
+        -------
+        result : tuple
+            returncode, stdout, stderr and a dictionary with timings
+            and resource usage (see :func:`runProcess`).
+        '''
+
+        threads = max(1, int(job_threads or 1))
+        if job_memory:
+            memory = IOTools.human2bytes(job_memory)
+        else:
+            memory = 0
+
+        waited = self.acquire(threads, memory)
+        E.info("%s: started after waiting %.1fs in local queue "
+               "(threads=%i, memory=%s, running=%i)" %
+               (job_name, waited, threads, job_memory, self.njobs))
+        Events.emit("job_started", task=task_name, job=job_name,
+                    engine="local", wait_time=waited)
+
+        limit = memory if self.max_memory is not None else 0
+
+        def _setup():
+            # new process group so that the whole job can be killed
+            os.setsid()
+            if limit > 0:
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+        try:
+            result = runProcess(statement, cwd=cwd, preexec_fn=_setup)
+        finally:
+            self.release(threads, memory)
+
+        return result
+
+
+def runProcess(statement, cwd=None, preexec_fn=None):
+    '''run *statement* in a shell and collect its resource usage.
+
+    The process is waited for with :func:`os.wait4` in order to
+    obtain the resource usage of the job. If *preexec_fn* puts the
+    process into its own process group, the group is killed if the
+    pipeline is interrupted.
+
+    Returns
+    -------
+    result : tuple
+        returncode, stdout, stderr and a dictionary with start and
+        end times and resource usage (see :func:`Jobs.getLocalUsage`).
+    '''
+
+    stdout = tempfile.TemporaryFile()
+    stderr = tempfile.TemporaryFile()
+    start = time.time()
+    process = subprocess.Popen(
+        statement,
+        cwd=cwd,
+        shell=True,
+        stdin=subprocess.PIPE,
+        stdout=stdout,
+        stderr=stderr,
+        preexec_fn=preexec_fn)
+    process.stdin.close()
+
+    try:
+        pid, status, rusage = os.wait4(process.pid, 0)
+    except BaseException:
+        if preexec_fn is not None:
+            os.killpg(process.pid, signal.SIGTERM)
+        raise
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    info = Jobs.getLocalUsage(rusage)
+    info["start_time"] = start
+    info["end_time"] = time.time()
+
+    stdout.seek(0)
+    stderr.seek(0)
+    result = (process.returncode, stdout.read(), stderr.read(), info)
+    stdout.close()
+    stderr.close()
+    return result
+
+
+def getLocalExecutor():
+    '''return the scheduler for jobs on the local host.
+
+    The scheduler is configured through ``local_max_threads`` and
+    ``local_max_memory``. Returns None if neither is set.
+    '''
+
+    global GLOBAL_EXECUTOR
+    max_threads = int(PARAMS.get("local_max_threads") or 0)
+    max_memory = str(PARAMS.get("local_max_memory") or "0")
+    if GLOBAL_EXECUTOR is None and (max_threads > 0 or max_memory != "0"):
+        GLOBAL_EXECUTOR = LocalExecutor(max_threads=max_threads,
+                                        max_memory=max_memory)
+    return GLOBAL_EXECUTOR
+
+
 def shellquote(statement):
     '''shell quote a string to be used as a function argument.
 
@@ -188,6 +373,11 @@ def buildStatement(**kwargs):
     from the global configuration dictionary PARAMS, but augmented by
     `kwargs`. The latter takes precedence.
 
+    If `kwargs` declares files to stage with ``job_scratch_inputs``
+    or ``job_scratch_outputs`` or the statement refers to the scratch
+    directory, the statement is wrapped to run in a node-local
+    scratch directory (see :mod:`Pipeline.Scratch`).
+
     Arguments
     ---------
     kwargs : dict
@@ -208,6 +398,13 @@ def buildStatement(**kwargs):
     if "statement" not in kwargs:
         raise ValueError("'statement' not defined")
 
+    scratch_inputs = kwargs.get("job_scratch_inputs")
+    scratch_outputs = kwargs.get("job_scratch_outputs")
+    if scratch_inputs or scratch_outputs:
+        kwargs = dict(kwargs)
+        kwargs.update(Scratch.getScratchFiles(scratch_inputs,
+                                              scratch_outputs))
+
     local_params = substituteParameters(**kwargs)
 
     # build the statement
@@ -227,6 +424,19 @@ def buildStatement(**kwargs):
     if statement.endswith(";"):
         statement = statement[:-1]
 
+    if scratch_inputs or scratch_outputs or Scratch.usesScratch(statement):
+        if kwargs.get("job_scratch_size"):
+            size = IOTools.human2bytes(kwargs["job_scratch_size"])
+        else:
+            size = int((kwargs.get("input_size") or 0) *
+                       float(PARAMS.get("scratch_size_factor", 4)))
+        statement = Scratch.buildScratchStatement(
+            statement,
+            inputs=scratch_inputs,
+            outputs=scratch_outputs,
+            size=size,
+            check_errors=not kwargs.get("ignore_pipe_errors", False))
+
     return statement
 
 
@@ -279,7 +489,14 @@ def joinStatements(statements, infile):
 
 def getJobMemory(options=False, PARAMS=False):
     '''Extract the job memory from an options
-       or PARAMS dictionaries'''
+       or PARAMS dictionaries
+
+    If ``cluster_memory_prediction`` is set, the memory is predicted
+    from previous runs of the same task (see
+    :func:`Jobs.predictJobMemory`). If a job has run out of memory
+    (``memory_attempt`` > 0), the larger of the configured and the
+    predicted memory is doubled with every attempt.
+    '''
 
     job_memory = None
     if options and 'job_memory' in options:
@@ -312,9 +529,36 @@ def getJobMemory(options=False, PARAMS=False):
                          ' using either the "job_memory" option or the'
                          ' "cluster_memory_default" parameter')
 
+    if options and PARAMS and PARAMS.get("cluster_memory_prediction", False):
+        predicted = Jobs.predictJobMemory(
+            options.get("task_name"),
+            options.get("input_size"),
+            margin=float(PARAMS.get("cluster_memory_margin", 1.5)))
+        attempt = options.get("memory_attempt", 0)
+        if predicted is not None:
+            configured = IOTools.human2bytes(job_memory)
+            if attempt == 0:
+                memory = predicted
+            else:
+                memory = max(configured, predicted) * 2 ** (attempt - 1)
+            # round up to multiples of 256M
+            job_memory = "%iM" % (-(-memory // 2 ** 28) * 256)
+        elif attempt > 0:
+            job_memory = "%iM" % (
+                IOTools.human2bytes(job_memory) * 2 ** attempt // 2 ** 20)
+
     return job_memory
 
 
+def isMemoryError(msg):
+    '''return True if the error message *msg* of a failed job
+    indicates that the job ran out of memory.'''
+    return re.search(
+        "MemoryError|Cannot allocate memory|std::bad_alloc|"
+        "OutOfMemoryError|[Oo]ut of memory|exceeded.*memory|"
+        "terminated by signal (9|-137|137)\\b", msg) is not None
+
+
 def getParallelEnvironment(options=False):
     ''' Configure cluster_parallel_environment and job_threads
         from a given job_options variable within an options dict'''
@@ -386,6 +630,28 @@ def run(**kwargs):
     options.update(list(getCallerLocals().items()))
     options.update(list(kwargs.items()))
 
+    # name of the ruffus task and input size for job accounting
+    options["task_name"] = Jobs.getTaskName()
+    options["input_size"] = Jobs.getInputSize(options)
+
+    if not PARAMS.get("cluster_memory_prediction", False):
+        return _run(options)
+
+    # resubmit jobs that failed because they ran out of memory
+    retries = int(PARAMS.get("cluster_memory_retries", 2))
+    for attempt in range(retries + 1):
+        try:
+            return _run(dict(options, memory_attempt=attempt))
+        except OSError as msg:
+            if attempt == retries or not isMemoryError(str(msg)):
+                raise
+            E.warn("%s: job ran out of memory, resubmitting (attempt %i)" %
+                   (options["task_name"], attempt + 1))
+
+
+def _run(options):
+    '''run the statement(s) in *options*, see :func:`run`.'''
+
     # insert legacy synonyms
     options['without_cluster'] = options.get('without_cluster')
     getParallelEnvironment(options)
@@ -440,6 +706,8 @@ def run(**kwargs):
         not options["without_cluster"] and \
         GLOBAL_SESSION is not None
 
+    task_name = options.get("task_name")
+
     # SGE compatible job_name
     job_name = re.sub(
         "[:]", "_",
@@ -494,7 +762,7 @@ def run(**kwargs):
             jt = setupDrmaaJobTemplate(session, options, job_name, job_memory)
             E.debug("Job spec is: %s" % jt.nativeSpecification)
 
-            job_ids, filenames = [], []
+            job_ids, filenames, submit_times = [], [], []
 
             for statement in statement_list:
                 E.info("running statement:\n%s" % statement)
@@ -506,6 +774,9 @@ def run(**kwargs):
                 job_id = session.runJob(jt)
 
                 job_ids.append(job_id)
+                submit_times.append(time.time())
+                Events.emit("job_submitted", task=task_name, job=job_name,
+                            job_id=job_id, engine="cluster")
                 filenames.append((job_path, stdout_path, stderr_path))
 
                 E.debug("job has been submitted with job_id %s" % str(job_id))
@@ -516,15 +787,21 @@ def run(**kwargs):
                                 False)
 
             # collect and clean up
-            for job_id, statement, paths in zip(job_ids, statement_list,
-                                                filenames):
+            for job_id, statement, paths, submit_time in zip(
+                    job_ids, statement_list, filenames, submit_times):
                 job_path, stdout_path, stderr_path = paths
+                job_info = {"task": task_name,
+                            "job_name": job_name,
+                            "submit_time": submit_time,
+                            "job_memory": IOTools.human2bytes(job_memory),
+                            "input_size": options.get("input_size")}
                 collectSingleJobFromCluster(session, job_id,
                                             statement,
                                             stdout_path,
                                             stderr_path,
                                             job_path,
-                                            ignore_errors=ignore_errors)
+                                            ignore_errors=ignore_errors,
+                                            job_info=job_info)
 
             session.deleteJobTemplate(jt)
 
@@ -550,6 +827,9 @@ def run(**kwargs):
                         (start, end, increment))
                 # sge works with 1-based, closed intervals
                 job_ids = session.runBulkJobs(jt, start + 1, end, increment)
+                Events.emit("job_submitted", task=task_name, job=job_name,
+                            job_id=job_ids[0], engine="cluster",
+                            array_size=len(job_ids))
                 E.debug("%i array jobs have been submitted as job_id %s" %
                         (len(job_ids), job_ids[0]))
                 retval = session.synchronize(
@@ -560,14 +840,22 @@ def run(**kwargs):
             else:
                 # run a single job
                 job_id = session.runJob(jt)
+                job_info = {"task": task_name,
+                            "job_name": job_name,
+                            "submit_time": time.time(),
+                            "job_memory": IOTools.human2bytes(job_memory),
+                            "input_size": options.get("input_size")}
                 E.debug("job has been submitted with job_id %s" % str(job_id))
+                Events.emit("job_submitted", task=task_name, job=job_name,
+                            job_id=job_id, engine="cluster")
 
                 collectSingleJobFromCluster(session, job_id,
                                             statement,
                                             stdout_path,
                                             stderr_path,
                                             job_path,
-                                            ignore_errors=ignore_errors)
+                                            ignore_errors=ignore_errors,
+                                            job_info=job_info)
 
             session.deleteJobTemplate(jt)
     else:
@@ -583,7 +871,9 @@ def run(**kwargs):
         if options.get("dryrun", False):
             return
 
-        for statement in statement_list:
+        executor = getLocalExecutor()
+
+        def _runLocal(statement):
             E.info("running statement:\n%s" % statement)
 
             # process substitution <() and >() does not
@@ -601,26 +891,68 @@ def run(**kwargs):
                 statement = pipes.quote(statement)
                 statement = "%s -c %s" % (shell, statement)
 
-            process = subprocess.Popen(
-                expandStatement(
-                    statement,
-                    ignore_pipe_errors=ignore_pipe_errors),
-                cwd=PARAMS["workingdir"],
-                shell=True,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-
-            # process.stdin.close()
-            stdout, stderr = process.communicate()
-
-            if process.returncode != 0 and not ignore_errors:
+            submit_time = time.time()
+            Events.emit("job_submitted", task=task_name, job=job_name,
+                        engine="local")
+            if executor is not None:
+                returncode, stdout, stderr, info = executor.execute(
+                    expandStatement(
+                        statement,
+                        ignore_pipe_errors=ignore_pipe_errors),
+                    job_threads=options.get("job_threads", 1),
+                    job_memory=job_memory,
+                    cwd=PARAMS["workingdir"],
+                    job_name=job_name,
+                    task_name=task_name)
+            else:
+                Events.emit("job_started", task=task_name, job=job_name,
+                            engine="local", wait_time=0)
+                returncode, stdout, stderr, info = runProcess(
+                    expandStatement(
+                        statement,
+                        ignore_pipe_errors=ignore_pipe_errors),
+                    cwd=PARAMS["workingdir"])
+
+            Jobs.recordJob(statement,
+                           task=task_name,
+                           job_name=job_name,
+                           engine="local",
+                           host=socket.gethostname(),
+                           submit_time=submit_time,
+                           exit_status=returncode,
+                           job_memory=IOTools.human2bytes(job_memory),
+                           input_size=options.get("input_size"),
+                           **info)
+
+            if returncode != 0 and not ignore_errors:
                 raise OSError(
                     "---------------------------------------\n"
                     "Child was terminated by signal %i: \n"
                     "The stderr was: \n%s\n%s\n"
                     "-----------------------------------------" %
-                    (-process.returncode, stderr, statement))
+                    (-returncode, stderr, statement))
+
+        if executor is not None and len(statement_list) > 1:
+            # run multiple statements concurrently within the budget
+            errors = []
+
+            def _runThread(statement):
+                try:
+                    _runLocal(statement)
+                except Exception as msg:
+                    errors.append(msg)
+
+            threads = [threading.Thread(target=_runThread, args=(x,))
+                       for x in statement_list]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+        else:
+            for statement in statement_list:
+                _runLocal(statement)
 
 
 def submit(module, function, params=None,
@@ -705,6 +1037,12 @@ def cluster_runnable(func):
     and *to_cluster* true. This will submit the function as an external
     job, but run it on the local machine.
 
+    If a worker pool has been started (see :mod:`Pipeline.Workers`),
+    the function is sent to a warm worker process instead of being
+    submitted as a separate job, provided it does not request more
+    than a single thread or more memory than the workers have
+    available.
+
     Note: all arguments in the decorated function must be passed as
     key-word arguments.
     '''
@@ -718,9 +1056,23 @@ def cluster_runnable(func):
 
         if "submit" in kwargs and kwargs["submit"]:
             del kwargs["submit"]
-            submit_args, args_file = _pickle_args(args, kwargs)
             module_file = os.path.abspath(
                 sys.modules[func.__module__].__file__)
+
+            pool = getWorkerPool()
+            if pool is not None and pool.accepts(
+                    kwargs.get("job_threads", 1),
+                    kwargs.get("job_memory", None)):
+                call_kwargs = dict([(x, y) for x, y in kwargs.items()
+                                    if x not in ("to_cluster", "logfile",
+                                                 "job_options", "job_queue",
+                                                 "job_threads",
+                                                 "job_memory")])
+                if pool.call(snip(module_file), function_name,
+                             args, call_kwargs):
+                    return
+
+            submit_args, args_file = _pickle_args(args, kwargs)
             submit(snip(__file__),
                    "run_pickled",
                    params=[snip(module_file), function_name, args_file],
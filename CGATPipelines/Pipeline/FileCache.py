@@ -0,0 +1,444 @@
+##########################################################################
+#
+#   MRC FGU Computational Genomics Group
+#
+#   $Id$
+#
+#   Copyright (C) 2009 Andreas Heger
+#
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation; either version 2
+#   of the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+##########################################################################
+"""FileCache.py - Parallel file-state cache for up-to-date checks
+==================================================================
+
+Before running or showing a pipeline, ruffus checks whether each job
+is up-to-date by testing the existence and modification time of all
+its input and output files one after the other. On network
+filesystems with many files this can take minutes.
+
+With ``filecache_enable`` set, the working directory is scanned
+before ruffus starts. Directories are listed and files are stat'ed
+with ``filecache_threads`` threads. Ruffus's file checks are then
+answered from memory. Paths outside the scanned tree are stat'ed on
+first use and remembered. Directories named in ``filecache_exclude``
+are not scanned.
+
+The cache only serves checks made before the first job starts. From
+then on, jobs change files and all checks go to the filesystem
+again. Thus ``pipeline_printout`` and the up-to-date analysis at the
+start of ``pipeline_run`` share one scan.
+
+With ``filecache_persist`` set, the scan is saved to
+:file:`.pipeline_filecache.json` if no job has been run, for example
+after ``show``. The next invocation only lists directories whose
+modification time has changed. Files are always stat'ed again, as
+changing an existing file in place does not change the modification
+time of its directory. The saved scan is discarded once jobs have
+been run.
+
+Reference
+---------
+
+"""
+
+import json
+import os
+import stat
+from multiprocessing.pool import ThreadPool
+
+import ruffus.task
+import ruffus.file_name_parameters
+
+import CGAT.Experiment as E
+
+# Set from Pipeline.py
+PARAMS = {}
+
+# global file cache
+GLOBAL_CACHE = None
+
+# cache installed into ruffus and ruffus' original job runner
+INSTALLED_CACHE = None
+RUFFUS_RUN_JOB = None
+
+# ruffus modules checking files
+RUFFUS_MODULES = (ruffus.task, ruffus.file_name_parameters)
+
+# number of paths stat'ed by a thread at a time
+CHUNK_SIZE = 1000
+
+
+def _statPaths(paths):
+    '''return (path, state) for *paths*.
+
+    The state is a tuple (mode, size, mtime, islink) following
+    symbolic links, or None if the path does not exist.
+    '''
+    result = []
+    for path in paths:
+        try:
+            st = os.lstat(path)
+            islink = stat.S_ISLNK(st.st_mode)
+            if islink:
+                st = os.stat(path)
+            result.append((path, (st.st_mode, st.st_size, st.st_mtime,
+                                  islink)))
+        except OSError:
+            result.append((path, None))
+    return result
+
+
+def _listDirectory(args):
+    '''list a directory unless its modification time matches
+    *previous*.
+
+    Returns (path, mtime, names, reused), where reused is True if
+    the names have been taken from *previous*. mtime is None if the
+    directory could not be listed.
+    '''
+    path, previous = args
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return path, None, [], False
+    if previous is not None and previous[0] == mtime:
+        return path, mtime, list(previous[1]), True
+    try:
+        names = os.listdir(path)
+    except OSError:
+        # unreadable directories are not cached
+        return path, None, [], False
+    return path, mtime, names, False
+
+
+class FileCache(object):
+    '''cache of file states for a directory tree.
+
+    Arguments
+    ---------
+    root : string
+        Directory to scan.
+    threads : int
+        Number of threads used for scanning.
+    exclude : list
+        Names of directories not to scan.
+    filename : string
+        If given, file the scan is saved to and loaded from.
+    '''
+
+    def __init__(self, root, threads=16, exclude=(), filename=None):
+        self.root = os.path.abspath(root)
+        self.threads = threads
+        self.exclude = set(exclude)
+        self.filename = filename
+        # directory => (mtime, {name: state})
+        self.directories = {}
+        # path => state for paths outside the scanned directories
+        self.files = {}
+        self.realpaths = {}
+        self.enabled = True
+        self.dispatched = False
+
+    def load(self):
+        '''return the saved scan or an empty dictionary.'''
+        if not self.filename or not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename) as inf:
+                data = json.load(inf)
+        except (IOError, OSError, ValueError):
+            return {}
+        if data.get("root") != self.root:
+            return {}
+        return data["directories"]
+
+    def save(self):
+        '''save the scan.'''
+        if not self.filename:
+            return
+        tmpfile = self.filename + ".tmp"
+        with open(tmpfile, "w") as outf:
+            json.dump({"root": self.root,
+                       "directories": self.directories}, outf)
+        os.rename(tmpfile, self.filename)
+
+    def discard(self):
+        '''remove the saved scan.'''
+        if self.filename and os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+    def scan(self):
+        '''list and stat all files below the root directory.
+
+        Directories are processed level by level. Directories whose
+        modification time is unchanged since the saved scan are not
+        listed again, but their files are stat'ed.
+        '''
+
+        previous = self.load()
+        pool = ThreadPool(self.threads)
+        nreused = 0
+        try:
+            level = [self.root]
+            while level:
+                listings = pool.map(
+                    _listDirectory,
+                    [(x, previous.get(x)) for x in level])
+
+                paths = []
+                for path, mtime, names, reused in listings:
+                    if mtime is None:
+                        continue
+                    nreused += reused
+                    self.directories[path] = (mtime, {})
+                    paths.extend([os.path.join(path, x) for x in names])
+
+                chunks = [paths[x:x + CHUNK_SIZE]
+                          for x in range(0, len(paths), CHUNK_SIZE)]
+                for result in pool.map(_statPaths, chunks):
+                    for path, state in result:
+                        dirname, name = os.path.split(path)
+                        self.directories[dirname][1][name] = state
+
+                level = []
+                for path, mtime, names, reused in listings:
+                    if mtime is None:
+                        continue
+                    for name, state in self.directories[path][1].items():
+                        if state is not None and \
+                           stat.S_ISDIR(state[0]) and \
+                           not state[3] and \
+                           name not in self.exclude:
+                            level.append(os.path.join(path, name))
+        finally:
+            pool.close()
+            pool.join()
+
+        E.info("file cache: scanned %i directories (%i unchanged) "
+               "with %i entries below %s" %
+               (len(self.directories), nreused,
+                sum([len(x[1]) for x in self.directories.values()]),
+                self.root))
+
+    def getState(self, path):
+        '''return the state of *path*, see :func:`_statPaths`.'''
+        path = os.path.abspath(path)
+        dirname, name = os.path.split(path)
+        if dirname in self.directories:
+            return self.directories[dirname][1].get(name)
+        if path == self.root:
+            return _statPaths([path])[0][1]
+        if path not in self.files:
+            self.files[path] = _statPaths([path])[0][1]
+        return self.files[path]
+
+    def realpath(self, path):
+        '''return the canonical path of *path*.'''
+        if path not in self.realpaths:
+            self.realpaths[path] = os.path.realpath(path)
+        return self.realpaths[path]
+
+    def disable(self):
+        '''stop answering from the cache because jobs are starting.'''
+        if self.enabled:
+            self.enabled = False
+            self.dispatched = True
+
+
+class _PathProxy(object):
+    '''replacement for :mod:`os.path` answering checks from a
+    :class:`FileCache`.'''
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def _getState(self, path):
+        state = self._cache.getState(path)
+        if state is None:
+            raise OSError(2, "No such file or directory", path)
+        return state
+
+    def exists(self, path):
+        if not self._cache.enabled:
+            return os.path.exists(path)
+        return self._cache.getState(path) is not None
+
+    def isfile(self, path):
+        if not self._cache.enabled:
+            return os.path.isfile(path)
+        state = self._cache.getState(path)
+        return state is not None and stat.S_ISREG(state[0])
+
+    def isdir(self, path):
+        if not self._cache.enabled:
+            return os.path.isdir(path)
+        state = self._cache.getState(path)
+        return state is not None and stat.S_ISDIR(state[0])
+
+    def getmtime(self, path):
+        if not self._cache.enabled:
+            return os.path.getmtime(path)
+        return self._getState(path)[2]
+
+    def getsize(self, path):
+        if not self._cache.enabled:
+            return os.path.getsize(path)
+        return self._getState(path)[1]
+
+    def realpath(self, path):
+        if not self._cache.enabled:
+            return os.path.realpath(path)
+        return self._cache.realpath(path)
+
+    def __getattr__(self, name):
+        return getattr(os.path, name)
+
+
+class _OSProxy(object):
+    '''replacement for :mod:`os` answering :func:`os.stat` from a
+    :class:`FileCache`.'''
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.path = _PathProxy(cache)
+
+    def stat(self, path, *args, **kwargs):
+        if not self._cache.enabled or args or kwargs or \
+           not isinstance(path, str):
+            return os.stat(path, *args, **kwargs)
+        mode, size, mtime, islink = self.path._getState(path)
+        return os.stat_result(
+            (mode, 0, 0, 0, 0, 0, size, int(mtime), int(mtime), int(mtime)),
+            {"st_atime": mtime, "st_mtime": mtime, "st_ctime": mtime})
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+
+def _wrapPool(factory, cache):
+    '''return a pool factory whose pools disable *cache* when
+    ruffus starts sending jobs to them.'''
+
+    def _createPool(*args, **kwargs):
+        pool = factory(*args, **kwargs)
+        imap_unordered = pool.imap_unordered
+
+        def _imap_unordered(*args, **kwargs):
+            cache.disable()
+            return imap_unordered(*args, **kwargs)
+
+        pool.imap_unordered = _imap_unordered
+        return pool
+
+    return _createPool
+
+
+def _runJob(process_parameters):
+    '''run a ruffus job after disabling the global cache.
+
+    This is a module level function so that it can be sent to
+    a process pool.
+    '''
+    if INSTALLED_CACHE is not None:
+        INSTALLED_CACHE.disable()
+    return RUFFUS_RUN_JOB(process_parameters)
+
+
+class installFileCache(object):
+    '''context manager answering ruffus file checks from *cache*.
+
+    Within the context, the :mod:`os` module used by ruffus is
+    replaced by a proxy. The cache is disabled as soon as ruffus
+    dispatches the first job, either to a pool or in the main
+    process.
+    '''
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.saved = []
+
+    def __enter__(self):
+        if self.cache is None:
+            return None
+        proxy = _OSProxy(self.cache)
+        for module in RUFFUS_MODULES:
+            self.saved.append((module, "os", module.os))
+            module.os = proxy
+
+        task = ruffus.task
+        # the name of the process pool differs between ruffus versions
+        for name in ("Pool", "ProcessPool", "ThreadPool"):
+            factory = getattr(task, name, None)
+            if factory is None:
+                continue
+            self.saved.append((task, name, factory))
+            setattr(task, name, _wrapPool(factory, self.cache))
+
+        global INSTALLED_CACHE, RUFFUS_RUN_JOB
+        INSTALLED_CACHE = self.cache
+        RUFFUS_RUN_JOB = task.run_pooled_job_without_exceptions
+        self.saved.append((task, "run_pooled_job_without_exceptions",
+                           RUFFUS_RUN_JOB))
+        task.run_pooled_job_without_exceptions = _runJob
+        return self.cache
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global INSTALLED_CACHE
+        for module, name, value in reversed(self.saved):
+            setattr(module, name, value)
+        self.saved = []
+        INSTALLED_CACHE = None
+        return False
+
+
+def startFileCache():
+    '''scan the working directory if ``filecache_enable`` is set.
+
+    Returns the :class:`FileCache` or None.
+    '''
+
+    global GLOBAL_CACHE
+    if not PARAMS.get("filecache_enable", False):
+        return None
+
+    workingdir = PARAMS.get("workingdir", os.getcwd())
+    if PARAMS.get("filecache_persist", False):
+        filename = os.path.join(workingdir, ".pipeline_filecache.json")
+    else:
+        filename = None
+
+    exclude = [x.strip() for x in
+               str(PARAMS.get("filecache_exclude", "")).split(",")
+               if x.strip()]
+
+    GLOBAL_CACHE = FileCache(workingdir,
+                             threads=int(PARAMS.get("filecache_threads", 16)),
+                             exclude=exclude,
+                             filename=filename)
+    GLOBAL_CACHE.scan()
+    return GLOBAL_CACHE
+
+
+def closeFileCache():
+    '''save the scan if no jobs have been run, otherwise discard it.'''
+
+    global GLOBAL_CACHE
+    if GLOBAL_CACHE is None:
+        return
+    if GLOBAL_CACHE.dispatched:
+        GLOBAL_CACHE.discard()
+    else:
+        GLOBAL_CACHE.save()
+    GLOBAL_CACHE = None
@@ -0,0 +1,392 @@
+##########################################################################
+#
+#   MRC FGU Computational Genomics Group
+#
+#   $Id$
+#
+#   Copyright (C) 2009 Andreas Heger
+#
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation; either version 2
+#   of the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+##########################################################################
+"""Jobs.py - Accounting of jobs run by a pipeline
+==================================================
+
+Every job started by :func:`run` is recorded in a sqlite database
+(``jobs_database``, default :file:`pipeline_jobs.db` in the working
+directory). Each row contains the task, the job name, a hash of the
+statement, submission/start/end times, the time waiting in the queue,
+the exit status and the resources used: maximum resident set size,
+maximum virtual memory, cpu time and bytes read and written.
+
+Resource usage is obtained with :func:`os.wait4` for jobs on the local
+host and from the DRMAA job information for jobs on the cluster. Not
+all queue managers report all fields, missing values are stored as
+NULL.
+
+The database can be summarized with::
+
+    python pipeline_xyz.py jobs
+
+which lists the slowest and most memory-hungry tasks.
+
+Reference
+---------
+
+"""
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+
+import CGAT.Experiment as E
+from CGATPipelines.Pipeline import Events as Events
+
+# Set from Pipeline.py
+PARAMS = {}
+
+# serialize access from threads
+LOCK = threading.Lock()
+
+COLUMNS = ("task", "job_name", "statement_hash", "engine", "host",
+           "submit_time", "start_time", "end_time", "wait_time",
+           "wall_time", "exit_status", "max_rss", "max_vmem", "cpu_time",
+           "io_read", "io_write", "job_memory", "input_size")
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS jobs (
+    task TEXT,
+    job_name TEXT,
+    statement_hash TEXT,
+    engine TEXT,
+    host TEXT,
+    submit_time REAL,
+    start_time REAL,
+    end_time REAL,
+    wait_time REAL,
+    wall_time REAL,
+    exit_status INT,
+    max_rss INT,
+    max_vmem INT,
+    cpu_time REAL,
+    io_read INT,
+    io_write INT,
+    job_memory INT,
+    input_size INT)'''
+
+
+def getDatabaseName():
+    '''return the filename of the job database.'''
+    dbname = PARAMS.get("jobs_database", "pipeline_jobs.db")
+    return os.path.join(PARAMS.get("workingdir", os.getcwd()), dbname)
+
+
+def getTaskName():
+    '''return the name of the ruffus task that is currently executing.
+
+    This is the outermost function on the stack that has been called
+    by ruffus.
+    '''
+    frame = sys._getframe(1)
+    task = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith("ruffus"):
+            break
+        task = frame.f_code.co_name
+        frame = frame.f_back
+    return task
+
+
+def createTable(dbhandle):
+    '''create the job table, adding columns missing in databases
+    written by previous versions.'''
+    dbhandle.execute(SCHEMA)
+    existing = set([x[1] for x in
+                    dbhandle.execute("PRAGMA table_info(jobs)")])
+    for column in COLUMNS:
+        if column not in existing:
+            dbhandle.execute("ALTER TABLE jobs ADD COLUMN %s" % column)
+
+
+def getInputSize(options):
+    '''return the total size in bytes of the input files of a job.
+
+    Input files are taken from ``infile`` or ``infiles`` in
+    *options*. Returns None if there are no input files.
+    '''
+
+    def _walk(value):
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, (list, tuple)):
+            for x in value:
+                for y in _walk(x):
+                    yield y
+
+    filenames = list(_walk(options.get("infiles", options.get("infile"))))
+    sizes = [os.path.getsize(x) for x in filenames if os.path.isfile(x)]
+    if not sizes:
+        return None
+    return sum(sizes)
+
+
+def predictJobMemory(task, input_size, margin=1.5, min_jobs=3,
+                     dbname=None):
+    '''predict the peak memory of a job from previous runs of *task*.
+
+    Job memory is enforced as a limit on virtual memory (see
+    :func:`Execution.run`), which is usually much larger than the
+    resident set size. The prediction is thus based on the peak
+    virtual memory of previous jobs. As this is only reported by
+    the queue manager, jobs run locally do not contribute.
+
+    Peak memory is modelled as a linear function of the input size,
+    fitted by least squares to successful jobs of the same task. The
+    fitted line is shifted up by the largest underestimate among
+    the previous jobs and multiplied by *margin*. If input sizes are
+    not available, the largest previous peak memory is used.
+
+    Arguments
+    ---------
+    task : string
+        Name of the task.
+    input_size : int
+        Total size of the input files in bytes.
+    margin : float
+        Safety factor applied to the estimate.
+    min_jobs : int
+        Minimum number of previous jobs required for a prediction.
+    dbname : string
+        Filename of the job database. Defaults to :func:`getDatabaseName`.
+
+    Returns
+    -------
+    memory : int
+        Predicted memory in bytes or None if there is not enough
+        data.
+    '''
+
+    if task is None:
+        return None
+
+    dbname = dbname or getDatabaseName()
+    if not os.path.exists(dbname):
+        return None
+
+    try:
+        dbhandle = sqlite3.connect(dbname, timeout=60)
+        try:
+            createTable(dbhandle)
+            data = dbhandle.execute(
+                "SELECT input_size, max_vmem FROM jobs "
+                "WHERE task = ? AND exit_status = 0 AND max_vmem > 0",
+                (task,)).fetchall()
+        finally:
+            dbhandle.close()
+    except sqlite3.Error as msg:
+        E.warn("could not read job history from %s: %s" % (dbname, msg))
+        return None
+
+    if len(data) < min_jobs:
+        return None
+
+    peak = max([y for x, y in data])
+    sized = [(float(x), float(y)) for x, y in data if x is not None]
+    if input_size is None or len(set([x for x, y in sized])) < 2:
+        return int(peak * margin)
+
+    n = float(len(sized))
+    mean_x = sum([x for x, y in sized]) / n
+    mean_y = sum([y for x, y in sized]) / n
+    slope = sum([(x - mean_x) * (y - mean_y) for x, y in sized]) / \
+        sum([(x - mean_x) ** 2 for x, y in sized])
+    if slope <= 0:
+        return int(peak * margin)
+
+    intercept = mean_y - slope * mean_x
+    offset = max([y - (intercept + slope * x) for x, y in sized])
+    estimate = intercept + slope * input_size + max(0, offset)
+    return int(max(estimate, min([y for x, y in sized])) * margin)
+
+
+def hashStatement(statement):
+    '''return a short hash of a statement.'''
+    return hashlib.md5(statement.encode("utf-8")).hexdigest()[:16]
+
+
+def recordJob(statement, **kwargs):
+    '''record a job in the job database.
+
+    A ``job_finished`` event with the same fields is emitted to the
+    pipeline event stream (see :mod:`Pipeline.Events`).
+
+    Failures to write to the database are logged, but do not
+    stop the pipeline.
+
+    Arguments
+    ---------
+    statement : string
+        Statement that was run.
+    kwargs : dict
+        Values for columns in :data:`COLUMNS`.
+    '''
+
+    data = dict([(x, None) for x in COLUMNS])
+    data.update(kwargs)
+    data["statement_hash"] = hashStatement(statement)
+    if data["start_time"] is not None and data["end_time"] is not None:
+        data["wall_time"] = data["end_time"] - data["start_time"]
+        if data["submit_time"] is not None:
+            data["wait_time"] = data["start_time"] - data["submit_time"]
+
+    event = dict(data)
+    event["job"] = event.pop("job_name")
+    Events.emit("job_finished", **event)
+
+    if not PARAMS.get("jobs_accounting", True):
+        return
+
+    try:
+        with LOCK:
+            dbhandle = sqlite3.connect(getDatabaseName(), timeout=60)
+            try:
+                createTable(dbhandle)
+                dbhandle.execute(
+                    "INSERT INTO jobs (%s) VALUES (%s)" %
+                    (",".join(COLUMNS), ",".join(["?"] * len(COLUMNS))),
+                    [data[x] for x in COLUMNS])
+                dbhandle.commit()
+            finally:
+                dbhandle.close()
+    except sqlite3.Error as msg:
+        E.warn("could not record job in %s: %s" % (getDatabaseName(), msg))
+
+
+def getLocalUsage(rusage):
+    '''return resource usage of a local job from a
+    :func:`os.wait4` rusage structure.
+
+    ``ru_maxrss`` is reported in kilobytes and block counts in
+    units of 512 bytes on Linux.
+    '''
+    return {"max_rss": rusage.ru_maxrss * 1024,
+            "cpu_time": rusage.ru_utime + rusage.ru_stime,
+            "io_read": rusage.ru_inblock * 512,
+            "io_write": rusage.ru_oublock * 512}
+
+
+def getClusterUsage(retval):
+    '''return times and resource usage of a cluster job from a
+    DRMAA JobInfo structure.
+
+    Field names differ between queue managers, the first one found
+    is used.
+    '''
+
+    if retval is None:
+        return {}
+
+    usage = retval.resourceUsage or {}
+
+    def _get(names, scale=1.0):
+        for name in names:
+            if name in usage:
+                try:
+                    return float(usage[name]) * scale
+                except ValueError:
+                    pass
+        return None
+
+    result = {
+        "exit_status": retval.exitStatus,
+        "submit_time": _get(("submission_time", "submit_time")),
+        "start_time": _get(("start_time",)),
+        "end_time": _get(("end_time",)),
+        "cpu_time": _get(("cpu", "ru_utime")),
+        "io_read": _get(("io_read", "ru_inblock"), 512),
+        "io_write": _get(("io_write", "ru_oublock"), 512)}
+
+    # sge reports maxrss in kilobytes and maxvmem in bytes
+    max_rss = _get(("ru_maxrss",), 1024)
+    if max_rss is not None:
+        result["max_rss"] = int(max_rss)
+    max_vmem = _get(("maxvmem",))
+    if max_vmem is not None:
+        result["max_vmem"] = int(max_vmem)
+
+    # sge reports times in milliseconds since the epoch
+    for key in ("submit_time", "start_time", "end_time"):
+        if result[key] is not None and result[key] > 1e11:
+            result[key] /= 1000.0
+
+    return result
+
+
+def getJobSummary(dbname=None, limit=10):
+    '''summarize the job database by task.
+
+    Arguments
+    ---------
+    dbname : string
+        Filename of the job database. Defaults to :func:`getDatabaseName`.
+    limit : int
+        Number of tasks to report in each section.
+
+    Returns
+    -------
+    summary : list
+        List of tuples (title, columns, rows).
+    '''
+
+    dbhandle = sqlite3.connect(dbname or getDatabaseName())
+    createTable(dbhandle)
+
+    aggregate = '''SELECT task, COUNT(*) AS jobs,
+    SUM(wall_time) AS total_wall,
+    MAX(wall_time) AS max_wall,
+    AVG(wait_time) AS avg_wait,
+    MAX(max_rss) / 1048576.0 AS max_rss_mb,
+    SUM(cpu_time) AS total_cpu,
+    SUM(CASE WHEN exit_status != 0 THEN 1 ELSE 0 END) AS failed
+    FROM jobs GROUP BY task ORDER BY %s DESC LIMIT %i'''
+
+    summary = []
+    for title, order in (("slowest tasks", "total_wall"),
+                         ("most memory-hungry tasks", "max_rss_mb")):
+        cc = dbhandle.execute(aggregate % (order, limit))
+        columns = [x[0] for x in cc.description]
+        summary.append((title, columns, cc.fetchall()))
+
+    dbhandle.close()
+    return summary
+
+
+def printJobSummary(outfile=sys.stdout, dbname=None, limit=10):
+    '''write a summary of the job database to *outfile*.'''
+
+    def _format(value):
+        if value is None:
+            return "na"
+        elif isinstance(value, float):
+            return "%.2f" % value
+        return str(value)
+
+    for title, columns, rows in getJobSummary(dbname, limit):
+        outfile.write("# %s\n" % title)
+        outfile.write("\t".join(columns) + "\n")
+        for row in rows:
+            outfile.write("\t".join(map(_format, row)) + "\n")
+        outfile.write("\n")
@@ -51,20 +51,35 @@ public web interface. The functions :func:`getPublishDestinations` and
 The function :meth:`publish_tracks` builds a UCSC track hub and
 moves it into the appropriate CGAT download directories.
 
+Incremental reports
+-------------------
+
+The function :func:`invalidateReport` compares the state of the
+database tables and files used by each tracker module with the state
+at the previous report build. Cached tracker results of modules whose
+inputs changed are removed and the pages using these modules are
+marked for rebuilding.
+
 Reference
 ---------
 
 '''
 import os
 import re
+import glob
+import multiprocessing
+import json
+import hashlib
 import shutil
 import inspect
 import collections
+import sqlite3
 import brewer2mpl
 
 from CGAT import Experiment as E
 import CGAT.IOTools as IOTools
 from CGATPipelines.Pipeline.Parameters import loadParameters
+from CGATPipelines.Pipeline.Database import toTable
 
 PROJECT_ROOT = '/ifs/projects'
 
@@ -253,6 +268,137 @@ def getPublishDestinations(prefix="", suffix=None):
     return dest_report, dest_export
 
 
+def _publishFile(args):
+    '''copy a single file of a report, applying *patterns* to html
+    files.
+
+    Worker function for :func:`publishFiles`.
+    '''
+    src, dest, patterns = args
+
+    if not os.path.exists(os.path.dirname(dest)):
+        try:
+            os.makedirs(os.path.dirname(dest))
+        except OSError:
+            # created by another process
+            pass
+
+    if not dest.endswith(".html"):
+        shutil.copy2(src, dest)
+        return
+
+    with open(src) as inf:
+        data = inf.read()
+
+    # only rewrite files that contain any of the patterns
+    if any(rx.search(data) for rx, repl in patterns):
+        for rx, repl in patterns:
+            data = rx.sub(repl, data)
+
+    with open(dest, "w") as outf:
+        outf.write(data)
+
+
+def publishFiles(src_dir, dest_dir, patterns=[], threads=1,
+                 manifest=".publish_manifest.json"):
+    '''publish the files in *src_dir* to *dest_dir*.
+
+    A manifest with the size, modification time and content hash of
+    each published file is kept in *dest_dir*. Only files that have
+    changed since the last publication are copied. Files that are
+    not present in *src_dir* any more are removed. If *dest_dir*
+    exists but has no manifest, it is replaced completely.
+
+    Substitutions in *patterns* are applied to files ending in
+    .html. If the patterns change, all html files are republished.
+
+    Arguments
+    ---------
+    src_dir : string
+        Source directory.
+    dest_dir : string
+        Destination directory.
+    patterns : list
+        List of tuples of compiled regular expressions and
+        replacement strings.
+    threads : int
+        Number of files to publish in parallel.
+    manifest : string
+        Filename of the manifest within *dest_dir*.
+
+    Returns
+    -------
+    counts : dict
+        Number of files that were published, removed and unchanged.
+    '''
+
+    manifest_file = os.path.join(dest_dir, manifest)
+    patterns_hash = hashlib.md5(
+        str([(rx.pattern, repl) for rx, repl in patterns]).encode(
+            "utf-8")).hexdigest()
+
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as inf:
+            old_manifest = json.load(inf)
+    else:
+        old_manifest = {"patterns": None, "files": {}}
+        if os.path.exists(dest_dir):
+            shutil.rmtree(dest_dir)
+
+    old_files = old_manifest["files"]
+    new_files = {}
+    todo = []
+    for root, dirs, files in os.walk(src_dir):
+        for f in files:
+            src = os.path.join(root, f)
+            relpath = os.path.relpath(src, src_dir)
+            st = os.stat(src)
+            old = old_files.get(relpath)
+            if old is not None and old[:2] == [st.st_size, st.st_mtime]:
+                checksum = old[2]
+            else:
+                with open(src, "rb") as inf:
+                    checksum = hashlib.md5(inf.read()).hexdigest()
+            new_files[relpath] = [st.st_size, st.st_mtime, checksum]
+
+            dest = os.path.join(dest_dir, relpath)
+            if old is None or old[2] != checksum or \
+               not os.path.exists(dest) or \
+               (f.endswith(".html") and
+                    old_manifest["patterns"] != patterns_hash):
+                todo.append(relpath)
+
+    stale = set(old_files).difference(new_files)
+    for relpath in stale:
+        dest = os.path.join(dest_dir, relpath)
+        if os.path.exists(dest):
+            os.remove(dest)
+
+    args = [(os.path.join(src_dir, x), os.path.join(dest_dir, x),
+             patterns) for x in todo]
+    if threads > 1 and len(args) > 1:
+        pool = multiprocessing.Pool(threads)
+        try:
+            pool.map(_publishFile, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        list(map(_publishFile, args))
+
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    with open(manifest_file, "w") as outf:
+        json.dump({"patterns": patterns_hash, "files": new_files}, outf)
+
+    counts = {"published": len(todo),
+              "removed": len(stale),
+              "unchanged": len(new_files) - len(todo)}
+    E.info("published %(published)i files, removed %(removed)i files, "
+           "%(unchanged)i files unchanged" % counts)
+    return counts
+
+
 def publish_report(prefix="",
                    patterns=[],
                    project_id=None,
@@ -278,6 +424,9 @@ def publish_report(prefix="",
     replacement_string).  Each substitutions will be applied on each
     file ending in .html.
 
+    Only files that have changed since the last publication are
+    copied, see :func:`publishFiles`.
+
     If *project_id* is not given, it will be looked up. This requires
     that this method is called within a subdirectory of PROJECT_ROOT.
 
@@ -357,36 +506,22 @@ def publish_report(prefix="",
 
         os.symlink(os.path.abspath(src), dest)
 
-    def _copy(src, dest):
-        if os.path.exists(dest):
-            shutil.rmtree(dest)
-        if not os.path.exists(src):
-            E.warn("%s does not exist - skipped" % src)
-            return
-        shutil.copytree(os.path.abspath(src), dest)
-
     # publish export dir via symlinking
     E.info("linking export directory in %s" % dest_export)
     _link(src_export,
           os.path.abspath(os.path.join(web_dir, dest_export)))
 
-    # publish web pages by copying
+    # publish web pages by copying changed files
     E.info("publishing web pages in %s" %
            os.path.abspath(os.path.join(web_dir, dest_report)))
-    _copy(os.path.abspath("report/html"),
-          os.path.abspath(os.path.join(web_dir, dest_report)))
-
-    for root, dirs, files in os.walk(os.path.join(web_dir, dest_report)):
-        for f in files:
-            fn = os.path.join(root, f)
-            if fn.endswith(".html"):
-                with open(fn) as inf:
-                    data = inf.read()
-                for rx, repl in _patterns:
-                    data = rx.sub(repl, data)
-                outf = open(fn, "w")
-                outf.write(data)
-                outf.close()
+    if os.path.exists("report/html"):
+        publishFiles(os.path.abspath("report/html"),
+                     os.path.abspath(os.path.join(web_dir, dest_report)),
+                     patterns=_patterns,
+                     threads=PARAMS.get("report_threads", 1))
+    else:
+        E.warn("%s does not exist - skipped" %
+               os.path.abspath("report/html"))
 
     if export_files:
         bigwigs, bams, beds = [], [], []
@@ -714,3 +849,246 @@ def publish_tracks(export_files,
 
     E.info(
         "data hub has been created at http://www.cgat.org/downloads/%(project_id)s/ucsc/hub.txt" % locals())
+
+
+def getTableStates(dbhandle, workingdir="."):
+    '''return a fingerprint of each table in an sqlite database.
+
+    The fingerprint consists of a hash of the table definition and a
+    modification marker. For tables loaded by a task, the marker is
+    the modification time of the :file:`.load` sentinel file in
+    *workingdir* that is touched whenever the table is (re-)loaded.
+    For other tables, the marker is the number of rows and the
+    largest rowid, which change when rows are added or removed.
+    Neither requires reading the table contents. Rows updated in
+    place are not detected.
+
+    Returns
+    -------
+    states : dict
+        Dictionary mapping table names to fingerprints.
+    '''
+    sentinels = {}
+    for fn in glob.glob(os.path.join(workingdir, "*.load")):
+        table = toTable(fn)
+        sentinels[table] = max(sentinels.get(table, 0),
+                               os.path.getmtime(fn))
+
+    states = {}
+    tables = dbhandle.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'table'").fetchall()
+    for table, sql in tables:
+        if table in sentinels:
+            marker = sentinels[table]
+        else:
+            try:
+                marker = list(dbhandle.execute(
+                    'SELECT COUNT(*), MAX(rowid) FROM "%s"' %
+                    table).fetchone())
+            except sqlite3.OperationalError:
+                # tables without rowid
+                marker = list(dbhandle.execute(
+                    'SELECT COUNT(*) FROM "%s"' % table).fetchone())
+        states[table] = [hashlib.md5((sql or "").encode("utf-8")).hexdigest(),
+                         marker]
+    return states
+
+
+def _patternToRegex(pattern):
+    '''convert a string with format placeholders or regular expression
+    groups into a regular expression matching table names.'''
+    parts = re.split(r"%(?:\(\w+\))?s|\(\.[*+]\)|\(\\S\+\)", pattern)
+    if len(parts) < 2 or len("".join(parts)) < 3:
+        return None
+    return re.compile("^%s$" % r"\w+".join(map(re.escape, parts)))
+
+
+def getTrackerInputs(trackerdir, tables, workingdir="."):
+    '''return the inputs of each tracker module in *trackerdir*.
+
+    Inputs are found by scanning the source code of each module:
+
+    * identifiers and strings that are names of tables in *tables*,
+    * strings with placeholders such as ``%(track)s_genes`` or
+      ``(.*)_genes``, which are matched against *tables*,
+    * strings that are names of existing files relative to
+      *workingdir*.
+
+    Inputs of tracker modules imported by a module are added to the
+    inputs of the importing module.
+
+    Returns
+    -------
+    inputs : dict
+        Dictionary mapping module names to a tuple of source hash,
+        set of tables and set of files.
+    '''
+
+    sources = {}
+    for fn in glob.glob(os.path.join(trackerdir, "*.py")):
+        with open(fn) as inf:
+            sources[os.path.basename(fn)[:-3]] = inf.read()
+
+    direct, imports = {}, {}
+    for module, source in sources.items():
+        words = set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", source))
+        strings = re.findall(r"[\"']([^\"'\n]+)[\"']", source)
+        used = words.intersection(tables)
+        files = set()
+        for string in strings:
+            if string in tables:
+                used.add(string)
+            elif os.path.isfile(os.path.join(workingdir, string)):
+                files.add(string)
+            for token in re.findall(
+                    r"[\w%()\\.*+]*(?:%(?:\(\w+\))?s|\(\.[*+]\))"
+                    r"[\w%()\\.*+]*", string):
+                rx = _patternToRegex(token)
+                if rx is not None:
+                    used.update([x for x in tables if rx.match(x)])
+        direct[module] = (hashlib.md5(source.encode("utf-8")).hexdigest(),
+                          used, files)
+        imports[module] = set(re.findall(
+            r"^\s*(?:from|import)\s+(\w+)", source, re.M)).intersection(
+                sources)
+
+    inputs = {}
+    for module in sources:
+        seen, todo = set(), [module]
+        while todo:
+            m = todo.pop()
+            if m not in seen:
+                seen.add(m)
+                todo.extend(imports[m])
+        inputs[module] = (
+            hashlib.md5("".join(sorted(
+                [direct[x][0] for x in seen])).encode("utf-8")).hexdigest(),
+            set().union(*[direct[x][1] for x in seen]),
+            set().union(*[direct[x][2] for x in seen]))
+    return inputs
+
+
+def getReportPages(docdir):
+    '''return the tracker modules used by each page of a report.
+
+    Returns
+    -------
+    pages : dict
+        Dictionary mapping filenames of pages to sets of module names.
+    '''
+    pages = {}
+    for root, dirs, files in os.walk(docdir):
+        for fn in files:
+            if not fn.endswith(".rst"):
+                continue
+            fn = os.path.join(root, fn)
+            with open(fn) as inf:
+                pages[fn] = set(re.findall(
+                    r"^\s*\.\.\s+report::\s+(\w+)\.", inf.read(), re.M))
+    return pages
+
+
+def invalidateReport(dbhandle, docdir, doctreedir, cachedir="_cache",
+                     statefile=None, workingdir="."):
+    '''prepare an incremental report build.
+
+    The tables and files used by each tracker module are compared to
+    their state at the previous build, stored in *statefile*. For
+    modules with changed inputs or source code, cached tracker
+    results in *cachedir* are removed and the doctrees of pages using
+    the module are removed from *doctreedir*, which causes sphinx to
+    re-read these pages. The report source itself is not modified.
+
+    Arguments
+    ---------
+    dbhandle : object
+        Database handle of an sqlite database.
+    docdir : string
+        Directory with the report source. Trackers are in
+        :file:`trackers` below it.
+    doctreedir : string
+        Directory with the doctrees of the previous build.
+    cachedir : string
+        Cache directory of the report engine.
+    statefile : string
+        Filename to store the state of inputs. Defaults to
+        :file:`report_state.json` in *cachedir*.
+    workingdir : string
+        Directory relative to which trackers read files.
+
+    Returns
+    -------
+    state : dict
+        The current state, to be saved with :func:`saveReportState`
+        once the report has been built.
+    marked : bool
+        False if some pages could not be marked for rebuilding, for
+        example because the doctrees are not writable. In this case
+        all pages need to be re-read.
+    '''
+
+    if statefile is None:
+        statefile = os.path.join(cachedir, "report_state.json")
+
+    tables = getTableStates(dbhandle, workingdir=workingdir)
+    inputs = getTrackerInputs(os.path.join(docdir, "trackers"),
+                              set(tables),
+                              workingdir=workingdir)
+
+    state = {"tables": tables, "modules": {}}
+    for module, (source_hash, used_tables, files) in inputs.items():
+        file_states = {}
+        for fn in files:
+            st = os.stat(os.path.join(workingdir, fn))
+            file_states[fn] = [st.st_size, st.st_mtime]
+        state["modules"][module] = {
+            "source": source_hash,
+            "tables": dict([(x, tables[x]) for x in used_tables]),
+            "files": file_states}
+
+    if os.path.exists(statefile):
+        with open(statefile) as inf:
+            old_state = json.load(inf)
+    else:
+        old_state = {"modules": {}}
+
+    changed = set([module for module, data in state["modules"].items()
+                   if old_state["modules"].get(module) != data])
+    E.info("report: %i of %i tracker modules have changed inputs" %
+           (len(changed), len(state["modules"])))
+
+    if changed and os.path.exists(cachedir):
+        for fn in os.listdir(cachedir):
+            if fn == os.path.basename(statefile):
+                continue
+            if set(re.split(r"\W+", fn)).intersection(changed):
+                os.unlink(os.path.join(cachedir, fn))
+
+    marked = True
+    for page, modules in getReportPages(docdir).items():
+        if modules.intersection(changed):
+            doctree = os.path.join(
+                doctreedir,
+                os.path.splitext(os.path.relpath(page, docdir))[0] +
+                ".doctree")
+            try:
+                if os.path.exists(doctree):
+                    os.unlink(doctree)
+            except OSError:
+                marked = False
+
+    if not marked:
+        E.warn("report: could not mark pages for rebuilding, "
+               "all pages will be rebuilt")
+
+    return state, marked
+
+
+def saveReportState(state, cachedir="_cache", statefile=None):
+    '''save the state returned by :func:`invalidateReport`.'''
+    if statefile is None:
+        statefile = os.path.join(cachedir, "report_state.json")
+    if not os.path.exists(os.path.dirname(statefile)):
+        os.makedirs(os.path.dirname(statefile))
+    with open(statefile, "w") as outf:
+        json.dump(state, outf)
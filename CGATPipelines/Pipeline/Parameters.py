@@ -28,8 +28,10 @@ Reference
 
 """
 
+import ast
 import re
 import collections
+import hashlib
 import os
 
 try:
@@ -92,6 +94,9 @@ class TriggeredDefaultFactory:
 # and normal dict behaviour.
 PARAMS = collections.defaultdict(TriggeredDefaultFactory())
 
+# resolved parameters, see getCachedParameters
+PARAMETER_CACHE = {}
+
 # patch - if --help or -h in command line arguments,
 # switch to a default dict to avoid missing paramater
 # failures
@@ -151,6 +156,17 @@ HARDCODED_PARAMS = {
     'local_tmpdir': os.environ.get("TMPDIR", '/scratch'),
     # directory used for temporary files shared across machines
     'shared_tmpdir': os.environ.get("SHARED_TMPDIR", "/ifs/scratch"),
+    # scratch space in local_tmpdir available to all jobs on a node,
+    # e.g. 200G. 0 means only limited by free disk space. See Scratch.py
+    'scratch_quota': "0",
+    # seconds a job waits for scratch space before failing
+    'scratch_timeout': 3600,
+    # scratch space reserved for a job without job_scratch_size as a
+    # multiple of the size of its input files
+    'scratch_size_factor': 4,
+    # stage temporary fastq files of mappers and read processors in
+    # node-local scratch space instead of shared_tmpdir
+    'scratch_fastq': False,
     # queue manager (supported: sge, slurm, torque, pbspro)
     'cluster_queue_manager': 'sge',
     # cluster queue to use
@@ -163,10 +179,61 @@ HARDCODED_PARAMS = {
     'cluster_memory_resource': "mem_free",
     # amount of memory set by default for each job
     'cluster_memory_default': "2G",
+    # predict job memory from previous runs recorded in the job
+    # database instead of using job_memory, see Jobs.py
+    'cluster_memory_prediction': False,
+    # safety factor applied to predicted memory
+    'cluster_memory_margin': 1.5,
+    # number of times a job that ran out of memory is resubmitted
+    # with more memory if memory prediction is enabled
+    'cluster_memory_retries': 2,
     # general cluster options
     'cluster_options': "",
     # parallel environment to use for multi-threaded jobs
     'cluster_parallel_environment': 'dedicated',
+    # record jobs and their resource usage in a database, see Jobs.py
+    'jobs_accounting': True,
+    # filename of the job database within the working directory
+    'jobs_database': "pipeline_jobs.db",
+    # number of threads available to jobs run on the local host.
+    # If set, local jobs are scheduled according to job_threads
+    # and job_memory. 0 uses all cpus if local_max_memory is set.
+    'local_max_threads': 0,
+    # memory available to jobs run on the local host, e.g. 64G.
+    # If set, local jobs are also limited to job_memory.
+    'local_max_memory': "0",
+    # number of warm worker processes for python functions on the
+    # local host, see Workers.py
+    'workers_local': 0,
+    # number of warm worker processes submitted as pilot jobs
+    'workers_pilots': 0,
+    # memory available to each warm worker process
+    'workers_memory': "4G",
+    # cache resolved parameters at start-up and of pipelines read
+    # with peekParameters
+    'parameters_cache': True,
+    # maximum number of files in the parameter cache, the least
+    # recently used files are removed
+    'parameters_cache_size': 100,
+    # only rebuild report pages whose inputs have changed
+    'report_incremental': False,
+    # comma-separated list of sinks for pipeline events, for example
+    # file:pipeline_events.jsonl,sqlite:pipeline_events.db,rabbitmq.
+    # See Events.py
+    'events_sinks': "",
+    # maximum number of events sent to sinks at once
+    'events_batch_size': 1000,
+    # maximum time in seconds before queued events are sent
+    'events_interval': 1.0,
+    # scan the working directory in parallel before checking which
+    # jobs are up-to-date, see FileCache.py
+    'filecache_enable': False,
+    # number of threads for scanning the working directory
+    'filecache_threads': 16,
+    # comma-separated list of directories not to scan
+    'filecache_exclude': "report,export",
+    # keep the scan between invocations if no jobs have been run
+    'filecache_persist': False,
     # ruffus job limits for databases
     'jobs_limit_db': 10,
     # ruffus job limits for R
@@ -344,6 +411,211 @@ def inputValidation(PARAMS, pipeline_script=""):
                 sys.exit(0)
 
 
+def getParameterFiles(filenames,
+                      site_ini=True,
+                      user_ini=True,
+                      default_ini=True):
+    '''return the configuration files contributing to the parameters
+    of a pipeline in the order in which they are read.
+
+    See :func:`getParameters` for the order of initialization.
+
+    Arguments
+    ---------
+    filenames : list
+       List of filenames of the configuration files supplied by the
+       user. Files that do not exist are removed from the list.
+    site_ini : bool
+       If set, add :file:`/etc/cgat/pipeline.ini`.
+    user_ini : bool
+       If set, add :file:`.cgat` in the user's home directory.
+    default_ini : bool
+       If set, add 'CGATPipelines/configuration/pipeline.ini'.
+
+    Returns
+    -------
+    filenames : list
+       List of filenames.
+    '''
+
+    # IMS: Several legacy scripts call this with a string as input
+    # rather than a list. Check for this and correct
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    # Clear up ini files on the list that do not exist.
+    # Please note the use of list(filenames) to create
+    # a clone to iterate over as we remove items from
+    # the original list (to avoid unexpected results)
+    for fn in list(filenames):
+        if not os.path.exists(fn):
+            filenames.remove(fn)
+
+    if site_ini:
+        # read configuration from /etc/cgat/pipeline.ini
+        fn = "/etc/cgat/pipeline.ini"
+        if os.path.exists(fn):
+            filenames.insert(0, fn)
+
+    if user_ini:
+        # read configuration from a users home directory
+        fn = os.path.join(os.path.expanduser("~"),
+                          ".cgat")
+        if os.path.exists(fn):
+            filenames.insert(0, fn)
+
+    if default_ini:
+        # The link between CGATPipelines and Pipeline.py
+        # needs to severed at one point.
+        # 1. config files into CGAT module directory?
+        # 2. Pipeline.py into CGATPipelines module directory?
+        filenames.insert(0,
+                         os.path.join(CGATPIPELINES_PIPELINE_DIR,
+                                      'configuration',
+                                      'pipeline.ini'))
+
+    return filenames
+
+
+def getParameterHash(filenames, *args):
+    '''return a hash of the contents of *filenames* and of any
+    additional arguments.
+
+    The hash changes if any of the files or the hard-coded defaults
+    in this module change. It is used as a key for
+    :func:`getCachedParameters`.
+    '''
+    h = hashlib.sha1()
+    for fn in [__file__.replace(".pyc", ".py")] + list(filenames):
+        h.update(fn.encode("utf-8"))
+        if os.path.exists(fn):
+            with open(fn, "rb") as inf:
+                h.update(hashlib.sha1(inf.read()).digest())
+    for arg in args:
+        h.update(str(arg).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _getCacheFilename(key):
+    cachedir = PARAMS.get(
+        "parameters_cachedir",
+        os.path.join(os.path.expanduser("~"), ".cache", "cgat",
+                     "parameters"))
+    return os.path.join(cachedir, "%s.params" % key)
+
+
+def getCachedParameters(key):
+    '''return resolved parameters stored under *key* or None.
+
+    Parameters are looked up in memory first and then in
+    ``parameters_cachedir``. Files read from the cache are marked as
+    recently used, see :func:`pruneParameterCache`.
+    '''
+    if key in PARAMETER_CACHE:
+        return dict(PARAMETER_CACHE[key])
+
+    if not PARAMS.get("parameters_cache", True):
+        return None
+
+    fn = _getCacheFilename(key)
+    if not os.path.exists(fn):
+        return None
+    try:
+        with open(fn) as inf:
+            params = ast.literal_eval(inf.read())
+        os.utime(fn, None)
+    except (IOError, OSError, ValueError, SyntaxError) as msg:
+        E.warn("could not read parameter cache %s: %s" % (fn, msg))
+        return None
+    PARAMETER_CACHE[key] = params
+    return dict(params)
+
+
+def cacheParameters(key, params):
+    '''store resolved parameters under *key*.
+
+    Parameters are serialized as a python literal that is read back
+    with :func:`ast.literal_eval`, which preserves types such as
+    tuples and non-string keys. Parameters that can not be
+    represented as a literal are not cached. Failures to write the
+    cache are logged and otherwise ignored. The size of the cache is
+    limited, see :func:`pruneParameterCache`.
+    '''
+    PARAMETER_CACHE[key] = dict(params)
+
+    if not PARAMS.get("parameters_cache", True):
+        return
+
+    fn = _getCacheFilename(key)
+    try:
+        data = repr(dict(params))
+        ast.literal_eval(data)
+    except (ValueError, SyntaxError) as msg:
+        E.warn("could not cache parameters: %s" % msg)
+        return
+
+    try:
+        if not os.path.exists(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        tmpfile = "%s.%i" % (fn, os.getpid())
+        with open(tmpfile, "w") as outf:
+            outf.write(data)
+        os.rename(tmpfile, fn)
+    except (IOError, OSError) as msg:
+        E.warn("could not write parameter cache %s: %s" % (fn, msg))
+        return
+
+    pruneParameterCache(os.path.dirname(fn),
+                        int(PARAMS.get("parameters_cache_size", 100)))
+
+
+def pruneParameterCache(cachedir, size):
+    '''remove all but the *size* most recently used files from
+    the parameter cache in *cachedir*.
+
+    Every distinct combination of configuration files adds a file
+    to the cache, so old entries are removed to keep the cache from
+    growing without bounds.
+    '''
+    filenames = []
+    for fn in os.listdir(cachedir):
+        if fn.endswith(".params"):
+            fn = os.path.join(cachedir, fn)
+            try:
+                filenames.append((os.path.getmtime(fn), fn))
+            except OSError:
+                # removed by another process
+                pass
+
+    for mtime, fn in sorted(filenames, reverse=True)[size:]:
+        try:
+            os.unlink(fn)
+        except OSError:
+            pass
+
+
+def _getRawConfig(config):
+    '''return the uninterpolated values in *config* as a list of
+    sections with lists of (key, value) tuples.'''
+    defaults = config.defaults()
+    raw = [("DEFAULT", sorted(defaults.items()))]
+    for section in config.sections():
+        raw.append((section, sorted(
+            [(key, value) for key, value in config.items(section, raw=True)
+             if defaults.get(key) != value])))
+    return raw
+
+
+def _setRawConfig(config, raw):
+    '''add the values returned by :func:`_getRawConfig` to
+    *config*.'''
+    for section, items in raw:
+        if section != "DEFAULT" and not config.has_section(section):
+            config.add_section(section)
+        for key, value in items:
+            config.set(section, key, value)
+
+
 def getParameters(filenames=["pipeline.ini", ],
                   defaults=None,
                   site_ini=True,
@@ -368,6 +640,11 @@ def getParameters(filenames=["pipeline.ini", ],
 
     This function also updates the module-wide parameter map.
 
+    The values read from the configuration files are cached (see
+    :func:`cacheParameters`) using the contents of the files as a
+    key, so that the files need not be parsed and interpolated again
+    when a pipeline is started or imported repeatedly.
+
     The section [DEFAULT] is equivalent to [general].
 
     The order of initialization is as follows:
@@ -438,48 +715,26 @@ def getParameters(filenames=["pipeline.ini", ],
         # turn on default dictionary
         TriggeredDefaultFactory.with_default = True
 
-    # Clear up ini files on the list that do not exist.
-    # Please note the use of list(filenames) to create
-    # a clone to iterate over as we remove items from
-    # the original list (to avoid unexpected results)
-    for fn in list(filenames):
-        if not os.path.exists(fn):
-            filenames.remove(fn)
-
-    if site_ini:
-        # read configuration from /etc/cgat/pipeline.ini
-        fn = "/etc/cgat/pipeline.ini"
-        if os.path.exists(fn):
-            filenames.insert(0, fn)
-
-    if user_ini:
-        # read configuration from a users home directory
-        fn = os.path.join(os.path.expanduser("~"),
-                          ".cgat")
-        if os.path.exists(fn):
-            filenames.insert(0, fn)
-
-    if default_ini:
-        # The link between CGATPipelines and Pipeline.py
-        # needs to severed at one point.
-        # 1. config files into CGAT module directory?
-        # 2. Pipeline.py into CGATPipelines module directory?
-        filenames.insert(0,
-                         os.path.join(CGATPIPELINES_PIPELINE_DIR,
-                                      'configuration',
-                                      'pipeline.ini'))
-
-    # IMS: Several legacy scripts call this with a string as input
-    # rather than a list. Check for this and correct
-
-    if isinstance(filenames, str):
-        filenames = [filenames]
+    filenames = getParameterFiles(filenames,
+                                  site_ini=site_ini,
+                                  user_ini=user_ini,
+                                  default_ini=default_ini)
 
     PARAMS['pipeline_ini'] = filenames
 
-    CONFIG.read(filenames)
-
-    p = configToDictionary(CONFIG)
+    # values from configuration files already read are part of the
+    # key as they can be referred to by interpolation
+    key = getParameterHash(filenames, _getRawConfig(CONFIG))
+    cached = getCachedParameters(key)
+    if cached is None:
+        CONFIG.read(filenames)
+        p = configToDictionary(CONFIG)
+        if p.get("parameters_cache", True):
+            cacheParameters(key, {"config": _getRawConfig(CONFIG),
+                                  "params": p})
+    else:
+        _setRawConfig(CONFIG, cached["config"])
+        p = cached["params"]
 
     # update with hard-coded PARAMS
     PARAMS.update(HARDCODED_PARAMS)
@@ -0,0 +1,434 @@
+##########################################################################
+#
+#   MRC FGU Computational Genomics Group
+#
+#   $Id$
+#
+#   Copyright (C) 2009 Andreas Heger
+#
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation; either version 2
+#   of the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+##########################################################################
+"""Scratch.py - Node-local scratch space for jobs
+==================================================
+
+Jobs that write large intermediate files to the shared temporary
+directory (``shared_tmpdir``) cause heavy traffic on the shared
+filesystem. This module lets a job work in a directory on the
+node-local disk (``local_tmpdir``) instead.
+
+A job declares files to stage in and out with options to
+:func:`run`::
+
+    statement = '''sort %(scratch_infile)s > %(scratch_outfile)s'''
+    P.run(job_scratch_inputs=infile,
+          job_scratch_outputs=outfile)
+
+Before the statement is run, a scratch directory is created on the
+node executing the job and the inputs are copied into it. Within
+the statement, the following variables are available:
+
+``scratch_dir``
+   the scratch directory, ``${CGAT_SCRATCH}``
+``scratch_infile``, ``scratch_infiles``
+   the first and all staged input files
+``scratch_outfile``, ``scratch_outfiles``
+   the first and all output files to be copied back
+
+If the statement succeeds, the output files are copied back next to
+their final location and renamed into place, so that partial output
+never appears under the final name. The scratch directory is removed
+when the job finishes, fails or receives a signal. Directories of
+jobs that were killed outright are removed by the next job on the
+same node.
+
+Statements that refer to ``${CGAT_SCRATCH}`` directly, for example
+via :func:`getScratchDir`, are given a scratch directory without
+staging.
+
+Scratch space is reserved before a job starts. The reservation is
+the size of the staged inputs plus ``job_scratch_size``. If that is
+not given, the size of the job's input files multiplied by
+``scratch_size_factor`` is reserved. If the reservations on a node
+would exceed ``scratch_quota`` or the free space on the disk, the
+job waits for up to ``scratch_timeout`` seconds.
+
+The node-side part of this module is run as a script and only uses
+the standard library.
+
+Reference
+---------
+
+"""
+
+import fcntl
+import json
+import optparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+# Set from Pipeline.py
+PARAMS = {}
+
+# shell variable holding the scratch directory of a job
+SCRATCH_VARIABLE = "CGAT_SCRATCH"
+
+# sub-directory of local_tmpdir with scratch directories
+SCRATCH_ROOT = "cgat_scratch"
+
+# interval in seconds between checks for free scratch space
+POLL_INTERVAL = 10
+
+
+def getScratchDir(subdir=None):
+    '''return the node-local scratch directory of a job for use
+    in a statement.
+
+    Using the directory in a statement makes :func:`run` create
+    the directory on the node executing the job.
+
+    Arguments
+    ---------
+    subdir : string
+        Optional sub-directory within the scratch directory.
+
+    Returns
+    -------
+    path : string
+        Path containing the shell variable ``${CGAT_SCRATCH}``.
+    '''
+    path = "${%s}" % SCRATCH_VARIABLE
+    if subdir:
+        path = "%s/%s" % (path, subdir)
+    return path
+
+
+def usesScratch(statement):
+    '''return True if *statement* refers to the scratch directory.'''
+    return "${%s}" % SCRATCH_VARIABLE in statement or \
+        "$%s" % SCRATCH_VARIABLE in statement
+
+
+def _asList(filenames):
+    if filenames is None:
+        return []
+    elif isinstance(filenames, str):
+        return [filenames]
+    return list(filenames)
+
+
+def getScratchFiles(inputs=None, outputs=None):
+    '''return statement variables for staged files.
+
+    Files are placed in the scratch directory under their basename.
+
+    Arguments
+    ---------
+    inputs : list
+        Files to copy to the scratch directory.
+    outputs : list
+        Files to copy back from the scratch directory.
+
+    Returns
+    -------
+    variables : dict
+        Dictionary with the statement variables ``scratch_dir``,
+        ``scratch_infile``, ``scratch_infiles``, ``scratch_outfile``
+        and ``scratch_outfiles``.
+
+    Raises
+    ------
+    ValueError
+        If two files have the same basename.
+    '''
+    inputs, outputs = _asList(inputs), _asList(outputs)
+
+    basenames = [os.path.basename(x) for x in inputs + outputs]
+    duplicates = set([x for x in basenames if basenames.count(x) > 1])
+    if duplicates:
+        raise ValueError(
+            "scratch files with identical names: %s" %
+            ",".join(sorted(duplicates)))
+
+    scratch_dir = getScratchDir()
+    infiles = ["%s/%s" % (scratch_dir, os.path.basename(x))
+               for x in inputs]
+    outfiles = ["%s/%s" % (scratch_dir, os.path.basename(x))
+                for x in outputs]
+    return {"scratch_dir": scratch_dir,
+            "scratch_infile": (infiles + [""])[0],
+            "scratch_infiles": " ".join(infiles),
+            "scratch_outfile": (outfiles + [""])[0],
+            "scratch_outfiles": " ".join(outfiles)}
+
+
+def buildScratchStatement(statement, inputs=None, outputs=None,
+                          size=0, check_errors=True):
+    '''wrap *statement* so that it runs in a node-local scratch
+    directory.
+
+    Arguments
+    ---------
+    statement : string
+        Command line statement.
+    inputs : list
+        Files to copy to the scratch directory before the statement
+        is run.
+    outputs : list
+        Files to copy back after the statement has completed
+        successfully.
+    size : int
+        Scratch space in bytes to reserve in addition to the inputs.
+    check_errors : bool
+        If True, check for errors in the statement with
+        ``checkpoint`` (see :func:`expandStatement`) before
+        copying outputs.
+
+    Returns
+    -------
+    statement : string
+        The wrapped statement.
+    '''
+
+    inputs = [os.path.abspath(x) for x in _asList(inputs)]
+    outputs = [os.path.abspath(x) for x in _asList(outputs)]
+    size += sum([os.path.getsize(x) for x in inputs if os.path.exists(x)])
+
+    script = os.path.abspath(__file__)
+    if script.endswith(".pyc"):
+        script = script[:-1]
+    helper = "%s %s" % (sys.executable, script)
+
+    reserve = [helper, "reserve",
+               '--root="%s"' % PARAMS.get("local_tmpdir",
+                                          tempfile.gettempdir()),
+               "--size=%i" % size,
+               "--quota=%s" % PARAMS.get("scratch_quota", "0"),
+               "--timeout=%i" % int(PARAMS.get("scratch_timeout", 3600)),
+               "--owner=$$"] + inputs
+
+    statements = [
+        "%s=`%s` || exit 1" % (SCRATCH_VARIABLE, " ".join(reserve)),
+        "export %s" % SCRATCH_VARIABLE,
+        """trap '%s release "$%s"' EXIT""" % (helper, SCRATCH_VARIABLE),
+        "trap 'exit 1' INT TERM HUP USR1 USR2",
+        statement]
+
+    if outputs:
+        commit = '%s commit --dir="$%s" %s' % (
+            helper, SCRATCH_VARIABLE, " ".join(outputs))
+        if check_errors:
+            statements.extend(["checkpoint", commit])
+        else:
+            statements[-1] = "%s && %s" % (statement, commit)
+
+    return "; ".join(statements)
+
+
+def _parseSize(value):
+    '''convert a size with an optional suffix K, M, G or T to bytes.'''
+    value = str(value).strip().upper()
+    for exponent, suffix in enumerate("KMGT"):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * 1024 ** (exponent + 1))
+    return int(float(value))
+
+
+def _isOrphan(reservation):
+    '''return True if the job owning a reservation on this host
+    has gone.'''
+    if reservation.get("host") != socket.gethostname():
+        return False
+    try:
+        os.kill(reservation["owner"], 0)
+    except OSError:
+        return True
+    return False
+
+
+def _readReservations(root):
+    '''return reservations in *root*, removing those of jobs
+    that have gone.'''
+    reservations = []
+    for filename in os.listdir(root):
+        if not filename.endswith(".json"):
+            continue
+        filename = os.path.join(root, filename)
+        try:
+            with open(filename) as inf:
+                reservation = json.load(inf)
+        except (IOError, OSError, ValueError):
+            continue
+        if _isOrphan(reservation):
+            shutil.rmtree(filename[:-len(".json")], ignore_errors=True)
+            os.unlink(filename)
+            continue
+        reservations.append(reservation)
+    return reservations
+
+
+def reserve(root, size, quota=0, owner=None, timeout=3600):
+    '''create a scratch directory once *size* bytes are available.
+
+    Reservations are recorded next to the scratch directories and
+    checked under a lock so that concurrent jobs on a node do not
+    exceed *quota* (if not 0) or the free space on the disk.
+
+    Returns
+    -------
+    scratch_dir : string
+        The scratch directory.
+
+    Raises
+    ------
+    OSError
+        If the space was not available within *timeout* seconds.
+    '''
+
+    root = os.path.join(root, SCRATCH_ROOT)
+    if not os.path.exists(root):
+        try:
+            os.makedirs(root)
+        except OSError:
+            # created by a concurrent job
+            pass
+
+    if quota and size > quota:
+        raise OSError("scratch space of %i bytes exceeds quota of %i bytes" %
+                      (size, quota))
+
+    deadline = time.time() + timeout
+    lockfile = open(os.path.join(root, ".lock"), "w")
+    try:
+        while True:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                used = sum([x["size"] for x in _readReservations(root)])
+                stat = os.statvfs(root)
+                free = stat.f_bavail * stat.f_frsize
+                if (not quota or used + size <= quota) and size <= free:
+                    scratch_dir = tempfile.mkdtemp(dir=root, prefix="ctmp")
+                    with open(scratch_dir + ".json", "w") as outf:
+                        json.dump({"host": socket.gethostname(),
+                                   "owner": owner or os.getppid(),
+                                   "size": size}, outf)
+                    return scratch_dir
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+            if time.time() > deadline:
+                raise OSError(
+                    "no scratch space of %i bytes available in %s after "
+                    "%is: %i bytes reserved, %i bytes free" %
+                    (size, root, timeout, used, free))
+            time.sleep(POLL_INTERVAL)
+    finally:
+        lockfile.close()
+
+
+def release(scratch_dir):
+    '''remove a scratch directory and its reservation.'''
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    if os.path.exists(scratch_dir + ".json"):
+        os.unlink(scratch_dir + ".json")
+
+
+def stage(scratch_dir, filenames):
+    '''copy *filenames* into *scratch_dir*.'''
+    for filename in filenames:
+        shutil.copy(filename, os.path.join(scratch_dir,
+                                           os.path.basename(filename)))
+
+
+def commit(scratch_dir, filenames):
+    '''copy files from *scratch_dir* to *filenames*.
+
+    Each file is copied to a temporary file in the destination
+    directory and then renamed. No file is copied if any is
+    missing.
+    '''
+    sources = [os.path.join(scratch_dir, os.path.basename(x))
+               for x in filenames]
+    missing = [x for x in sources if not os.path.exists(x)]
+    if missing:
+        raise OSError("output files missing in scratch directory: %s" %
+                      ",".join(missing))
+
+    for source, dest in zip(sources, filenames):
+        handle, tmpfile = tempfile.mkstemp(
+            dir=os.path.dirname(dest) or ".",
+            prefix="." + os.path.basename(dest))
+        os.close(handle)
+        try:
+            shutil.copy2(source, tmpfile)
+            os.rename(tmpfile, dest)
+        except BaseException:
+            os.unlink(tmpfile)
+            raise
+
+
+def main(argv=None):
+    '''reserve, release or commit a scratch directory on the node
+    executing a job.'''
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = optparse.OptionParser(
+        usage="%prog reserve|release|commit [OPTIONS] [files]")
+    parser.add_option("--root", dest="root", type="string")
+    parser.add_option("--dir", dest="dir", type="string")
+    parser.add_option("--size", dest="size", type="int", default=0)
+    parser.add_option("--quota", dest="quota", type="string", default="0")
+    parser.add_option("--owner", dest="owner", type="int")
+    parser.add_option("--timeout", dest="timeout", type="int",
+                      default=3600)
+    (options, args) = parser.parse_args(argv[1:])
+
+    if not args:
+        parser.error("no command given")
+    command, filenames = args[0], args[1:]
+
+    try:
+        if command == "reserve":
+            scratch_dir = reserve(options.root,
+                                  options.size,
+                                  quota=_parseSize(options.quota),
+                                  owner=options.owner,
+                                  timeout=options.timeout)
+            try:
+                stage(scratch_dir, filenames)
+            except BaseException:
+                release(scratch_dir)
+                raise
+            sys.stdout.write(scratch_dir + "\n")
+        elif command == "release":
+            release(filenames[0])
+        elif command == "commit":
+            commit(options.dir, filenames)
+        else:
+            parser.error("unknown command '%s'" % command)
+    except (IOError, OSError) as msg:
+        sys.stderr.write("scratch %s failed: %s\n" % (command, msg))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
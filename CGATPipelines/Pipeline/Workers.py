@@ -0,0 +1,410 @@
+##########################################################################
+#
+#   MRC FGU Computational Genomics Group
+#
+#   $Id$
+#
+#   Copyright (C) 2009 Andreas Heger
+#
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation; either version 2
+#   of the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+##########################################################################
+"""Workers.py - Warm worker processes for python functions
+===========================================================
+
+Functions decorated with :func:`cluster_runnable` and called with
+``submit=True`` are normally run as a separate job that starts a new
+interpreter, imports the pipeline module and unpickles the
+arguments. For pipelines that run many short functions, most of the
+time is spent starting up.
+
+This module provides a pool of long-lived worker processes that keep
+pipeline modules imported and receive function calls over a
+socket. Workers are either started on the local host
+(``workers_local``) or submitted as pilot jobs to the cluster
+(``workers_pilots``). Pilot jobs connect back to the pipeline
+process, which needs to be reachable from the compute nodes.
+
+The pool is configured in the ``[workers]`` section of the
+configuration file::
+
+    [workers]
+    # number of workers on the local host
+    local=4
+    # number of pilot jobs on the cluster
+    pilots=0
+    # memory available to each worker. Functions requesting
+    # more memory or more than one thread are submitted as
+    # separate jobs
+    memory=4G
+
+Note that functions are run within the worker's copy of the
+pipeline module. Changes to module-level state in the pipeline
+process after the worker has started are not visible to the
+function.
+
+Reference
+---------
+
+"""
+
+import importlib
+import os
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+from multiprocessing.connection import Client, Listener
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+# Set from Pipeline.py
+PARAMS = {}
+
+# global worker pool
+GLOBAL_POOL = None
+
+
+class WorkerPool(object):
+    '''a pool of worker processes accepting function calls.
+
+    The pool listens on a socket for workers connecting. Each
+    connected worker is served by a thread that takes calls from
+    a queue shared by all workers.
+
+    Arguments
+    ---------
+    nlocal : int
+        Number of workers to start on the local host.
+    npilots : int
+        Number of pilot jobs to submit to the cluster.
+    memory : string
+        Memory available to each worker.
+    workingdir : string
+        Working directory of workers.
+    '''
+
+    def __init__(self, nlocal=0, npilots=0, memory="4G",
+                 workingdir=None):
+
+        self.memory = memory
+        self.max_memory = IOTools.human2bytes(memory)
+        self.workingdir = workingdir or os.getcwd()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.nconnected = 0
+        self.npilots = npilots
+        self.processes = []
+        self.threads = []
+        self.closed = False
+
+        self.authkey = os.urandom(32)
+        if npilots > 0:
+            # pilots connect from compute nodes
+            self.listener = Listener(("", 0), authkey=self.authkey)
+            address = "%s:%i" % (socket.getfqdn(),
+                                 self.listener.address[1])
+        else:
+            self.listener = Listener(family="AF_UNIX",
+                                     authkey=self.authkey)
+            address = self.listener.address
+
+        # authentication key is passed through a file that is only
+        # readable by the user
+        self.keyfile = os.path.join(self.workingdir,
+                                    ".workers_%i.key" % os.getpid())
+        fd = os.open(self.keyfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        os.write(fd, self.authkey)
+        os.close(fd)
+
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+        statement = [sys.executable, "-m", "CGATPipelines.Pipeline.Workers",
+                     address, self.keyfile]
+
+        self.logfile = open(
+            os.path.join(self.workingdir, "pipeline_workers.log"), "a")
+        for x in range(nlocal):
+            self.processes.append(subprocess.Popen(
+                statement,
+                cwd=self.workingdir,
+                stdout=self.logfile,
+                stderr=subprocess.STDOUT))
+
+        for x in range(npilots):
+            thread = threading.Thread(
+                target=self._submitPilot,
+                args=(" ".join(statement), x))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        E.info("worker pool: started %i local workers and %i pilots at %s" %
+               (nlocal, npilots, address))
+
+    def _accept(self):
+        '''accept connections from workers.'''
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except (OSError, IOError, EOFError) as msg:
+                if self.closed:
+                    break
+                E.warn("worker pool: failed connection: %s" % msg)
+                continue
+
+            with self.lock:
+                self.nconnected += 1
+            thread = threading.Thread(target=self._serve,
+                                      args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _submitPilot(self, statement, idx):
+        '''submit a pilot job to the cluster and wait for it
+        to finish.'''
+
+        from CGATPipelines.Pipeline.Execution import run
+        try:
+            run(statement=statement,
+                job_memory=self.memory,
+                job_threads=1,
+                outfile="worker%i" % idx)
+        except Exception as msg:
+            E.warn("worker pool: pilot job %i failed: %s" % (idx, msg))
+        finally:
+            with self.lock:
+                self.npilots -= 1
+            self._checkAlive()
+
+    def _serve(self, connection):
+        '''send calls to a connected worker.'''
+        while True:
+            call = self.queue.get()
+            if call is None:
+                try:
+                    connection.send(None)
+                except (OSError, IOError):
+                    pass
+                break
+
+            try:
+                connection.send(call["request"])
+                call["result"] = connection.recv()
+            except (OSError, IOError, EOFError) as msg:
+                # worker has gone away, resubmit call
+                E.warn("worker pool: lost worker: %s" % msg)
+                self.queue.put(call)
+                break
+            call["done"].set()
+
+        connection.close()
+        with self.lock:
+            self.nconnected -= 1
+        self._checkAlive()
+
+    def _checkAlive(self):
+        '''release queued calls if no worker is left.'''
+        if self.isAlive():
+            return
+        while True:
+            try:
+                call = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if call is not None:
+                call["result"] = None
+                call["done"].set()
+
+    def isAlive(self):
+        '''return True if workers are connected or starting up.'''
+        if self.closed:
+            return False
+        with self.lock:
+            if self.nconnected > 0 or self.npilots > 0:
+                return True
+        return any([x.poll() is None for x in self.processes])
+
+    def accepts(self, job_threads=1, job_memory=None):
+        '''return True if a call with the given resource requirements
+        can be run in the pool.'''
+        if not self.isAlive():
+            return False
+        if job_threads and int(job_threads) > 1:
+            return False
+        if job_memory and \
+           IOTools.human2bytes(job_memory) > self.max_memory:
+            return False
+        return True
+
+    def call(self, module_file, function_name, args, kwargs):
+        '''run a function in a worker and wait for it to finish.
+
+        Arguments
+        ---------
+        module_file : string
+            Filename of module containing the function.
+        function_name : string
+            Name of the function.
+        args : list
+            Positional arguments.
+        kwargs : dict
+            Keyword arguments.
+
+        Returns
+        -------
+        success : bool
+            False if no worker was available to run the function.
+
+        Raises
+        ------
+        OSError
+            If the function raised an exception.
+        '''
+        call = {"request": (module_file, function_name, args, kwargs),
+                "result": None,
+                "done": threading.Event()}
+        self.queue.put(call)
+        self._checkAlive()
+        # wait with timeout so that the main thread can be interrupted
+        while not call["done"].wait(60):
+            pass
+
+        if call["result"] is None:
+            return False
+
+        success, msg = call["result"]
+        if not success:
+            raise OSError(
+                "---------------------------------------\n"
+                "Function %s in %s failed in worker: \n%s\n"
+                "-----------------------------------------" %
+                (function_name, module_file, msg))
+        return True
+
+    def close(self):
+        '''shut down all workers.'''
+        for x in range(len(self.processes) + len(self.threads)):
+            self.queue.put(None)
+        self.closed = True
+        self.listener.close()
+
+        # pilot jobs still waiting in the queue are not waited for
+        for process in self.processes:
+            process.wait()
+        self.logfile.close()
+        if os.path.exists(self.keyfile):
+            os.unlink(self.keyfile)
+
+
+def startWorkerPool():
+    '''start the global worker pool if configured.'''
+
+    global GLOBAL_POOL
+    nlocal = int(PARAMS.get("workers_local", 0))
+    npilots = int(PARAMS.get("workers_pilots", 0))
+    if nlocal + npilots == 0:
+        return None
+
+    GLOBAL_POOL = WorkerPool(nlocal=nlocal,
+                             npilots=npilots,
+                             memory=PARAMS.get("workers_memory", "4G"),
+                             workingdir=PARAMS.get("workingdir"))
+    return GLOBAL_POOL
+
+
+def closeWorkerPool():
+    '''shut down the global worker pool.'''
+
+    global GLOBAL_POOL
+    if GLOBAL_POOL is not None:
+        GLOBAL_POOL.close()
+        GLOBAL_POOL = None
+
+
+def getWorkerPool():
+    '''return the global worker pool or None if not started.'''
+    return GLOBAL_POOL
+
+
+def _importModule(module_file, modules):
+    '''import a module from a file, caching it in *modules*.'''
+    if module_file not in modules:
+        location = os.path.dirname(module_file)
+        if location != "" and location not in sys.path:
+            sys.path.append(location)
+        modules[module_file] = importlib.import_module(
+            os.path.basename(module_file))
+    return modules[module_file]
+
+
+def serve(address, authkey):
+    '''connect to a worker pool at *address* and run function
+    calls until told to stop.'''
+
+    if ":" in address:
+        host, port = address.split(":")
+        address = (host, int(port))
+
+    connection = Client(address, authkey=authkey)
+    modules = {}
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        module_file, function_name, args, kwargs = request
+        E.info("calling %s.%s" % (os.path.basename(module_file),
+                                  function_name))
+        try:
+            module = _importModule(module_file, modules)
+            getattr(module, function_name)(*args, **kwargs)
+            result = (True, None)
+        except Exception:
+            result = (False, traceback.format_exc())
+        sys.stdout.flush()
+        connection.send(result)
+
+    connection.close()
+
+
+def main(argv=None):
+    '''run a worker process connecting to the pool at the address
+    given on the command line.'''
+
+    if argv is None:
+        argv = sys.argv
+
+    address, keyfile = argv[1:3]
+    with open(keyfile, "rb") as inf:
+        authkey = inf.read()
+
+    serve(address, authkey)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -201,11 +201,16 @@ within a submodule to be exported are all imported to the namespace of
 
    Pipeline/Control
    Pipeline/Database
+   Pipeline/Events
    Pipeline/Execution
+   Pipeline/FileCache
    Pipeline/Files
+   Pipeline/Jobs
    Pipeline/Local
    Pipeline/Parameters
+   Pipeline/Scratch
    Pipeline/Utils
+   Pipeline/Workers
 
 Reference
 ---------
@@ -224,6 +229,7 @@ from CGATPipelines.Pipeline.Cluster import *
 from CGATPipelines.Pipeline.Execution import *
 from CGATPipelines.Pipeline.Utils import *
 from CGATPipelines.Pipeline.Parameters import *
+from CGATPipelines.Pipeline.Scratch import getScratchDir
 
 
 from CGAT import Experiment as E
@@ -238,8 +244,13 @@ from . import Local as Local
 from . import Execution as Execution
 from . import Control as Control
 from . import Database as Database
+from . import Events as Events
+from . import FileCache as FileCache
 from . import Files as Files
+from . import Jobs as Jobs
 from . import Parameters as Parameters
+from . import Scratch as Scratch
+from . import Workers as Workers
 
 # broadcast parameters and config object, take from
 # Parameters.py
@@ -251,7 +262,12 @@ Local.CONFIG = CONFIG
 Local.PARAMS = PARAMS
 Control.PARAMS = PARAMS
 Execution.PARAMS = PARAMS
+Events.PARAMS = PARAMS
+FileCache.PARAMS = PARAMS
 Files.PARAMS = PARAMS
+Jobs.PARAMS = PARAMS
+Scratch.PARAMS = PARAMS
+Workers.PARAMS = PARAMS
 
 # set working directory at process launch to prevent repeated calls to
 # os.getcwd failing if network is busy
@@ -260,13 +276,23 @@ PARAMS["workingdir"] = os.getcwd()
 
 def run_report(clean=True,
                with_pipeline_status=True,
-               pipeline_status_format="svg"):
+               pipeline_status_format="svg",
+               incremental=None):
     '''run CGATreport.
 
     This will also run ruffus to create an svg image of the pipeline
     status unless *with_pipeline_status* is set to False. The image
     will be saved into the export directory.
 
+    If *incremental* is set, the report is not cleaned. Instead,
+    cached results of trackers whose database tables, files or
+    source code have changed since the last build are removed and
+    only pages using these trackers are rebuilt (see
+    :func:`Local.invalidateReport`). If *incremental* is None, it is
+    set from the ``report_incremental`` option unless *clean* is
+    False, in which case it is always used as otherwise trackers
+    would return stale cached results.
+
     '''
 
     if with_pipeline_status:
@@ -321,6 +347,23 @@ def run_report(clean=True,
     # ignore these.
     erase_return = "|| true"
 
+    if incremental is None:
+        incremental = not clean or PARAMS.get("report_incremental", False)
+
+    # incremental builds require an sqlite database
+    report_state, sphinx_options = None, ""
+    if incremental and PARAMS["database_backend"] == "sqlite":
+        dbhandle = connect()
+        report_state, marked = Local.invalidateReport(
+            dbhandle, docdir,
+            doctreedir=os.path.join(PARAMS["workingdir"],
+                                    PARAMS["report_doctrees"]),
+            workingdir=PARAMS["workingdir"])
+        dbhandle.close()
+        if not marked:
+            sphinx_options = "-E"
+        clean = False
+
     if clean:
         clean = """rm -rf report _cache _static;"""
     else:
@@ -344,12 +387,26 @@ def run_report(clean=True,
     -d %(report_doctrees)s
     -c .
     -j %(report_threads)s
+    %(sphinx_options)s
     %(docdir)s %(report_html)s
     >& report.log %(erase_return)s )
     '''
 
     run()
 
+    # the return value of the build is ignored, thus check the log
+    # before recording the state of a successful build
+    if report_state is not None:
+        logfile = os.path.join(PARAMS["workingdir"], "report.log")
+        succeeded = False
+        if os.path.exists(logfile):
+            with open(logfile) as inf:
+                succeeded = "build succeeded" in inf.read()
+        if succeeded:
+            Local.saveReportState(report_state)
+        else:
+            E.warn("report build failed, see %s" % logfile)
+
     E.info('the report is available at %s' % os.path.abspath(
         os.path.join(PARAMS['report_html'], "contents.html")))
 
@@ -400,6 +457,7 @@ __all__ = [
     "createView",
     "getDatabaseName",
     "importFromIterator",
+    "loadTables",
     # Utils.py
     "add_doc",
     "isTest",
@@ -433,4 +491,6 @@ __all__ = [
     "checkParameter",
     "isTrue",
     "configToDictionary",
+    # Scratch.py
+    "getScratchDir",
 ]
@@ -24,6 +24,8 @@ from bs4 import BeautifulSoup, NavigableString
 from rpy2.robjects import pandas2ri
 from rpy2.robjects import r as R
 import copy
+import multiprocessing
+import pysam
 
 # Set PARAMS in calling module
 PARAMS = {}
@@ -514,78 +516,202 @@ def filterMutect(infile, outfile, logfile,
             outf.write("%s\t%i\n" % (reason, reasons[reason]))
 
 
-# the following two functions should be generalised
-# currently they operate only on mutect output
-def compileMutationalSignature(infiles, outfiles):
-    '''takes a list of mutect output files and compiles per sample mutation
-    signatures'''
+# single base substitutions, reported relative to the pyrimidine of the
+# mutated base pair
+SUBSTITUTIONS = ["C>A", "C>G", "C>T", "T>A", "T>C", "T>G"]
+
+# names of the six substitution classes in the output of
+# compileMutationalSignature and their index in SUBSTITUTIONS
+MUTATIONS = ["C:T", "C:A", "C:G", "A:C", "A:T", "A:G"]
+MUTATION2SUBSTITUTION = [2, 0, 1, 5, 3, 4]
+
+# 96 substitutions in trinucleotide context, e.g. A[C>A]G
+CHANNELS = ["%s[%s]%s" % (b5, substitution, b3)
+            for substitution in SUBSTITUTIONS
+            for b5 in "ACGT"
+            for b3 in "ACGT"]
+
+# map bases to 0-3 (ACGT), all other characters to 4
+BASE_CODES = np.empty(256, dtype=np.int64)
+BASE_CODES.fill(4)
+for x, c in enumerate("ACGT"):
+    BASE_CODES[ord(c)] = x
+    BASE_CODES[ord(c.lower())] = x
+
+# index of substitution in SUBSTITUTIONS from pyrimidine reference
+# base (C=1, T=3) and alternate base, -1 for invalid combinations
+SUBSTITUTION_INDEX = np.array([[-1, -1, -1, -1, -1],
+                               [0, -1, 1, 2, -1],
+                               [-1, -1, -1, -1, -1],
+                               [3, 4, 5, -1, -1],
+                               [-1, -1, -1, -1, -1]])
+
+
+def _encodeBases(bases):
+    '''return numeric codes of a sequence of bases.'''
+    return BASE_CODES[np.frombuffer("".join(bases).encode("ascii"),
+                                    dtype=np.uint8)]
+
+
+def countMutationalSignature(infile, genome=None):
+    '''count single base substitutions in :term:`vcf` formatted *infile*.
+
+    Substitutions are counted in the six classes of
+    :data:`SUBSTITUTIONS`. If *genome*, a samtools-indexed
+    :term:`fasta` file, is given, substitutions are also counted in
+    the 96 trinucleotide contexts of :data:`CHANNELS`. Purine
+    reference bases are counted as the pyrimidine on the opposite
+    strand with the reverse complement context.
+
+    The file is read as a stream and the counts are computed from
+    arrays of base codes.
+
+    Returns
+    -------
+    counts : numpy.array
+        Counts for each of the 6 substitutions.
+    context_counts : numpy.array
+        Counts for each of the 96 channels. None if no *genome* is
+        given.
+    '''
 
-    delim = ":"
+    if genome:
+        fasta = pysam.FastaFile(genome)
 
-    def lookup(b1, b2):
-        '''return lookup key for a pair of bases'''
-        return(b1 + delim + b2)
+    refs, alts, contexts = [], [], []
+    c = E.Counter()
+    with IOTools.openFile(infile) as inf:
+        for line in inf:
+            if line.startswith("#"):
+                continue
+            values = line.split("\t", 5)
+            c.input += 1
+            ref, alt = values[3].upper(), values[4].upper()
+            if len(ref) != 1 or len(alt) != 1:
+                c.skipped_not_snv += 1
+                continue
+            refs.append(ref)
+            alts.append(alt)
+            if genome:
+                pos = int(values[1]) - 1
+                context = fasta.fetch(values[0], max(0, pos - 1), pos + 2)
+                if len(context) != 3 or pos == 0:
+                    context = "NNN"
+                contexts.append(context)
+
+    if genome:
+        fasta.close()
+
+    if not refs:
+        E.info("%s: %s" % (infile, c))
+        return (np.zeros(len(SUBSTITUTIONS), dtype=np.int64),
+                np.zeros(len(CHANNELS), dtype=np.int64) if genome else None)
+
+    refs = _encodeBases(refs)
+    alts = _encodeBases(alts)
+    # purines are reported as the pyrimidine on the opposite strand
+    purine = (refs == 0) | (refs == 2)
+    refs = np.where(purine & (refs < 4), 3 - refs, refs)
+    alts = np.where(purine & (alts < 4), 3 - alts, alts)
+    substitutions = SUBSTITUTION_INDEX[refs, alts]
+    valid = substitutions >= 0
+    c.skipped_invalid = int(np.sum(~valid))
+    counts = np.bincount(substitutions[valid],
+                         minlength=len(SUBSTITUTIONS))
+
+    context_counts = None
+    if genome:
+        contexts = _encodeBases(contexts).reshape(-1, 3)
+        # reverse complement contexts of purines
+        flipped = np.where(contexts < 4, 3 - contexts, 4)[:, ::-1]
+        contexts = np.where(purine[:, np.newaxis], flipped, contexts)
+        # the genome base must agree with the reference base
+        has_context = (valid &
+                       (contexts[:, 1] == refs) &
+                       (contexts < 4).all(axis=1))
+        c.skipped_no_context = int(np.sum(valid & ~has_context))
+        channels = (substitutions * 16 +
+                    contexts[:, 0] * 4 +
+                    contexts[:, 2])[has_context]
+        context_counts = np.bincount(channels, minlength=len(CHANNELS))
+
+    c.output = int(np.sum(valid))
+    E.info("%s: %s" % (infile, c))
+
+    return counts, context_counts
+
+
+def _countMutationalSignature(args):
+    '''worker function for :func:`compileMutationalSignature`.'''
+    return countMutationalSignature(*args)
 
-    def breakKey(key):
-        '''take a lookup key and return the elements'''
-        return key.split(delim)
 
-    def comp(base):
-        '''return complementary base'''
-        comp_dict = {"C": "G", "G": "C", "A": "T", "T": "A"}
-        return comp_dict[base]
+# the following two functions should be generalised
+# currently they operate only on mutect output
+@cluster_runnable
+def compileMutationalSignature(infiles, outfiles, genome=None, threads=1):
+    '''takes a list of mutect output files and compiles per sample mutation
+    signatures.
+
+    Counts for the six substitution classes are output in long format
+    to ``outfiles[0]`` and as a table to ``outfiles[1]``. If a third
+    output file and a *genome* are given, a samples x 96 channels
+    matrix of substitutions in trinucleotide context is output to
+    ``outfiles[2]``.
+
+    Files are processed in parallel using *threads* processes, see
+    :func:`countMutationalSignature`. As child processes can not be
+    started from within a ruffus job, call this function with
+    ``submit=True`` and *job_threads* set to *threads* from a
+    pipeline.
+    '''
 
     def getID(infile):
         return P.snip(os.path.basename(infile),
                       ".mutect.snp.annotated.filtered.vcf")
 
-    outfile1 = IOTools.openFile(outfiles[0], "w")
-    mutations = ["C:T", "C:A", "C:G", "A:C", "A:T", "A:G"]
-
-    outfile1.write("%s\t%s\t%s\t%s\t%s\n" % ("patient_id", "base_change",
-                                             "ref", "alt", "frequency"))
-    patient_freq = {}
+    if len(outfiles) < 3:
+        genome = None
+
+    args = [(infile, genome) for infile in infiles]
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        try:
+            results = pool.map(_countMutationalSignature, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = list(map(_countMutationalSignature, args))
 
-    for infile in infiles:
-        patient_id = getID(infile)
-        mut_dict = {}
-        for comb in mutations:
-            mut_dict[comb] = 0
+    patient_ids = [getID(infile) for infile in infiles]
+    # samples x substitution classes in the order of MUTATIONS
+    counts = np.array([x[0] for x in results],
+                      dtype=np.int64).reshape(len(infiles), -1)
+    counts = counts[:, MUTATION2SUBSTITUTION]
 
-        with IOTools.openFile(infile, "r") as f:
-            for line in f.readlines():
-                if line.startswith('#'):
-                    continue
-                values = line.split("\t")
-                key = lookup(values[3], values[4])
-                if key in mut_dict:
-                    mut_dict[key] += 1
-                else:
-                    comp_key = lookup(
-                        comp(values[3]), comp(values[4]))
-                    mut_dict[comp_key] += 1
-
-        patient_freq[patient_id] = mut_dict
-
-    for mutation in mutations:
-        base1, base2 = breakKey(mutation)
-        for infile in infiles:
-            patient_id = getID(infile)
-            outfile1.write("%s\t%s\t%s\t%s\t%s\n" % (patient_id, mutation,
-                                                     base1, base2,
-                                                     patient_freq[patient_id]
-                                                     [mutation]))
-    outfile1.close()
-
-    outfile2 = IOTools.openFile(outfiles[1], "w")
-    outfile2.write("%s\t%s\n" % ("patient_id",
-                                 "\t".join(mutations)))
-    for infile in infiles:
-        patient_id = getID(infile)
-        frequencies = "\t".join(map(str, [patient_freq[patient_id][x]
-                                          for x in mutations]))
-        outfile2.write("%s\t%s\n" % (patient_id, frequencies))
-    outfile2.close()
+    with IOTools.openFile(outfiles[0], "w") as outf:
+        outf.write("%s\t%s\t%s\t%s\t%s\n" % ("patient_id", "base_change",
+                                             "ref", "alt", "frequency"))
+        for y, mutation in enumerate(MUTATIONS):
+            base1, base2 = mutation.split(":")
+            for patient_id, count in zip(patient_ids, counts[:, y]):
+                outf.write("%s\t%s\t%s\t%s\t%i\n" % (
+                    patient_id, mutation, base1, base2, count))
+
+    with IOTools.openFile(outfiles[1], "w") as outf:
+        outf.write("%s\t%s\n" % ("patient_id", "\t".join(MUTATIONS)))
+        for patient_id, row in zip(patient_ids, counts):
+            outf.write("%s\t%s\n" % (patient_id, "\t".join(map(str, row))))
+
+    if genome:
+        context_counts = np.array([x[1] for x in results],
+                                  dtype=np.int64).reshape(len(infiles), -1)
+        with IOTools.openFile(outfiles[2], "w") as outf:
+            outf.write("%s\t%s\n" % ("patient_id", "\t".join(CHANNELS)))
+            for patient_id, row in zip(patient_ids, context_counts):
+                outf.write("%s\t%s\n" % (patient_id,
+                                         "\t".join(map(str, row))))
 
 
 ##############################################################################
@@ -911,216 +1037,146 @@ def filterQuality(infile, qualstr, qualfilter, outfiles):
     out2.close()
 
 
-@cluster_runnable
-def FilterExacCols(infile, exac_suffs, exac_thresh):
-    '''
-    Returns a set of line indices indicating lines where either of the alleles
-    called have a frequency of greater that exac_thresh in any of the
-    populations specified as exac_suffs.
-    Where no data is available an allele frequency of -1 is used.
-
-    Exac provide data as AC_xxx and AN_xxx where AC is the allele count
-    - the number of times the allele has been called
-    - and AN is chromosome count - the number of
-    samples in which the allele could have been called - in population xxx.
-    AC / AN = allele frequecy.
-
-    exac_suffs are any columns where an AC_xxx and AN_xxx column is provided
-    in the VCF, e.g. Adj will calculate allele frequency from the AC_Adj
-    and AN_Adj columns
+def _splitAlleleValues(values, missing):
+    '''split comma-separated per-allele values into a
+    :class:`pandas.DataFrame` with one column per alternate allele.
 
+    Values that are not numeric (".", "NA") are set to *missing*.
+    Returns the values and a boolean array indicating which alleles
+    are present.
+    '''
+    values = pd.Series(values).str.split(",", expand=True)
+    present = values.notnull().values
+    values = values.apply(pd.to_numeric, errors="coerce").to_numpy(
+        dtype=float, copy=True)
+    values[np.isnan(values) & present] = missing
+    return values, present
+
+
+def _getCalledAlleleFrequencies(af, present, genotypes):
+    '''return the frequencies of the two alleles called in each
+    genotype.
+
+    *af* contains the frequencies of the alternate alleles with one
+    row per variant and *present* indicates the alleles at each
+    variant. The frequency of the reference allele is 1 minus the sum
+    of the (non-negative) alternate allele frequencies. If a called
+    allele is not in *af*, -1 is returned for both alleles.
+    '''
+    af = np.where(present, af, np.nan)
+    ref = 1 - np.nansum(np.clip(af, 0, None), axis=1)
+    af = np.column_stack((ref, af))
+    nalleles = present.sum(axis=1) + 1
+    # clamp only for indexing, alleles not in *af* are set to -1 below
+    index = np.minimum(genotypes, af.shape[1] - 1)
+    rows = np.arange(len(af))
+    called = np.column_stack((af[rows, index[:, 0]],
+                              af[rows, index[:, 1]]))
+    called[genotypes.max(axis=1) >= nalleles] = -1
+    return called
+
+
+def getRarityFrequencies(lines, columns, exac_suffs, fcols):
+    '''compute the allele frequencies of the alleles called in each
+    variant in *lines*.
+
+    *lines* is a list of rows of a variant table split into fields
+    and *columns* are the column names.
+
+    Frequencies are computed from ExAC allele counts (``AC_xxx``) and
+    chromosome counts (``AN_xxx``) for each population xxx in
+    *exac_suffs* and taken directly from the allele frequency columns
+    in *fcols*. Multi-allelic sites provide comma separated values,
+    where the chromosome count may be given once for all alleles.
+    Missing values result in an allele frequency of -1.
+
+    Returns
+    -------
+    freqs : numpy.array
+        Array of shape (number of variants, number of populations, 2)
+        with the frequencies of both called alleles in each population,
+        ExAC populations first.
     '''
-    # read columns from the input VCF
-    exac_suffs = exac_suffs.split(",")
-    cols = IOTools.openFile(infile).readline().strip().split("\t")
-    nD = dict()
-    afdict = dict()
-    for e in exac_suffs:
-        # find the columns with the appropriate information
-        # Allele count
-        AC_i = cols.index("AC_%s" % (e))
-        # Allele Number
-        AN_i = cols.index("AN_%s" % (e))
-        # Genotype
-        GT_i = cols.index('GT')
-        nlist = set()
-        n = 0
-        AFS = []
-        with IOTools.openFile(infile) as input:
-            for line in input:
-                if n > 1:
-                    line = line.strip().split("\t")
-                    # At multi-allelic sites, comma delimited AC and AN values
-                    # are provided
-                    # "." and "NA" indicate no data here - this is represented
-                    # as an AF of -1
-                    AC = line[AC_i].replace(".", "-1").replace(
-                        "NA", "-1").split(",")
-                    AN = line[AN_i].replace(".", "1").replace(
-                        "NA", "1").split(",")
-                    AC = np.array([float(a) for a in AC])
-                    AN = np.array([float(a) for a in AN])
-                    AF = AC / AN
-                    AF2 = [af if af > 0 else 0 for af in AF]
-                    AF = np.insert(AF, 0, (1 - sum(AF2)))
-
-                    # Chromosome count is usually the same for all minor
-                    # alleles (but not always)
-                    # If it is not the same the AC and AN lists should be the
-                    # same length
-                    # Otherwise AN will have length 1
-                    if len(AC) != len(AN):
-                        AN = [AN] * len(AC)
-
-                    # Record the genotype called in this sample for this SNP
-                    GT = line[GT_i]
-                    GT = GT.replace(".", '0')
-                    GT = GT.split("/")
-                    GT[0], GT[1] = int(GT[0]), int(GT[1])
-
-                    # If the variant is not in ExAC the ExAC columns show "."
-                    # but the site
-                    # may still have been called as multi allelic
-                    # - use -1 for all frequencies
-                    # in this case
-                    if max(GT) > (len(AF) - 1):
-                        AF = np.array([-1] * (max(GT) + 1))
-
-                    AF1 = AF[GT[0]]
-                    AF2 = AF[GT[1]]
-                    AFS.append((AF1, AF2))
-                    # Remember where both allele frequencies are
-                    # greater than exac_thresh
-                    if AF1 >= exac_thresh and AF2 >= exac_thresh:
-                        nlist.add(n)
-                else:
-                    AFS.append(('NA', 'NA'))
-                n += 1
-        afdict[e] = AFS
-        nD[e] = nlist
 
-    ns = set.union(*list(nD.values()))
-    return afdict, ns
+    genotypes = pd.Series([line[columns.index("GT")] for line in lines])
+    genotypes = genotypes.str.replace(".", "0", regex=False).str.split(
+        "[/|]", n=1, expand=True)
+    # haploid genotypes
+    if genotypes.shape[1] == 1:
+        genotypes[1] = genotypes[0]
+    genotypes[1] = genotypes[1].fillna(genotypes[0])
+    genotypes = genotypes.astype(int).values
 
+    freqs = []
+    for e in exac_suffs:
+        AC_i = columns.index("AC_%s" % e)
+        AN_i = columns.index("AN_%s" % e)
+        AC, present = _splitAlleleValues([line[AC_i] for line in lines], -1)
+        AN, AN_present = _splitAlleleValues(
+            [line[AN_i] for line in lines], 1)
+        # the chromosome count is usually the same for all alleles and
+        # given once
+        AN = np.where(AN_present, AN, AN[:, :1])
+        if AN.shape[1] < AC.shape[1]:
+            AN = np.column_stack(
+                [AN] + [AN[:, :1]] * (AC.shape[1] - AN.shape[1]))
+        freqs.append(_getCalledAlleleFrequencies(
+            AC / AN[:, :AC.shape[1]], present, genotypes))
 
-@cluster_runnable
-def FilterFreqCols(infile, thresh, fcols):
-    '''
-    Returns a set of line indices indicating lines where either of the alleles
-    called have a frequency of less than thresh in all of the columns specified
-    in fcols.
-    No information - assigned allele frequency of -1.
-    '''
-    fcols = fcols.split(",")
-    # read the column headings from the variant table
-    cols = IOTools.openFile(infile).readline().strip().split("\t")
-    # store allele frequency columns
-    AFdict = dict()
-    # store low frequency indices
-    nD = dict()
     for col in fcols:
-        ind = cols.index(col)
-        GT_i = cols.index('GT')
-        n = 0
-        nlist = set()
-        AFS = []
-        with IOTools.openFile(infile) as input:
-            for line in input:
-                if n > 1:
-                    line = line.strip().split("\t")
-                    GT = line[GT_i].replace(".", "0").split("/")
-                    af = line[ind].split(",")
-                    AF = []
-                    # where the allele frequency is not numeric
-                    # "." or "NA" use -1 to indicate no data
-                    for a in af:
-                        try:
-                            AF.append(float(a))
-                        except:
-                            AF.append(float(-1))
-                    AF2 = [l if l > 0 else 0 for l in AF]
-                    AF = np.array(AF)
-                    AF = np.insert(AF, 0, 1 - sum(AF2))
-                    GT[0] = int(GT[0])
-                    GT[1] = int(GT[1])
-                    # If the variant is not in database the column shows "."
-                    # but the site
-                    # may still have been called as multi allelic
-                    # - use -1 for all frequencies
-                    # in this case
-                    if max(GT[0], GT[1]) > (len(AF) - 1):
-                        AF = [float(-1)] * (max(GT[0], GT[1]) + 1)
-                    AF1 = AF[GT[0]]
-                    AF2 = AF[GT[1]]
-                    if AF1 >= thresh and AF2 >= thresh:
-                        nlist.add(n)
-                    AFS.append((AF1, AF2))
-                else:
-                    AFS.append(('NA', 'NA'))
-                n += 1
-        AFdict[col] = AFS
-        nD[col] = nlist
+        ind = columns.index(col)
+        af, present = _splitAlleleValues([line[ind] for line in lines], -1)
+        freqs.append(_getCalledAlleleFrequencies(af, present, genotypes))
 
-    ns = set.union(*list(nD.values()))
-    return AFdict, ns
+    return np.stack(freqs, axis=1)
 
 
-def WriteFreqFiltered(infile, exacdict, exacinds, otherdict, otherinds,
-                      outfiles):
+@cluster_runnable
+def filterRarity(infile, exac, freqs, thresh, outfiles, chunk_size=100000):
     '''
-    Writes the output of the frequency filtering steps to file, including
-    the new columns showing calculated allele frequency for the allele
-    in this specific sample.
+    Filter out variants which are common in any of the exac or other
+    population datasets as specified in the pipeline.ini.
+
+    Variants are common if both called alleles have a frequency of at
+    least *thresh* in any population. The table is read once in chunks
+    of *chunk_size* variants, see :func:`getRarityFrequencies`. The
+    frequencies of the called alleles are added to the output as
+    ``xxx_calc`` columns.
     '''
-    x = 0
+    exac_suffs = exac.split(",")
+    fcols = freqs.split(",")
+    thresh = float(thresh)
+    newcols = ["%s_calc" % c for c in exac_suffs + fcols]
+
     out = IOTools.openFile(outfiles[0], "w")
     out2 = IOTools.openFile(outfiles[1], "w")
 
-    exaccols = list(exacdict.keys())
-    othercols = list(otherdict.keys())
-
-    # column names for the new columns
-    exacnewcols = ["%s_calc" % c for c in exaccols]
-    othernewcols = ["%s_calc" % c for c in othercols]
-
-    with IOTools.openFile(infile) as infile:
-        for line in infile:
-            line = line.strip()
-            if x <= 1:
-                # write the column names
-                out.write("%s\t%s\t%s\n" % (line, "\t".join(exacnewcols),
-                                            "\t".join(othernewcols)))
-            else:
-                freqs = []
-                for key in exaccols:
-                    col = exacdict[key]
-                    freqs.append(col[x])
-                for key in othercols:
-                    col = otherdict[key]
-                    freqs.append(col[x])
-                freqs = [str(freq) for freq in freqs]
-
-                if x not in exacinds and x not in otherinds:
-                    out.write("%s\t%s\n" % (line, "\t".join(freqs)))
+    with IOTools.openFile(infile) as inf:
+        # the first two lines are headers
+        header = [inf.readline().strip() for x in range(2)]
+        columns = header[0].split("\t")
+        for line in header:
+            out.write("%s\t%s\n" % (line, "\t".join(newcols)))
+
+        while True:
+            lines = [line.strip() for line in
+                     itertools.islice(inf, chunk_size)]
+            if not lines:
+                break
+            fields = [line.split("\t") for line in lines]
+            afs = getRarityFrequencies(fields, columns, exac_suffs, fcols)
+            common = ((afs >= thresh).all(axis=2)).any(axis=1)
+            for line, af, is_common in zip(lines, afs.tolist(), common):
+                af = "\t".join(["(%r, %r)" % tuple(x) for x in af])
+                if is_common:
+                    out2.write("%s\t%s\n" % (line, af))
                 else:
-                    out2.write("%s\t%s\n" % (line, "\t".join(freqs)))
-            x += 1
+                    out.write("%s\t%s\n" % (line, af))
+
     out.close()
     out2.close()
 
 
-@cluster_runnable
-def filterRarity(infile, exac, freqs, thresh, outfiles):
-    '''
-    Filter out variants which are common in any of the exac or other
-    population datasets as specified in the pipeline.ini.
-    '''
-    exacdict, exacinds = FilterExacCols(infile, exac, thresh)
-    otherdict, otherinds = FilterFreqCols(infile, thresh, freqs)
-    WriteFreqFiltered(infile, exacdict, exacinds, otherdict,
-                      otherinds, outfiles)
-
-
 @cluster_runnable
 def filterDamage(infile, damagestr, outfiles):
     '''
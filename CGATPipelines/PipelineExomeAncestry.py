@@ -4,8 +4,6 @@ import CGAT.IOTools as IOTools
 import random
 import itertools
 from CGATPipelines.Pipeline import cluster_runnable
-import json
-import decimal
 from sklearn.cluster import KMeans
 import matplotlib
 import matplotlib.pyplot as plt
@@ -13,6 +11,15 @@ import matplotlib.cm as cm
 import matplotlib.patches as mpatches
 
 
+# all possible genotypes as list of strings (e.g. CC CT CG CA TT etc).
+# The order defines the last axis of the genotype frequency store.
+GENOTYPES = ["%s%s" % (g[0], g[1])
+             for g in itertools.permutations("CGAT", 2)] + \
+    ['CC', 'GG', 'TT', 'AA']
+
+GENOTYPE2INDEX = dict((g, x) for x, g in enumerate(GENOTYPES))
+
+
 @cluster_runnable
 def MakeSNPFreqDict(infiles, outfiles, rs):
     '''
@@ -22,19 +29,17 @@ def MakeSNPFreqDict(infiles, outfiles, rs):
     1. Finds all SNPs which have a known genotype frequency for all 11
        hapmap ancestries
     2. Picks a random 50000 of these SNPs
-    3. Stores a list of these SNPs as randomsnps.tsv
-    4. Builds a dictionary of dictionaries of dictionaries where:
-           At Level 1 each key is a HapMap ancestry ID
-               each of these keys leads to another dictionary - level 2.
-           At Level 2 each key is a dbSNP SNP ID
-               each of these keys leads to another dictionary - level 3.
-           At Level 3 each key is a genotype:
-               the values of these keys are the genotype frequency of this
-               genotype at this SNP in this ancestry.
-       e.g. snpdict['ASW']['rs000000001']['CT'] -->
+    3. Stores a list of these SNPs as randomsnps.tsv. The line number
+       of a SNP is its index in the frequency store.
+    4. Stores the list of HapMap ancestry IDs in ancestries.tsv.
+    5. Builds a SNP x ancestry x genotype matrix of genotype frequencies,
+       e.g. freqs[snp2index['rs000000001'], anc2index['ASW'],
+                   GENOTYPE2INDEX['CT']] -->
             frequency of the CT genotype at the rs0000001 SNP in the
             ASW population
-    5.  Stores this dictionary in json format as randomsnps.json
+       Genotypes are ordered as in :data:`GENOTYPES`.
+    6. Stores this matrix in numpy format as snpfreqs.npy so that it
+       can be memory-mapped later.
     '''
 
     # list all chromosomes
@@ -50,13 +55,8 @@ def MakeSNPFreqDict(infiles, outfiles, rs):
         # make a set of all the snp ids of known frequency for
         # this chromsome for each ancestry
         for f in thischrom:
-            snpids = []
-            anc = f.split("/")[-1].split("_")[3]
             with IOTools.openFile(f) as inp:
-                for line in inp:
-                    line = line.strip().split(" ")
-                    snpids.append(line[0])
-            snpids = set(snpids)
+                snpids = set([line.split(" ", 1)[0] for line in inp])
             snpidsets.append(snpids)
         # find the snp ids where frequency is known in all ancestries
         thischromsnps = set.intersection(*snpidsets)
@@ -67,59 +67,41 @@ def MakeSNPFreqDict(infiles, outfiles, rs):
     pooled = set.union(*vals)
     # take a random sample of snps from this set
     random.seed(rs)
-    sam = set(random.sample(pooled, 50000))
-
-    # make a new dictionary of just the sampled snps for each chrom
-    snpdictsam = dict()
-    for key in snpdict:
-        i = snpdict[key] & sam
-        snpdictsam[key] = i
-
-    # generate all possible genotypes as list of strings
-    # (e.g. CC CT CG CA TT etc)
-    res = ["%s%s" % (g[0], g[1])
-           for g in itertools.permutations("CGAT", 2)]
-    res += ['CC', 'GG', 'TT', 'AA']
-    freqdict = dict()
-    ancs = set([l.split("/")[-1].split("_")[3] for l in infiles])
-
-    # build an empty dictionary of dictionaries of dictionaries
-    # to store genotype freqs for each ancestry
-    for anc in ancs:
-        freqdict.setdefault(anc, dict())
-        for s in sam:
-            freqdict[anc].setdefault(s, dict())
-            for r in res:
-                freqdict[anc][s][r] = 0.0
+    sam = sorted(random.sample(sorted(pooled), 50000))
+    snp2index = dict((snp, x) for x, snp in enumerate(sam))
 
-    # read genotype freqs from the input file and store in the dictionary
+    ancs = sorted(set([l.split("/")[-1].split("_")[3] for l in infiles]))
+    anc2index = dict((anc, x) for x, anc in enumerate(ancs))
+
+    # frequencies of genotypes not listed for a SNP remain 0
+    freqs = np.zeros((len(sam), len(ancs), len(GENOTYPES)),
+                     dtype=np.float32)
+
+    # read genotype freqs from the input file and store in the matrix
     for f in infiles:
         bits = f.split("/")[-1].split("_")
-        anc = bits[3]
-        chrom = bits[2]
-        snpset = snpdictsam[chrom]
+        anc = anc2index[bits[3]]
         with IOTools.openFile(f) as input:
             for line in input:
                 line = line.strip().split(" ")
-                if line[0] in snpset:
-                    G1 = "%s%s" % (line[10][0], line[10][-1])
-                    try:
-                        F1 = float(line[11])
-                        G2 = "%s%s" % (line[13][0], line[13][-1])
-                        F2 = float(line[14])
-                        G3 = "%s%s" % (line[16][0], line[16][-1])
-                        F3 = float(line[17])
-                    except:
-                        # because occasionally the GFs are not numeric
-                        continue
-                    freqdict[anc][line[0]][G1] = F1
-                    freqdict[anc][line[0]][G2] = F2
-                    freqdict[anc][line[0]][G3] = F3
-
-    # dump dictionary in a json file to resurrect later
-    outf = IOTools.openFile(outfiles[0], "w")
-    json.dump(freqdict, outf)
-    outf.close()
+                snp = snp2index.get(line[0], None)
+                if snp is None:
+                    continue
+                G1 = "%s%s" % (line[10][0], line[10][-1])
+                try:
+                    F1 = float(line[11])
+                    G2 = "%s%s" % (line[13][0], line[13][-1])
+                    F2 = float(line[14])
+                    G3 = "%s%s" % (line[16][0], line[16][-1])
+                    F3 = float(line[17])
+                except:
+                    # because occasionally the GFs are not numeric
+                    continue
+                freqs[snp, anc, GENOTYPE2INDEX[G1]] = F1
+                freqs[snp, anc, GENOTYPE2INDEX[G2]] = F2
+                freqs[snp, anc, GENOTYPE2INDEX[G3]] = F3
+
+    np.save(outfiles[0], freqs)
 
     # store the sampled list of snps
     out = IOTools.openFile(outfiles[1], "w")
@@ -127,6 +109,48 @@ def MakeSNPFreqDict(infiles, outfiles, rs):
         out.write("%s\n" % snp)
     out.close()
 
+    # store the list of ancestries
+    out = IOTools.openFile(outfiles[2], "w")
+    for anc in ancs:
+        out.write("%s\n" % anc)
+    out.close()
+
+
+def loadSNPFreqs(infiles):
+    '''load the genotype frequency store built by :func:`MakeSNPFreqDict`.
+
+    Arguments
+    ---------
+    infiles : list
+        Filenames of the frequency matrix, the SNP list and the
+        ancestry list.
+
+    Returns
+    -------
+    freqs : numpy.memmap
+        Memory-mapped SNP x ancestry x genotype frequency matrix.
+    snp2index : dict
+        Map of SNP IDs to rows in `freqs`.
+    ancs : list
+        HapMap ancestry IDs in the order of the second axis of `freqs`.
+    '''
+    freqs = np.load(infiles[0], mmap_mode="r")
+    with IOTools.openFile(infiles[1]) as inf:
+        snp2index = dict((line.strip(), x) for x, line in enumerate(inf))
+    with IOTools.openFile(infiles[2]) as inf:
+        ancs = [line.strip() for line in inf]
+    return freqs, snp2index, ancs
+
+
+def formatLog10(value):
+    '''format a log10 transformed value in scientific notation.
+
+    This permits writing numbers outside the range of floating
+    point numbers, e.g. 2.5E-1000.
+    '''
+    exponent = int(np.floor(value))
+    return "%.6fE%i" % (10 ** (value - exponent), exponent)
+
 
 @cluster_runnable
 def GenotypeSNPs(infile, snplist, outfile):
@@ -182,7 +206,7 @@ def GenotypeSNPs(infile, snplist, outfile):
 
 
 @cluster_runnable
-def CalculateAncestry(infile, calledsnps, snpdict, outfiles):
+def CalculateAncestry(infile, calledsnps, snpfreqs, outfiles):
     '''
     Takes the data stored in MakeRandomSNPSet and the genotype of each sample
     at each site in calledsnps.tsv and tabulates the frequency of this
@@ -190,67 +214,64 @@ def CalculateAncestry(infile, calledsnps, snpdict, outfiles):
     The overall probability of each ancestry is then calculated as the
     product of these frequencies. These can only be used in comparison to
     each other - to show which of the 11 ancestries is most probable.
+
+    The genotype frequencies are looked up for all SNPs and ancestries at
+    once in the memory-mapped store (see :func:`loadSNPFreqs`) and the
+    product is computed as a sum of log-frequencies.
     '''
 
     # List the SNPs in the sample where a variant has been called
     # Record the reference genotype at each of these SNPs
-    called = set()
+    # SNPs are output in the order of calledsnps so that all samples
+    # are consistent.
+    called = []
     refs = dict()
-    for line in IOTools.openFile(calledsnps).readlines():
+    for line in IOTools.openFile(calledsnps):
         line = line.strip().split("\t")
         refs[line[0]] = line[1]
-        called.add(line[0])
+        called.append(line[0])
 
     # Record the genotype of the current sample at each SNP
     currents = dict()
-    for line in IOTools.openFile(infile).readlines():
+    for line in IOTools.openFile(infile):
         line = line.strip().split("\t")
         currents[line[0]] = line[3]
 
-    # Regenerate the genotype frequency dictionary made earlier
-    s = IOTools.openFile(snpdict)
-    snpdict = json.load(s)
-    s.close()
-    ancs = list(snpdict.keys())
+    freqs, snp2index, ancs = loadSNPFreqs(snpfreqs)
+
+    # where a variant hasn't been called in the current sample assume
+    # the reference genotype
+    genos = [currents.get(snp, refs[snp]) for snp in called]
+
+    # genotypes not recorded in hapmap get a frequency of 0
+    rows = np.array([snp2index[snp] for snp in called], dtype=np.int64)
+    cols = np.array([GENOTYPE2INDEX.get(geno, -1) for geno in genos],
+                    dtype=np.int64)
+    table = np.array(freqs[rows, :, cols])
+    table[cols == -1] = 0
 
     # Build a table of the frequency of the genotype in this sample
     # in each of the hapmap ancestries
     out = IOTools.openFile(outfiles[0], "w")
     out.write("snp\tgenotype\t%s\n" % "\t".join(ancs))
-    for snp in called:
-        # where a variant hasn't been called in the current sample assume
-        # the reference genotype
-        if snp in currents:
-            geno = currents[snp]
-        else:
-            geno = refs[snp]
-
-        res = []
-        for anc in ancs:
-            D = snpdict[anc]
-            sub = D[snp]
-            freq = sub[geno]
-            res.append(freq)
-
-        res = [str(r) for r in res]
-        out.write("%s\t%s\t%s\n" % (snp, geno, "\t".join(res)))
-
+    for snp, geno, res in zip(called, genos, table):
+        out.write("%s\t%s\t%s\n" % (
+            snp, geno, "\t".join(["%g" % r for r in res])))
     out.close()
-    out = IOTools.openFile(outfiles[1], "w")
-
-    # read the output of the previous step into pandas
-    res = pd.read_csv(outfiles[0], sep="\t")
 
     # calculate the probability of each ancestry as the product of all the
     # genotype frequencies
     # SNPs where a genotype not recorded in hapmap has been called are
     # skipped
-    # decimal package is used because the results are very small floats
-    res = res.replace(0, float('nan'))
-    for anc in set(ancs):
-        r = res[anc][np.invert(res[anc].isnull())]
-        r = [decimal.Decimal(d) for d in r]
-        out.write("%s\t%s\n" % (anc, np.product(r)))
+    # the product is computed in log space because the results are very
+    # small floats
+    with np.errstate(divide="ignore"):
+        logfreqs = np.where(table > 0, np.log10(table), 0)
+    scores = logfreqs.sum(axis=0, dtype=np.float64)
+
+    out = IOTools.openFile(outfiles[1], "w")
+    for anc, score in zip(ancs, scores):
+        out.write("%s\t%s\n" % (anc, formatLog10(score)))
     out.close()
 
 
@@ -448,7 +448,9 @@ class SequenceCollectionProcessor(object):
     tmpdir_fastq : string
         Directory with the locations of temporary :term:`fastq`
         formatted files. This directory can be used as a general
-        temporary directory by a mapper.
+        temporary directory by a mapper. If ``scratch_fastq`` is set,
+        this is a directory on the node-local disk that only exists
+        while the statement is running.
     """
 
     # compress temporary fastq files with gzip
@@ -511,7 +513,12 @@ class SequenceCollectionProcessor(object):
 
         assert len(infiles) > 0, "no input files for processing"
 
-        tmpdir_fastq = P.getTempDir(shared=True)
+        if P.PARAMS.get("scratch_fastq", False):
+            # node-local scratch directory, created when the
+            # statement is run
+            tmpdir_fastq = P.getScratchDir("fastq")
+        else:
+            tmpdir_fastq = P.getTempDir(shared=True)
 
         # create temporary directory again for nodes
         statement = ["mkdir -p %s" % tmpdir_fastq]
@@ -609,7 +616,8 @@ class SequenceCollectionProcessor(object):
                     new_files = files
 
                 out_base = os.path.basename(os.path.splitext(outfile)[0])
-                new_files = [re.sub(r"%s/(.+).(fastq..*gz)" % tmpdir_fastq,
+                new_files = [re.sub(r"%s/(.+).(fastq..*gz)" %
+                                    re.escape(tmpdir_fastq),
                                     r"%s/%s_\1.\2" % (tmpdir_fastq, out_base),
                                     nf) for nf in new_files]
 
@@ -8,12 +8,21 @@ Reference
 """
 
 import CGAT.Experiment as E
+import collections
+import math
+import multiprocessing
 import os
 import re
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
 import CGAT.IOTools as IOTools
 import CGAT.BamTools as BamTools
 import CGATPipelines.Pipeline as P
+from CGATPipelines.Pipeline import cluster_runnable
+import numpy as np
 import pandas as pd
+import pysam
 
 PICARD_MEMORY = "5G"
 
@@ -793,3 +802,689 @@ def loadIdxstats(infiles, outfile):
            outfile,
            options="--ignore-empty --add-index=track")
     os.unlink(outf.name)
+
+
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+RTREE_MAGIC = 0x2468ACE0
+
+
+def _readBigWigHeader(inf):
+    '''read the header of a :term:`bigwig` file.
+
+    Returns the byte order, the header fields and the list of
+    zoom level headers.
+    '''
+    data = inf.read(64)
+    if struct.unpack("<I", data[:4])[0] == BIGWIG_MAGIC:
+        byteorder = "<"
+    elif struct.unpack(">I", data[:4])[0] == BIGWIG_MAGIC:
+        byteorder = ">"
+    else:
+        raise ValueError("%s is not a bigwig file" % inf.name)
+
+    header = dict(zip(
+        ("magic", "version", "zoomLevels", "chromTreeOffset",
+         "fullDataOffset", "fullIndexOffset", "fieldCount",
+         "definedFieldCount", "autoSqlOffset", "totalSummaryOffset",
+         "uncompressBufSize", "reserved"),
+        struct.unpack(byteorder + "IHHQQQHHQQIQ", data)))
+
+    zoom_levels = [
+        struct.unpack(byteorder + "IIQQ", inf.read(24))
+        for x in range(header["zoomLevels"])]
+
+    return byteorder, header, zoom_levels
+
+
+def _readBigWigContigs(inf, byteorder, offset):
+    '''read the contig B+ tree of a :term:`bigwig` file.
+
+    Returns a list of tuples (contig, contig_id, size).
+    '''
+    inf.seek(offset)
+    magic, block_size, key_size, val_size, item_count = struct.unpack(
+        byteorder + "IIIIQ", inf.read(24))
+    if magic != BPT_MAGIC:
+        raise ValueError("invalid contig index in %s" % inf.name)
+
+    contigs = []
+
+    def _readNode(node_offset):
+        inf.seek(node_offset)
+        is_leaf, reserved, count = struct.unpack(
+            byteorder + "BBH", inf.read(4))
+        if is_leaf:
+            for x in range(count):
+                key = inf.read(key_size).rstrip(b"\0").decode("ascii")
+                contig_id, size = struct.unpack(
+                    byteorder + "II", inf.read(8))
+                contigs.append((key, contig_id, size))
+        else:
+            children = []
+            for x in range(count):
+                inf.read(key_size)
+                children.append(
+                    struct.unpack(byteorder + "Q", inf.read(8))[0])
+            for child in children:
+                _readNode(child)
+
+    # skip reserved bytes
+    _readNode(offset + 32)
+    return contigs
+
+
+def _readBigWigBlocks(inf, byteorder, offset):
+    '''return the (offset, size) of all data blocks in the R tree
+    index at *offset* of a :term:`bigwig` file.'''
+    inf.seek(offset)
+    magic = struct.unpack(byteorder + "I", inf.read(4))[0]
+    if magic != RTREE_MAGIC:
+        raise ValueError("invalid data index in %s" % inf.name)
+
+    blocks = []
+
+    def _readNode(node_offset):
+        inf.seek(node_offset)
+        is_leaf, reserved, count = struct.unpack(
+            byteorder + "BBH", inf.read(4))
+        if is_leaf:
+            for x in range(count):
+                blocks.append(struct.unpack(
+                    byteorder + "16xQQ", inf.read(32)))
+        else:
+            children = [struct.unpack(byteorder + "16xQ", inf.read(24))[0]
+                        for x in range(count)]
+            for child in children:
+                _readNode(child)
+
+    # skip index header
+    _readNode(offset + 48)
+    return blocks
+
+
+def readBigWigSummary(infile, contigs=False):
+    '''read summary statistics of a :term:`bigwig` file.
+
+    The header and total summary are read directly from the file
+    without external tools. The fields correspond to the output of
+    ``bigWigInfo``.
+
+    If *contigs* is set, per-contig statistics are computed from the
+    zoom level with the lowest resolution. The full data is not
+    read. If the file has no zoom levels, no per-contig statistics
+    are returned.
+
+    Arguments
+    ---------
+    infile : string
+        Filename in :term:`bigwig` format.
+    contigs : bool
+        Compute per-contig statistics.
+
+    Returns
+    -------
+    summary : OrderedDict
+        Summary statistics.
+    contig_summaries : list
+        List of tuples (contig, size, covered, mean, min, max).
+    '''
+
+    with open(infile, "rb") as inf:
+        byteorder, header, zoom_levels = _readBigWigHeader(inf)
+
+        inf.seek(header["totalSummaryOffset"])
+        covered, min_val, max_val, sum_data, sum_squares = struct.unpack(
+            byteorder + "Qdddd", inf.read(40))
+
+        contig_list = _readBigWigContigs(
+            inf, byteorder, header["chromTreeOffset"])
+
+        if zoom_levels:
+            index_end = zoom_levels[0][2]
+        else:
+            index_end = os.path.getsize(infile)
+
+        if covered > 0:
+            mean = sum_data / covered
+            var = sum_squares - sum_data * sum_data / covered
+            if covered > 1:
+                var /= covered - 1
+            std = math.sqrt(max(0, var))
+        else:
+            mean, std = 0, 0
+
+        summary = collections.OrderedDict((
+            ("version", header["version"]),
+            ("isCompressed",
+             "yes" if header["uncompressBufSize"] > 0 else "no"),
+            ("isSwapped", int(byteorder == ">")),
+            ("primaryDataSize",
+             header["fullIndexOffset"] - header["fullDataOffset"]),
+            ("primaryIndexSize", index_end - header["fullIndexOffset"]),
+            ("zoomLevels", header["zoomLevels"]),
+            ("chromCount", len(contig_list)),
+            ("basesCovered", covered),
+            ("mean", mean),
+            ("min", min_val),
+            ("max", max_val),
+            ("std", std)))
+
+        if not contigs or not zoom_levels:
+            return summary, []
+
+        # the last zoom level has the lowest resolution
+        index_offset = zoom_levels[-1][3]
+        counts = collections.defaultdict(lambda: [0, 0.0, None, None])
+        for offset, size in _readBigWigBlocks(inf, byteorder, index_offset):
+            inf.seek(offset)
+            data = inf.read(size)
+            if header["uncompressBufSize"] > 0:
+                data = zlib.decompress(data)
+            for x in range(0, len(data), 32):
+                contig_id, start, end, valid, min_v, max_v, sum_v, sumsq_v = \
+                    struct.unpack_from(byteorder + "IIIIffff", data, x)
+                c = counts[contig_id]
+                c[0] += valid
+                c[1] += sum_v
+                c[2] = min_v if c[2] is None else min(c[2], min_v)
+                c[3] = max_v if c[3] is None else max(c[3], max_v)
+
+    contig_summaries = []
+    for contig, contig_id, size in contig_list:
+        if contig_id not in counts:
+            contig_summaries.append((contig, size, 0, 0, 0, 0))
+            continue
+        valid, sum_v, min_v, max_v = counts[contig_id]
+        contig_summaries.append(
+            (contig, size, valid,
+             sum_v / valid if valid else 0, min_v, max_v))
+
+    return summary, contig_summaries
+
+
+def _readBigWigSummary(args):
+    '''worker function for :func:`loadBigWigStats`.'''
+    return readBigWigSummary(*args)
+
+
+def loadBigWigStats(infiles, outfile, contigs=False, threads=1):
+    '''summarize :term:`bigwig` files and load into database.
+
+    Summaries are read with :func:`readBigWigSummary` using a pool of
+    *threads* threads. Threads are used as reading summaries is
+    I/O-bound and the function runs within the pipeline process,
+    where ruffus jobs may not start child processes. The summaries are loaded into the table
+    derived from *outfile* with one row per track. If *contigs* is
+    set, per-contig summaries are loaded into the table
+    <table>_per_contig.
+
+    Arguments
+    ---------
+    infiles : list
+        Filenames in :term:`bigwig` format.
+    outfile : string
+        Logfile. The table name will be derived from `outfile`.
+    contigs : bool
+        Load per-contig summaries.
+    threads : int
+        Number of files to read in parallel.
+    '''
+
+    args = [(infile, contigs) for infile in infiles]
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(_readBigWigSummary, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = list(map(_readBigWigSummary, args))
+
+    tracks = [P.snip(os.path.basename(x), ".bw") for x in infiles]
+    tablename = P.toTable(outfile)
+
+    columns = ["track"] + list(results[0][0].keys()) if results else ["track"]
+    tables = [(tablename,
+               columns,
+               [[track] + list(summary.values())
+                for track, (summary, contig_summaries)
+                in zip(tracks, results)],
+               ["track"])]
+
+    if contigs:
+        tables.append((
+            tablename + "_per_contig",
+            ["track", "contig", "size", "covered", "mean", "min", "max"],
+            [(track,) + x
+             for track, (summary, contig_summaries) in zip(tracks, results)
+             for x in contig_summaries],
+            ["track", "contig"]))
+
+    P.loadTables(P.connect(), tables, outfile=outfile)
+
+
+# number of items per data block in bigwig files written by
+# buildBigWigFromBam
+BIGWIG_ITEMS_PER_SLOT = 1024
+# number of children per index node
+BIGWIG_BLOCK_SIZE = 256
+# bin sizes of zoom levels
+BIGWIG_ZOOM_LEVELS = [1000 * 4 ** x for x in range(8)]
+# chunk size for computing the first zoom level
+BIGWIG_CHUNK_SIZE = BIGWIG_ZOOM_LEVELS[0] * 10000
+
+
+def getCoverage(samfile, contig, length, scale=1.0, split=False,
+                extend=0):
+    '''compute read coverage of *contig*.
+
+    Arguments
+    ---------
+    samfile : pysam.AlignmentFile
+        Alignments.
+    contig : string
+        Contig name.
+    length : int
+        Contig length.
+    scale : float
+        Scale factor applied to coverage values.
+    split : bool
+        If True, count only aligned blocks of spliced reads.
+    extend : int
+        If > 0, extend reads to this size in their direction.
+
+    Returns
+    -------
+    coverage : numpy.array
+        float32 array of length *length*.
+
+    The coverage is computed in a single int32 array that is
+    converted to float32 in place, block by block, so memory usage is
+    4 bytes per base.
+    '''
+
+    counts = np.zeros(length + 1, dtype=np.int32)
+    starts, ends = [], []
+    for read in samfile.fetch(contig):
+        if read.is_unmapped:
+            continue
+        if split:
+            for start, end in read.get_blocks():
+                starts.append(start)
+                ends.append(end)
+        elif extend > 0:
+            if read.is_reverse:
+                starts.append(max(0, read.reference_end - extend))
+                ends.append(read.reference_end)
+            else:
+                starts.append(read.reference_start)
+                ends.append(min(length, read.reference_start + extend))
+        else:
+            starts.append(read.reference_start)
+            ends.append(read.reference_end)
+
+        # update counts in batches to bound memory
+        if len(starts) >= 1000000:
+            np.add.at(counts, starts, 1)
+            np.add.at(counts, ends, -1)
+            starts, ends = [], []
+
+    if starts:
+        np.add.at(counts, starts, 1)
+        np.add.at(counts, ends, -1)
+
+    np.cumsum(counts, dtype=np.int32, out=counts)
+    coverage = counts.view(np.float32)
+    for start in range(0, length, BIGWIG_CHUNK_SIZE):
+        end = min(length, start + BIGWIG_CHUNK_SIZE)
+        coverage[start:end] = counts[start:end]
+        if scale != 1.0:
+            coverage[start:end] *= scale
+    return coverage[:length]
+
+
+def _getZoomRecords(coverage, binsize):
+    '''return zoom level summaries of *coverage* in bins of *binsize*.
+
+    Returns an array of bin starts and an array with columns
+    covered bases, min, max, sum and sum of squares. Only positions
+    with non-zero coverage are counted, bins without data are
+    removed.
+    '''
+    records, bin_starts = [], []
+    for chunk_start in range(0, len(coverage), BIGWIG_CHUNK_SIZE):
+        chunk = coverage[chunk_start:chunk_start + BIGWIG_CHUNK_SIZE]
+        starts = np.arange(0, len(chunk), binsize)
+        covered = chunk != 0
+        records.append(np.column_stack((
+            np.add.reduceat(covered, starts).astype(np.float64),
+            np.minimum.reduceat(np.where(covered, chunk, np.inf), starts),
+            np.maximum.reduceat(np.where(covered, chunk, -np.inf), starts),
+            np.add.reduceat(chunk, starts, dtype=np.float64),
+            np.add.reduceat(chunk.astype(np.float64) ** 2, starts))))
+        bin_starts.append(starts + chunk_start)
+
+    records = np.concatenate(records)
+    bin_starts = np.concatenate(bin_starts)
+    keep = records[:, 0] > 0
+    return bin_starts[keep], records[keep]
+
+
+def _mergeZoomRecords(bin_starts, records, binsize):
+    '''merge zoom records into bins of *binsize*.'''
+    bins = bin_starts // binsize
+    new_bins, index = np.unique(bins, return_index=True)
+    return new_bins * binsize, np.column_stack((
+        np.add.reduceat(records[:, 0], index),
+        np.minimum.reduceat(records[:, 1], index),
+        np.maximum.reduceat(records[:, 2], index),
+        np.add.reduceat(records[:, 3], index),
+        np.add.reduceat(records[:, 4], index)))
+
+
+def _buildBigWigBlocks(args):
+    '''compute coverage for a single contig and build compressed
+    bigwig data and zoom blocks.
+
+    Worker function for :func:`buildBigWigFromBam`.
+    '''
+    infile, contig, contig_id, length, scale, split, extend = args
+
+    samfile = pysam.AlignmentFile(infile, "rb")
+    coverage = getCoverage(samfile, contig, length,
+                           scale=scale, split=split, extend=extend)
+    samfile.close()
+
+    # convert to runs of constant coverage, ignoring zero
+    # coverage. Positions are compared in chunks to avoid a
+    # temporary copy of the coverage.
+    changes = [np.array([], dtype=np.int64)]
+    for start in range(0, length - 1, BIGWIG_CHUNK_SIZE):
+        end = min(length, start + BIGWIG_CHUNK_SIZE + 1)
+        changes.append(np.flatnonzero(
+            coverage[start + 1:end] != coverage[start:end - 1]) + start + 1)
+    changes = np.concatenate(changes)
+    starts = np.concatenate(([0], changes)).astype(np.uint32)
+    ends = np.concatenate((changes, [length])).astype(np.uint32)
+    values = coverage[starts]
+    nonzero = values != 0
+    starts, ends, values = starts[nonzero], ends[nonzero], values[nonzero]
+
+    # bedGraph sections
+    data_blocks = []
+    item_type = np.dtype([("start", "<u4"), ("end", "<u4"),
+                          ("value", "<f4")])
+    for x in range(0, len(starts), BIGWIG_ITEMS_PER_SLOT):
+        items = np.empty(min(BIGWIG_ITEMS_PER_SLOT, len(starts) - x),
+                         dtype=item_type)
+        items["start"] = starts[x:x + BIGWIG_ITEMS_PER_SLOT]
+        items["end"] = ends[x:x + BIGWIG_ITEMS_PER_SLOT]
+        items["value"] = values[x:x + BIGWIG_ITEMS_PER_SLOT]
+        block = struct.pack("<IIIIIBBH", contig_id,
+                            int(items["start"][0]), int(items["end"][-1]),
+                            0, 0, 1, 0, len(items)) + items.tobytes()
+        data_blocks.append((int(items["start"][0]), int(items["end"][-1]),
+                            len(block), zlib.compress(block)))
+
+    # summary over all positions with data
+    lengths = (ends - starts).astype(np.float64)
+    if len(values) > 0:
+        summary = (lengths.sum(),
+                   float(values.min()),
+                   float(values.max()),
+                   float((lengths * values).sum()),
+                   float((lengths * values.astype(np.float64) ** 2).sum()))
+    else:
+        summary = (0, None, None, 0, 0)
+
+    # zoom levels
+    zoom_blocks = []
+    zoom_type = np.dtype([("contig", "<u4"), ("start", "<u4"),
+                          ("end", "<u4"), ("valid", "<u4"),
+                          ("min", "<f4"), ("max", "<f4"),
+                          ("sum", "<f4"), ("sumsq", "<f4")])
+    bin_starts, records = None, None
+    for binsize in BIGWIG_ZOOM_LEVELS:
+        if records is None:
+            bin_starts, records = _getZoomRecords(coverage, binsize)
+        else:
+            bin_starts, records = _mergeZoomRecords(
+                bin_starts, records, binsize)
+        blocks = []
+        for x in range(0, len(bin_starts), BIGWIG_ITEMS_PER_SLOT):
+            b = bin_starts[x:x + BIGWIG_ITEMS_PER_SLOT]
+            r = records[x:x + BIGWIG_ITEMS_PER_SLOT]
+            items = np.empty(len(b), dtype=zoom_type)
+            items["contig"] = contig_id
+            items["start"] = b
+            items["end"] = np.minimum(b + binsize, length)
+            items["valid"] = r[:, 0]
+            items["min"] = r[:, 1]
+            items["max"] = r[:, 2]
+            items["sum"] = r[:, 3]
+            items["sumsq"] = r[:, 4]
+            block = items.tobytes()
+            blocks.append((int(items["start"][0]), int(items["end"][-1]),
+                           len(block), len(items), zlib.compress(block)))
+        zoom_blocks.append(blocks)
+
+    return contig_id, data_blocks, zoom_blocks, summary
+
+
+def _writeRTree(outf, blocks, end_offset):
+    '''write an R tree index for *blocks* to *outf*.
+
+    *blocks* is a list of tuples (contig_id, start, end, offset,
+    size) sorted by position.
+    '''
+
+    if blocks:
+        first, last = blocks[0], blocks[-1]
+        bounds = (first[0], first[1], last[0], last[2])
+    else:
+        bounds = (0, 0, 0, 0)
+
+    outf.write(struct.pack("<IIQIIIIQII", RTREE_MAGIC, BIGWIG_BLOCK_SIZE,
+                           len(blocks), bounds[0], bounds[1],
+                           bounds[2], bounds[3], end_offset,
+                           BIGWIG_ITEMS_PER_SLOT, 0))
+
+    # build levels bottom-up, each node is a list of items
+    # (contig_start, start, contig_end, end, payload)
+    items = [(x[0], x[1], x[0], x[2], x[3], x[4]) for x in blocks]
+    levels = [[items[x:x + BIGWIG_BLOCK_SIZE]
+               for x in range(0, len(items), BIGWIG_BLOCK_SIZE)] or [[]]]
+    while len(levels[-1]) > 1:
+        nodes = levels[-1]
+        parents = [(node[0][0], node[0][1], node[-1][2], node[-1][3], x)
+                   for x, node in enumerate(nodes)]
+        levels.append([parents[x:x + BIGWIG_BLOCK_SIZE]
+                       for x in range(0, len(parents), BIGWIG_BLOCK_SIZE)])
+
+    # write top-down, computing the offsets of the next level
+    offset = outf.tell()
+    levels = levels[::-1]
+    for level, nodes in enumerate(levels):
+        is_leaf = level == len(levels) - 1
+        item_size = 32 if is_leaf else 24
+        offset += sum([4 + item_size * len(node) for node in nodes])
+        if not is_leaf:
+            child_item_size = 32 if level + 1 == len(levels) - 1 else 24
+            child_offsets = []
+            child_offset = offset
+            for child in levels[level + 1]:
+                child_offsets.append(child_offset)
+                child_offset += 4 + child_item_size * len(child)
+
+        for node in nodes:
+            outf.write(struct.pack("<BBH", int(is_leaf), 0, len(node)))
+            for item in node:
+                if is_leaf:
+                    outf.write(struct.pack("<IIIIQQ", *item))
+                else:
+                    outf.write(struct.pack("<IIIIQ", item[0], item[1],
+                                           item[2], item[3],
+                                           child_offsets[item[4]]))
+
+
+def _writeContigTree(outf, contigs):
+    '''write the contig B+ tree for *contigs* to *outf*.
+
+    *contigs* is a list of (contig, size) sorted by name. Contig
+    identifiers are the index in this list.
+    '''
+
+    key_size = max([len(x[0]) for x in contigs])
+    block_size = max(1, min(BIGWIG_BLOCK_SIZE, len(contigs)))
+    outf.write(struct.pack("<IIIIQQ", BPT_MAGIC, block_size, key_size, 8,
+                           len(contigs), 0))
+
+    def _key(name):
+        return name.encode("ascii").ljust(key_size, b"\0")
+
+    items = [(_key(name), x, size) for x, (name, size) in enumerate(contigs)]
+    levels = [[items[x:x + block_size]
+               for x in range(0, len(items), block_size)]]
+    while len(levels[-1]) > 1:
+        parents = [(node[0][0], x) for x, node in enumerate(levels[-1])]
+        levels.append([parents[x:x + block_size]
+                       for x in range(0, len(parents), block_size)])
+
+    offset = outf.tell()
+    levels = levels[::-1]
+    item_size = key_size + 8
+    for level, nodes in enumerate(levels):
+        is_leaf = level == len(levels) - 1
+        offset += sum([4 + item_size * len(node) for node in nodes])
+        child_offsets = []
+        child_offset = offset
+        if not is_leaf:
+            for child in levels[level + 1]:
+                child_offsets.append(child_offset)
+                child_offset += 4 + item_size * len(child)
+        for node in nodes:
+            outf.write(struct.pack("<BBH", int(is_leaf), 0, len(node)))
+            for item in node:
+                if is_leaf:
+                    outf.write(item[0] + struct.pack("<II", item[1], item[2]))
+                else:
+                    outf.write(item[0] +
+                               struct.pack("<Q", child_offsets[item[1]]))
+
+
+@cluster_runnable
+def buildBigWigFromBam(infile, outfile, scale=1.0, split=False,
+                       extend=0, threads=1):
+    '''build a :term:`bigwig` file with read coverage from a
+    :term:`bam` file.
+
+    Coverage is computed contig by contig with pysam
+    (:func:`getCoverage`) and written directly as bedGraph sections
+    and zoom levels (:data:`BIGWIG_ZOOM_LEVELS`). Contigs are
+    processed in parallel using *threads* processes. Memory usage is
+    bounded by the coverage of the largest contig(s) being processed
+    and the compressed zoom data.
+
+    Arguments
+    ---------
+    infile : string
+        Input filename in :term:`bam` format. The file needs to
+        be indexed.
+    outfile : string
+        Output filename in :term:`bigwig` format.
+    scale : float
+        Scale factor applied to coverage values.
+    split : bool
+        If True, count only aligned blocks of spliced reads.
+    extend : int
+        If > 0, extend reads to this size in their direction.
+    threads : int
+        Number of contigs to process in parallel.
+    '''
+
+    samfile = pysam.AlignmentFile(infile, "rb")
+    contigs = sorted(zip(samfile.references, samfile.lengths))
+    samfile.close()
+
+    args = [(infile, contig, x, length, scale, split, extend)
+            for x, (contig, length) in enumerate(contigs)]
+
+    nlevels = len(BIGWIG_ZOOM_LEVELS)
+    header_size = 64 + 24 * nlevels
+
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = pool.imap(_buildBigWigBlocks, args)
+    else:
+        pool = None
+        results = map(_buildBigWigBlocks, args)
+
+    data_index = []
+    zoom_blocks = [[] for x in range(nlevels)]
+    total = [0, None, None, 0.0, 0.0]
+    uncompress_buf_size = 0
+
+    outf = open(outfile, "wb")
+    try:
+        # header, zoom headers and total summary are written at the end
+        outf.write(b"\0" * (header_size + 40))
+        chrom_tree_offset = outf.tell()
+        _writeContigTree(outf, contigs)
+
+        full_data_offset = outf.tell()
+        outf.write(struct.pack("<I", 0))
+        for contig_id, data_blocks, zooms, summary in results:
+            for start, end, size, block in data_blocks:
+                data_index.append((contig_id, start, end,
+                                   outf.tell(), len(block)))
+                outf.write(block)
+                uncompress_buf_size = max(uncompress_buf_size, size)
+            for level, blocks in enumerate(zooms):
+                zoom_blocks[level].extend(
+                    [(contig_id,) + x for x in blocks])
+            covered, min_v, max_v, sum_v, sumsq_v = summary
+            if covered:
+                total[0] += covered
+                total[1] = min_v if total[1] is None else min(total[1], min_v)
+                total[2] = max_v if total[2] is None else max(total[2], max_v)
+                total[3] += sum_v
+                total[4] += sumsq_v
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    full_index_offset = outf.tell()
+    _writeRTree(outf, data_index, full_index_offset)
+
+    zoom_headers = []
+    for binsize, blocks in zip(BIGWIG_ZOOM_LEVELS, zoom_blocks):
+        data_offset = outf.tell()
+        outf.write(struct.pack("<I", sum([x[4] for x in blocks])))
+        index = []
+        for contig_id, start, end, size, nitems, block in blocks:
+            index.append((contig_id, start, end, outf.tell(), len(block)))
+            outf.write(block)
+            uncompress_buf_size = max(uncompress_buf_size, size)
+        index_offset = outf.tell()
+        _writeRTree(outf, index, index_offset)
+        zoom_headers.append((binsize, data_offset, index_offset))
+
+    outf.write(struct.pack("<I", BIGWIG_MAGIC))
+
+    # fill in header
+    outf.seek(0)
+    outf.write(struct.pack("<IHHQQQHHQQIQ", BIGWIG_MAGIC, 4, nlevels,
+                           chrom_tree_offset, full_data_offset,
+                           full_index_offset, 0, 0, 0, header_size,
+                           uncompress_buf_size, 0))
+    for binsize, data_offset, index_offset in zoom_headers:
+        outf.write(struct.pack("<IIQQ", binsize, 0,
+                               data_offset, index_offset))
+    outf.write(struct.pack("<Qdddd", int(total[0]), total[1] or 0,
+                           total[2] or 0, total[3], total[4]))
+    outf.seek(full_data_offset)
+    outf.write(struct.pack("<I", len(data_index)))
+    outf.close()
@@ -41,10 +41,13 @@ Code
 '''
 import re
 import os
+import random
+import string
 import tempfile
 import collections
 import shutil
 import glob
+import numpy
 
 import logging as L
 import CGAT.Experiment as E
@@ -85,25 +88,100 @@ def filterMotifsFromMEME(infile, outfile, selected):
     outs.close()
 
 
+# translation table to hard mask soft-masked (lower case) characters
+try:
+    HARDMASK = str.maketrans(string.ascii_lowercase, "N" * 26)
+except AttributeError:
+    HARDMASK = string.maketrans(string.ascii_lowercase, "N" * 26)
+
+# map nucleotides to 0-3, all other characters to 4
+NUCLEOTIDE_CODES = numpy.empty(256, dtype=numpy.int64)
+NUCLEOTIDE_CODES.fill(4)
+for x, c in enumerate("ACGT"):
+    NUCLEOTIDE_CODES[ord(c)] = x
+    NUCLEOTIDE_CODES[ord(c.lower())] = x
+
+
+def dustSequence(sequence, window=64, level=20):
+    '''mask low-complexity regions in *sequence* using a DUST-like
+    triplet score.
+
+    Each window of *window* bases is scored by the counts c_t of the
+    64 possible triplets as sum(c_t * (c_t - 1) / 2) / (l - 1), where l
+    is the number of triplets in the window. All bases in windows with
+    a score above *level* / 10 are replaced by ``N``. This is a
+    simplified fixed-window scheme and does not reproduce the output
+    of dustmasker or sdust.
+
+    The scores for all windows are computed at once from cumulative
+    triplet counts.
+
+    Arguments
+    ---------
+    sequence : string
+        Nucleotide sequence.
+    window : int
+        Window size.
+    level : int
+        Score threshold.
+
+    Returns
+    -------
+    sequence : string
+        Masked sequence.
+    '''
+
+    seq = numpy.frombuffer(sequence.encode("ascii"), dtype=numpy.uint8)
+    codes = NUCLEOTIDE_CODES[seq]
+    ntriplets = len(seq) - 2
+    # number of triplets in a window
+    width = min(window - 2, ntriplets)
+    if width < 2:
+        return sequence
+
+    # triplets containing other characters than ACGT are not counted
+    triplets = codes[:-2] * 16 + codes[1:-1] * 4 + codes[2:]
+    triplets[(codes[:-2] == 4) | (codes[1:-1] == 4) | (codes[2:] == 4)] = 64
+
+    counts = numpy.zeros((ntriplets + 1, 65), dtype=numpy.int32)
+    counts[numpy.arange(1, ntriplets + 1), triplets] = 1
+    numpy.cumsum(counts, axis=0, out=counts)
+    counts = (counts[width:] - counts[:-width])[:, :64]
+
+    scores = (counts * (counts - 1) // 2).sum(axis=1)
+    masked_windows = numpy.flatnonzero(10 * scores > level * (width - 1))
+    if len(masked_windows) == 0:
+        return sequence
+
+    # mark all bases in masked windows
+    mask = numpy.zeros(len(seq) + 1, dtype=numpy.int32)
+    numpy.add.at(mask, masked_windows, 1)
+    numpy.add.at(mask, masked_windows + width + 2, -1)
+    mask = numpy.cumsum(mask[:-1]) > 0
+
+    seq = seq.copy()
+    seq[mask] = ord("N")
+    return seq.tobytes().decode("ascii")
+
+
 def maskSequences(sequences, masker=None):
     '''return a list of masked sequence.
 
     *masker* can be one of
-        dust/dustmasker * run dustmasker on sequences
+        dust            * mask low complexity regions with
+                          :func:`dustSequence`
+        dustmasker      * run dustmasker on sequences
         softmask        * use softmask to hardmask sequences
     '''
 
-    if masker in ("dust", "dustmasker"):
-        masker_object = Masker.MaskerDustMasker()
-    else:
-        masker_object = None
-
     if masker == "softmask":
         # the genome sequence is repeat soft-masked
         masked_seq = sequences
-    elif masker in ("dust", "dustmasker"):
-        # run dust
-        masked_seq = masker_object.maskSequences(
+    elif masker == "dust":
+        masked_seq = [dustSequence(x.upper()) for x in sequences]
+    elif masker == "dustmasker":
+        # run dustmasker
+        masked_seq = Masker.MaskerDustMasker().maskSequences(
             [x.upper() for x in sequences])
     elif masker is None:
         masked_seq = [x.upper() for x in sequences]
@@ -111,11 +189,67 @@ def maskSequences(sequences, masker=None):
         raise ValueError("unknown masker %s" % masker)
 
     # hard mask softmasked characters
-    masked_seq = [re.sub("[a-z]", "N", x) for x in masked_seq]
+    masked_seq = [x.translate(HARDMASK) for x in masked_seq]
 
     return masked_seq
 
 
+def fetchSequences(fasta, regions, max_gap=10000, max_span=10000000):
+    '''return the sequences of genomic *regions*.
+
+    Regions are sorted by contig and start coordinate and regions that
+    are less than *max_gap* apart are fetched with a single read from
+    *fasta*.
+
+    Arguments
+    ---------
+    fasta : IndexedFasta
+        The genome.
+    regions : list
+        List of tuples (contig, start, end).
+    max_gap : int
+        Maximum gap between regions read together.
+    max_span : int
+        Maximum size of a single read.
+
+    Returns
+    -------
+    sequences : list
+        The sequences in the order of *regions*.
+    '''
+
+    sequences = [None] * len(regions)
+    order = sorted(range(len(regions)),
+                   key=lambda x: (regions[x][0], regions[x][1]))
+
+    def _fetch(block):
+        contig = regions[block[0]][0]
+        block_start = min([regions[x][1] for x in block])
+        block_end = max([regions[x][2] for x in block])
+        seq = fasta.getSequence(contig, "+", block_start, block_end)
+        for x in block:
+            contig, start, end = regions[x][:3]
+            sequences[x] = seq[start - block_start:end - block_start]
+
+    block, block_start, block_end = [], None, None
+    for x in order:
+        contig, start, end = regions[x][:3]
+        if block and (contig != regions[block[0]][0] or
+                      start > block_end + max_gap or
+                      end - block_start > max_span):
+            _fetch(block)
+            block = []
+        if not block:
+            block_start, block_end = start, end
+        block.append(x)
+        block_end = max(block_end, end)
+
+    if block:
+        _fetch(block)
+
+    return sequences
+
+
 def exportSequencesFromBedFile(infile, outfile, masker=None, mode="intervals"):
     '''export sequences for intervals in :term:`bed`-formatted *infile* 
     to :term:`fasta` formatted *outfile*
@@ -173,10 +307,9 @@ def writeSequencesForIntervals(track,
     the table <track>_intervals in the database *dbhandle* and save to
     *filename* in :term:`fasta` format.
 
-    If num_shuffles is set, shuffled copies are created as well with
-    the shuffled number appended to the filename.
+    If *shuffled* is set, the sequences are shuffled.
 
-    The sequences are masked before shuffling (is this appropriate?)
+    The sequences are masked after shuffling.
 
     If *full* is set, the whole intervals will be output, otherwise
     only the region around the peak given by *halfwidth*
@@ -190,7 +323,8 @@ def writeSequencesForIntervals(track,
     If *num_sequences* is set, the first *num_sequences* will be used.
 
     *masker* can be a combination of
-        * dust, dustmasker: apply dustmasker
+        * dust: apply :func:`dustSequence`
+        * dustmasker: apply dustmasker
         * softmask: mask softmasked genomic regions
 
     *order* is the order by which peaks should be sorted. Possible
@@ -202,10 +336,78 @@ def writeSequencesForIntervals(track,
     interval. The intervals will be centered around the mid-point and
     truncated the same way as the main intervals.
 
+    To build several of these sets at once, use
+    :func:`writeSequenceSetsForIntervals`.
     '''
 
-    fasta = IndexedFasta.IndexedFasta(
-        os.path.join(PARAMS["genome_dir"], PARAMS["genome"]))
+    if shift:
+        if shift != "leftright":
+            raise ValueError("unknown shift %s" % shift)
+        if shuffled:
+            raise ValueError("shuffling of shifted intervals not supported")
+        sequence_set = "leftright"
+    elif shuffled:
+        sequence_set = "shuffled"
+    else:
+        sequence_set = "foreground"
+
+    return writeSequenceSetsForIntervals(
+        track,
+        {sequence_set: filename},
+        dbhandle,
+        full=full,
+        halfwidth=halfwidth,
+        maxsize=maxsize,
+        proportion=proportion,
+        masker=masker,
+        offset=offset,
+        num_sequences=num_sequences,
+        min_sequences=min_sequences,
+        order=order)[sequence_set]
+
+
+def writeSequenceSetsForIntervals(track,
+                                  filenames,
+                                  dbhandle,
+                                  full=False,
+                                  halfwidth=None,
+                                  maxsize=None,
+                                  proportion=None,
+                                  masker=[],
+                                  offset=0,
+                                  num_sequences=None,
+                                  min_sequences=None,
+                                  order="peakval"):
+    '''build several sequence sets for motif discovery in one pass.
+
+    Intervals are taken from the table <track>_intervals in the
+    database *dbhandle*. *filenames* is a dictionary mapping the
+    sequence sets to build to output filenames. Possible sets are:
+
+    foreground
+        the intervals
+    shuffled
+        the intervals with shuffled sequences
+    leftright
+        intervals of the same size on the left and right of each
+        interval
+
+    The sequences for all sets are read together with
+    :func:`fetchSequences`. See :func:`writeSequencesForIntervals`
+    for the other arguments.
+
+    Returns
+    -------
+    counts : dict
+        The number of sequences written for each set.
+    '''
+
+    for sequence_set in filenames:
+        if sequence_set not in ("foreground", "shuffled", "leftright"):
+            raise ValueError("unknown sequence set %s" % sequence_set)
+
+    if masker is None or isinstance(masker, str):
+        masker = [masker]
 
     cc = dbhandle.cursor()
 
@@ -218,8 +420,8 @@ def writeSequencesForIntervals(track,
             "Unknown value passed as order parameter, check your ini file")
 
     tablename = "%s_intervals" % P.tablequote(track)
-    statement = '''SELECT contig, start, end, interval_id, peakcenter 
-                       FROM %(tablename)s 
+    statement = '''SELECT contig, start, end, interval_id, peakcenter
+                       FROM %(tablename)s
                        ''' % locals() + orderby
 
     cc.execute(statement)
@@ -244,77 +446,98 @@ def writeSequencesForIntervals(track,
     fasta = IndexedFasta.IndexedFasta(
         os.path.join(PARAMS["genome_dir"], PARAMS["genome"]))
 
-    # modify the ranges
-    if shift:
-        if shift == "leftright":
-            new_data = [(contig, start - (end - start), start, str(interval_id) + "_left", peakcenter)
-                        for contig, start, end, interval_id, peakcenter in data]
-            new_data.extend([(contig, end, end + (end - start), str(interval_id) + "_right", peakcenter)
-                             for contig, start, end, interval_id, peakcenter in data])
-        data = new_data
-
-    if halfwidth:
-        # center around peakcenter, add halfwidth on either side
-        data = [(contig, peakcenter - halfwidth, peakcenter + halfwidth, interval_id)
-                for contig, start, end, interval_id, peakcenter in data]
-    else:
-        # remove peakcenter
-        data = [(contig, start, end, interval_id)
-                for contig, start, end, interval_id, peakcenter in data]
-
-    # get the sequences - cut at number of nucleotides
-    sequences = []
-    current_size, nseq = 0, 0
-    new_data = []
-    for contig, start, end, interval_id in data:
-        lcontig = fasta.getLength(contig)
-        start, end = max(0, start + offset), min(end + offset, lcontig)
-        if start >= end:
-            L.info("writeSequencesForIntervals %s: sequence %s is empty: start=%i, end=%i, offset=%i - ignored" %
-                   (track, id, start, end, offset))
-            continue
-        seq = fasta.getSequence(contig, "+", start, end)
-        sequences.append(seq)
-        new_data.append((start, end, interval_id, contig))
-        current_size += len(seq)
-        if maxsize and current_size >= maxsize:
-            L.info("writeSequencesForIntervals %s: maximum size (%i) reached - only %i sequences output (%i ignored)" %
-                   (track, maxsize, nseq, len(data) - nseq))
-            break
-        nseq += 1
-
-    data = new_data
-
-    if shuffled:
-        # note that shuffling is done on the unmasked sequences
-        # Otherwise N's would be interspersed with real sequence
-        # messing up motif finding unfairly. Instead, masking is
-        # done on the shuffled sequence.
-        sequences = [list(x) for x in sequences]
-        for sequence in sequences:
-            random.shuffle(sequence)
-        sequences = maskSequences(["".join(x) for x in sequences], masker)
-
-    c = E.Counter()
-    outs = IOTools.openFile(filename, "w")
-    for masker in masker:
-        if masker not in ("unmasked", "none", None):
-            sequences = maskSequences(sequences, masker)
-
-    for sequence, d in zip(sequences, data):
-        c.input += 1
-        if len(sequence) == 0:
-            c.empty += 1
-            continue
-        start, end, id, contig = d
-        id = "%s_%s %s:%i-%i" % (track, str(id), contig, start, end)
-        outs.write(">%s\n%s\n" % (id, sequence))
-        c.output += 1
-    outs.close()
+    def _buildRegions(data):
+        if halfwidth:
+            # center around peakcenter, add halfwidth on either side
+            data = [(contig, peakcenter - halfwidth, peakcenter + halfwidth,
+                     interval_id)
+                    for contig, start, end, interval_id, peakcenter in data]
+        else:
+            # remove peakcenter
+            data = [(contig, start, end, interval_id)
+                    for contig, start, end, interval_id, peakcenter in data]
+
+        # cut at number of nucleotides
+        regions = []
+        current_size = 0
+        for contig, start, end, interval_id in data:
+            lcontig = fasta.getLength(contig)
+            start, end = max(0, start + offset), min(end + offset, lcontig)
+            if start >= end:
+                L.info("writeSequencesForIntervals %s: sequence %s is empty: start=%i, end=%i, offset=%i - ignored" %
+                       (track, interval_id, start, end, offset))
+                continue
+            regions.append((contig, start, end, interval_id))
+            current_size += end - start
+            if maxsize and current_size >= maxsize:
+                L.info("writeSequencesForIntervals %s: maximum size (%i) reached - only %i sequences output (%i ignored)" %
+                       (track, maxsize, len(regions), len(data) - len(regions)))
+                break
+        return regions
+
+    regions = {}
+    if "foreground" in filenames or "shuffled" in filenames:
+        regions["foreground"] = _buildRegions(data)
+    if "leftright" in filenames:
+        # shift intervals and their peak centers by the interval size
+        shifted = [(contig, start - (end - start), start,
+                    str(interval_id) + "_left", peakcenter - (end - start))
+                   for contig, start, end, interval_id, peakcenter in data]
+        shifted.extend([(contig, end, end + (end - start),
+                         str(interval_id) + "_right",
+                         peakcenter + (end - start))
+                        for contig, start, end, interval_id, peakcenter
+                        in data])
+        regions["leftright"] = _buildRegions(shifted)
+
+    # fetch sequences for all sets together
+    all_regions = sum(list(regions.values()), [])
+    all_sequences = fetchSequences(fasta, all_regions)
+    sequences, x = {}, 0
+    for key, value in regions.items():
+        sequences[key] = all_sequences[x:x + len(value)]
+        x += len(value)
+
+    counts = {}
+    for sequence_set, filename in filenames.items():
+
+        if sequence_set == "leftright":
+            key = "leftright"
+        else:
+            key = "foreground"
+        seqs = sequences[key]
+
+        if sequence_set == "shuffled":
+            # note that shuffling is done on the unmasked sequences
+            # Otherwise N's would be interspersed with real sequence
+            # messing up motif finding unfairly. Instead, masking is
+            # done on the shuffled sequence.
+            seqs = [list(x) for x in seqs]
+            for sequence in seqs:
+                random.shuffle(sequence)
+            seqs = ["".join(x) for x in seqs]
+
+        for m in masker:
+            if m not in ("unmasked", "none", None):
+                seqs = maskSequences(seqs, m)
+
+        c = E.Counter()
+        outs = IOTools.openFile(filename, "w")
+        for sequence, d in zip(seqs, regions[key]):
+            c.input += 1
+            if len(sequence) == 0:
+                c.empty += 1
+                continue
+            contig, start, end, id = d
+            id = "%s_%s %s:%i-%i" % (track, str(id), contig, start, end)
+            outs.write(">%s\n%s\n" % (id, sequence))
+            c.output += 1
+        outs.close()
 
-    E.info("%s" % c)
+        E.info("%s: %s" % (sequence_set, c))
+        counts[sequence_set] = c.output
 
-    return c.output
+    return counts
 
 
 def runRegexMotifSearch(infiles, outfile):
@@ -492,50 +715,97 @@ def loadGLAM2SCAN(infile, outfile):
     os.unlink(tmpfile.name)
 
 
-def loadMAST(infile, outfile):
-    '''parse mast file and load into database.
-
-    Parse several motif runs and add them to the same
-    table.
+class MASTChunk(object):
+    '''file-like view of a single chunk in a MAST output file.
 
-    Add columns for the control data as well.
+    Lines are read from the underlying stream until the header of the
+    next chunk (a line starting with ``::``), which is kept in
+    :attr:`next_header`.
     '''
 
-    tablename = P.toTable(outfile)
+    def __init__(self, infile):
+        self.infile = infile
+        self.next_header = None
+        self.exhausted = False
 
-    tmpfile = P.getTempFile(".")
+    def __iter__(self):
+        return self
 
-    tmpfile.write(MAST.Match().header +
-                  "\tmotif\tcontig"
-                  "\tl_evalue\tl_pvalue\tl_nmatches\tl_length\tl_start\tl_end"
-                  "\tr_evalue\tr_pvalue\tr_nmatches\tr_length\tr_start\tr_end"
-                  "\tmin_evalue\tmin_pvalue\tmax_nmatches" + "\n")
+    def __next__(self):
+        if self.exhausted:
+            raise StopIteration
+        line = next(self.infile, None)
+        if line is None or line.startswith("::"):
+            self.next_header = line
+            self.exhausted = True
+            raise StopIteration
+        return line
 
-    lines = IOTools.openFile(infile).readlines()
-    chunks = [x for x in range(len(lines)) if lines[x].startswith("::")]
-    chunks.append(len(lines))
+    next = __next__
 
-    def readChunk(lines, chunk):
-        # use real file, as MAST parser can not deal with a
-        # list of lines
-        tmpfile2 = P.getTempFile(".")
+    def readline(self):
+        return next(self, "")
+
+    def readlines(self):
+        return list(self)
+
+    def read(self):
+        return "".join(self)
+
+
+def iterateMASTChunks(infile):
+    '''iterate over chunks in a MAST output file.
+
+    The file contains the concatenated output of several MAST runs,
+    each preceded by a header such as ``:: motif = motif1 - foreground
+    ::``.
+
+    Yields tuples of (motif, part, chunk), where chunk is a file-like
+    :class:`MASTChunk` object. Any lines of a chunk that have not been
+    consumed are skipped when the next chunk is requested.
+    '''
+    header = None
+    for line in infile:
+        if line.startswith("::"):
+            header = line
+            break
+
+    while header is not None:
         try:
             motif, part = re.match(
-                ":: motif = (\S+) - (\S+) ::", lines[chunks[chunk]]).groups()
+                r":: motif = (\S+) - (\S+) ::", header).groups()
         except AttributeError:
             raise ValueError(
-                "parsing error in line '%s'" % lines[chunks[chunk]])
+                "parsing error in line '%s'" % header)
 
-        E.info("reading %s - %s" % (motif, part))
+        chunk = MASTChunk(infile)
+        yield motif, part, chunk
 
-        tmpfile2.write("".join(lines[chunks[chunk] + 1:chunks[chunk + 1]]))
-        tmpfile2.close()
+        for line in chunk:
+            pass
+        header = chunk.next_header
 
-        mast = MAST.parse(IOTools.openFile(tmpfile2.name, "r"))
 
-        os.unlink(tmpfile2.name)
+def loadMAST(infile, outfile, batch_size=10000):
+    '''parse mast file and load into database.
 
-        return motif, part, mast
+    Parse several motif runs and add them to the same
+    table.
+
+    Add columns for the control data as well.
+
+    The file is parsed chunk by chunk from the stream. Control data
+    are only kept for the sequences in the current foreground chunk
+    and rows are written in batches of `batch_size`.
+    '''
+
+    tmpfile = P.getTempFile(".")
+
+    tmpfile.write(MAST.Match().header +
+                  "\tmotif\tcontig"
+                  "\tl_evalue\tl_pvalue\tl_nmatches\tl_length\tl_start\tl_end"
+                  "\tr_evalue\tr_pvalue\tr_nmatches\tr_length\tr_start\tr_end"
+                  "\tmin_evalue\tmin_pvalue\tmax_nmatches" + "\n")
 
     def splitId(s, mode):
         '''split background match id
@@ -544,63 +814,75 @@ def loadMAST(infile, outfile):
 
         track might contain '_'.
         '''
-        d = match.id.split("_")
+        d = s.split("_")
         if mode == "bg":
             return "_".join(d[:-2]), d[-2], d[-1]
         elif mode == "fg":
             return "_".join(d[:-1]), d[-1]
 
-    for chunk in range(0, len(chunks) - 1, 2):
-
-        motif_fg, part, mast_fg = readChunk(lines, chunk)
-        assert part == "foreground"
-        motif_bg, part, mast_bg = readChunk(lines, chunk + 1)
-        assert part == "background"
-        assert motif_fg == motif_bg
-
-        # index control data
-        controls = collections.defaultdict(dict)
-        for match in mast_bg.matches:
-            track, id, pos = splitId(match.id, "bg")
-            controls[id][pos] = (
-                match.evalue, match.pvalue, match.nmotifs, match.length, match.start, match.end)
-
-        for match in mast_fg.matches:
-            # remove track and pos
-            track, match.id = splitId(match.id, "fg")
-            # move to genomic coordinates
-            contig, start, end = re.match(
-                "(\S+):(\d+)..(\d+)", match.description).groups()
-            if match.nmotifs > 0:
-                start, end = int(start), int(end)
-                match.start += start
-                match.end += start
-                match.positions = [x + start for x in match.positions]
-
-            id = match.id
-            if id not in controls:
-                P.warn("no controls for %s - increase MAST evalue" % id)
-
-            if "l" not in controls[id]:
-                controls[id]["l"] = (
-                    float(PARAMS["mast_evalue"]), 1, 0, 0, 0, 0)
-            if "r" not in controls[id]:
-                controls[id]["r"] = (
-                    float(PARAMS["mast_evalue"]), 1, 0, 0, 0, 0)
-
-            min_evalue = min(controls[id]["l"][0], controls[id]["r"][0])
-            min_pvalue = min(controls[id]["l"][1], controls[id]["r"][1])
-            max_nmatches = max(controls[id]["l"][2], controls[id]["r"][2])
-
-            tmpfile.write(str(match) + "\t%s\t%s\t%s\t%s\t%s\t%s\t%s" %
-                          (motif_fg, contig,
-                           "\t".join(map(str, controls[id]["l"])),
-                           "\t".join(map(str, controls[id]["r"])),
-                           str(min_evalue),
-                           str(min_pvalue),
-                           str(max_nmatches),
-                           ) + "\n")
-
+    no_control = (float(PARAMS["mast_evalue"]), 1, 0, 0, 0, 0)
+
+    rows = []
+
+    with IOTools.openFile(infile) as inf:
+
+        chunks = iterateMASTChunks(inf)
+
+        for motif_fg, part, chunk in chunks:
+            assert part == "foreground"
+            E.info("reading %s - %s" % (motif_fg, part))
+            mast_fg = MAST.parse(chunk)
+
+            fg_ids = set([splitId(match.id, "fg")[1]
+                          for match in mast_fg.matches])
+
+            motif_bg, part, chunk = next(chunks)
+            assert part == "background"
+            assert motif_fg == motif_bg
+            E.info("reading %s - %s" % (motif_bg, part))
+
+            # index control data for foreground sequences
+            controls = collections.defaultdict(dict)
+            for match in MAST.parse(chunk).matches:
+                track, id, pos = splitId(match.id, "bg")
+                if id in fg_ids:
+                    controls[id][pos] = (
+                        match.evalue, match.pvalue, match.nmotifs,
+                        match.length, match.start, match.end)
+
+            for match in mast_fg.matches:
+                # remove track and pos
+                track, match.id = splitId(match.id, "fg")
+                # move to genomic coordinates
+                contig, start, end = re.match(
+                    r"(\S+):(\d+)..(\d+)", match.description).groups()
+                if match.nmotifs > 0:
+                    start, end = int(start), int(end)
+                    match.start += start
+                    match.end += start
+                    match.positions = [x + start for x in match.positions]
+
+                id = match.id
+                if id not in controls:
+                    E.warn("no controls for %s - increase MAST evalue" % id)
+
+                left = controls[id].get("l", no_control)
+                right = controls[id].get("r", no_control)
+
+                rows.append(
+                    str(match) + "\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" %
+                    (motif_fg, contig,
+                     "\t".join(map(str, left)),
+                     "\t".join(map(str, right)),
+                     str(min(left[0], right[0])),
+                     str(min(left[1], right[1])),
+                     str(max(left[2], right[2]))))
+
+                if len(rows) >= batch_size:
+                    tmpfile.write("".join(rows))
+                    rows = []
+
+    tmpfile.write("".join(rows))
     tmpfile.close()
 
     P.load(tmpfile.name,
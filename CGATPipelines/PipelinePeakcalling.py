@@ -2,6 +2,7 @@ import os
 import re
 import collections
 import itertools
+from multiprocessing.pool import ThreadPool
 import CGAT.Experiment as E
 import CGATPipelines.Pipeline as P
 import CGAT.IOTools as IOTools
@@ -2752,6 +2753,266 @@ def readTable(tabfile):
     return D
 
 
+def getReadExtents(samfile, contig, start, end, offset=0):
+    '''return the extents of reads within a genomic region.
+
+    If `offset` is larger than 0, tags are shifted by `offset` / 2 and
+    extended by `offset` / 2. For peak counting this follows the MACS
+    protocol, see the function def __tags_call_peak in PeakDetect.py:
+    only the start of reads (taking into account the strand) is taken
+    and reads on the + strand are shifted downstream and reads on the
+    - strand upstream. Otherwise, the aligned extent of a read is
+    returned.
+
+    Reads are collected directly into numpy arrays, so memory usage
+    is proportional to the number of reads in the region. Use
+    small regions for deeply sequenced samples.
+
+    Arguments
+    ---------
+    samfile : pysam.AlignmentFile
+        Handle to a :term:`bam` formatted file.
+    contig : string
+        Chromosome
+    start : int
+        Start coordinate, 0-based
+    end : int
+        End coordinate, 0-based, position after end of region
+    offset : int
+        Peak shift to apply to reads
+
+    Returns
+    -------
+    starts : numpy.array
+        Start coordinates of read extents
+    ends : numpy.array
+        End coordinates of read extents
+    '''
+
+    # some unmapped reads might have a position
+    reads = np.fromiter(
+        ((read.reference_start, read.reference_end, read.is_reverse)
+         for read in samfile.fetch(contig, max(0, start - offset),
+                                   end + offset)
+         if not read.is_unmapped),
+        dtype=[("start", np.int64), ("end", np.int64), ("reverse", bool)])
+
+    starts, ends, reverse = reads["start"], reads["end"], reads["reverse"]
+
+    if offset > 0:
+        shift = offset // 2
+        starts, ends = (np.where(reverse, ends - offset, starts + shift),
+                        np.where(reverse, ends - shift, starts + offset))
+
+    starts = np.maximum(starts, 0)
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+
+def computePeakStats(read_starts, read_ends, starts, ends,
+                     chunk_size=1000000):
+    '''compute peak parameters for intervals from read extents.
+
+    The read density is accumulated over the region spanning all
+    intervals and the peak parameters are derived for all intervals
+    with vectorized reductions. Intervals are processed in chunks
+    covering about `chunk_size` bases to limit memory usage.
+
+    Arguments
+    ---------
+    read_starts : numpy.array
+        Sorted start coordinates of read extents.
+    read_ends : numpy.array
+        Sorted end coordinates of read extents.
+    starts : numpy.array
+        Start coordinates of intervals, 0-based.
+    ends : numpy.array
+        End coordinates of intervals, 0-based, position after end
+        of interval. Intervals must not be empty.
+    chunk_size : int
+        Number of bases to process at once. A chunk contains at least
+        one interval.
+
+    Returns
+    -------
+    stats : tuple
+        Tuple of arrays (npeaks, peakcenter, length, avgval, peakval,
+        nreads), see :func:`countPeaks`.
+    '''
+
+    lengths = ends - starts
+    if np.any(lengths <= 0):
+        raise ValueError("empty intervals can not be counted")
+
+    region_start, region_end = starts.min(), ends.max()
+    region_length = region_end - region_start
+
+    # accumulate read density from read boundaries
+    coverage = np.zeros(region_length + 1, dtype=np.int32)
+    for positions, delta in ((read_starts, 1), (read_ends, -1)):
+        positions, counts = np.unique(
+            np.clip(positions - region_start, 0, region_length),
+            return_counts=True)
+        coverage[positions] += delta * counts
+    coverage = np.cumsum(coverage[:-1], dtype=np.int32)
+
+    # reads overlapping an interval are all reads starting before
+    # its end minus those ending before its start
+    nreads = np.searchsorted(read_starts, ends, side="left") - \
+        np.searchsorted(read_ends, starts, side="right")
+
+    npeaks = np.zeros(len(starts), dtype=np.int64)
+    peakcenter = np.zeros(len(starts), dtype=np.int64)
+    avgval = np.zeros(len(starts), dtype=np.float64)
+    peakval = np.zeros(len(starts), dtype=np.int32)
+
+    cumulative_lengths = np.cumsum(lengths)
+    x = 0
+    while x < len(starts):
+        y = max(x + 1, np.searchsorted(
+            cumulative_lengths,
+            cumulative_lengths[x] - lengths[x] + chunk_size,
+            side="right"))
+        chunk = slice(x, y)
+        x = y
+        chunk_lengths = lengths[chunk]
+        boundaries = np.concatenate(([0], np.cumsum(chunk_lengths)[:-1]))
+
+        # genomic positions of all bases in the intervals of the chunk
+        positions = np.repeat(starts[chunk] - boundaries, chunk_lengths) + \
+            np.arange(chunk_lengths.sum())
+        values = coverage[positions - region_start]
+
+        peakval[chunk] = np.maximum.reduceat(values, boundaries)
+        avgval[chunk] = np.add.reduceat(
+            values, boundaries, dtype=np.float64) / chunk_lengths
+
+        is_peak = values == np.repeat(peakval[chunk], chunk_lengths)
+        n = np.add.reduceat(is_peak.astype(np.int64), boundaries)
+        npeaks[chunk] = n
+
+        # peakcenter is median coordinate between peaks
+        # such that it is a valid peak in the middle
+        peakcenter[chunk] = positions[is_peak][np.cumsum(n) - n + n // 2]
+
+    return npeaks, peakcenter, lengths, avgval, peakval, nreads
+
+
+def _countPeaksInContig(args):
+    '''compute peak parameters for all intervals on a contig.
+
+    Intervals sorted by start are processed in chunks of intervals
+    starting within `chunk_size` bases. Reads are fetched from each
+    :term:`bam` file for the region spanned by a chunk, so that
+    memory usage does not depend on the number of reads on the
+    contig.
+    '''
+    contig, starts, ends, bamfiles, offsets, chunk_size = args
+
+    samfiles = [pysam.AlignmentFile(x, "rb") for x in bamfiles]
+    results = []
+    try:
+        x = 0
+        while x < len(starts):
+            y = max(x + 1, np.searchsorted(starts, starts[x] + chunk_size,
+                                           side="left"))
+            chunk = slice(x, y)
+            x = y
+
+            read_starts, read_ends = [], []
+            for samfile, offset in zip(samfiles, offsets):
+                s, e = getReadExtents(samfile, contig,
+                                      starts[chunk].min(),
+                                      ends[chunk].max(),
+                                      offset)
+                read_starts.append(s)
+                read_ends.append(e)
+
+            results.append(computePeakStats(
+                np.sort(np.concatenate(read_starts)),
+                np.sort(np.concatenate(read_ends)),
+                starts[chunk], ends[chunk],
+                chunk_size=chunk_size))
+    finally:
+        for samfile in samfiles:
+            samfile.close()
+
+    return tuple(np.concatenate(x) for x in zip(*results))
+
+
+def countPeaksInIntervals(contigs, starts, ends, bamfiles, offsets=None,
+                          threads=1, chunk_size=1000000):
+    '''compute peak parameters for a collection of genomic intervals.
+
+    Intervals are grouped by contig and contigs are processed in
+    parallel by a pool of `threads` threads. Threads are used as
+    this function runs within ruffus jobs, which may not start
+    child processes. See :func:`countPeaks` for a description of
+    the peak parameters.
+
+    Arguments
+    ---------
+    contigs : list
+        Chromosome of each interval.
+    starts : list
+        Start coordinate of each interval, 0-based.
+    ends : list
+        End coordinate of each interval, 0-based, position after end
+        of interval.
+    bamfiles : list
+        List of filenames of :term:`bam` formatted files.
+    offsets : list
+        Peak shifts to apply to reads in each :term:`bam` file.
+    threads : int
+        Number of threads.
+    chunk_size : int
+        Reads are counted for intervals within about `chunk_size`
+        bases at a time.
+
+    Returns
+    -------
+    stats : tuple
+        Tuple of arrays (npeaks, peakcenter, length, avgval, peakval,
+        nreads) in the order of the input intervals.
+    '''
+
+    if offsets is None:
+        offsets = [0] * len(bamfiles)
+    assert len(bamfiles) == len(offsets)
+
+    contigs = np.array(contigs)
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+
+    # group intervals by contig and sort by start
+    order = np.lexsort((starts, contigs))
+    groups = [order[contigs[order] == contig]
+              for contig in np.unique(contigs)]
+
+    args = [(contigs[idx[0]], starts[idx], ends[idx], bamfiles, offsets,
+             chunk_size)
+            for idx in groups]
+
+    stats = [np.zeros(len(starts), dtype=np.int64),
+             np.zeros(len(starts), dtype=np.int64),
+             np.zeros(len(starts), dtype=np.int64),
+             np.zeros(len(starts), dtype=np.float64),
+             np.zeros(len(starts), dtype=np.int64),
+             np.zeros(len(starts), dtype=np.int64)]
+
+    pool = ThreadPool(threads)
+    try:
+        for idx, result in zip(groups,
+                               pool.imap(_countPeaksInContig, args)):
+            for array, values in zip(stats, result):
+                array[idx] = values
+    finally:
+        pool.close()
+        pool.join()
+
+    return tuple(stats)
+
+
 def countPeaks(contig, start, end, samfiles, offsets=None):
     '''compute peak parameters within a genomic interval.
 
@@ -2786,22 +3047,25 @@ def countPeaks(contig, start, end, samfiles, offsets=None):
     nreads : int
         Number of tags contained in interval.
 
+    For computing peak parameters of many intervals, use
+    :func:`countPeaksInIntervals`.
+
     CG: THIS FUNCTION WAS COPIED FROM OLD PipelinePeakcalling to maintain
     compatability for pipeline_intervals.py. Could be removed if functionality
     no longer needed.
     '''
 
-    nreads, counts = getCounts(contig, start, end, samfiles, offsets)
+    if offsets is None:
+        offsets = [0] * len(samfiles)
 
-    length = end - start
-    avgval = numpy.mean(counts)
-    peakval = max(counts)
+    read_starts, read_ends = [], []
+    for samfile, offset in zip(samfiles, offsets):
+        s, e = getReadExtents(samfile, contig, start, end, offset)
+        read_starts.append(s)
+        read_ends.append(e)
 
-    # set other peak parameters
-    peaks = numpy.array(list(range(0, length)))[counts >= peakval]
-    npeaks = len(peaks)
-    # peakcenter is median coordinate between peaks
-    # such that it is a valid peak in the middle
-    peakcenter = start + peaks[npeaks // 2]
+    stats = computePeakStats(np.sort(np.concatenate(read_starts)),
+                             np.sort(np.concatenate(read_ends)),
+                             np.array([start]), np.array([end]))
 
-    return npeaks, peakcenter, length, avgval, peakval, nreads
+    return tuple(x[0] for x in stats)
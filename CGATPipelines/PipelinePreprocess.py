@@ -156,6 +156,10 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
         directory. Otherwise, a temporary directory is used.
     summarize : bool
         If True, summarize the output after each step.
+    stream : bool
+        If True, connect consecutive tools that can process
+        :term:`fastq` data from stdin to stdout by pipes instead of
+        writing compressed intermediate files.
     threads : int
         Number of processing threads to use.
     outdir : string
@@ -170,6 +174,9 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
         directory. Otherwise, a temporary directory is used.
     summarize : bool
         If True, summarize the output after each step.
+    stream : bool
+        If True, connect consecutive tools that can process
+        :term:`fastq` data from stdin to stdout by pipes.
     threads : int
         Number of processing threads to use.
 
@@ -183,9 +190,11 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
                  summarize=False,
                  threads=1,
                  qual_format='phred64',
+                 stream=False,
                  *args, **kwargs):
         self.save = save
         self.summarize = summarize
+        self.stream = stream
         self.threads = threads
         if self.save:
             self.outdir = "processed.dir"
@@ -245,28 +254,32 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
         cmd_processors = []
 
         # build statements from processors
-        for idx, processor in enumerate(self.processors):
-
-            # number of output files created in this step
-            nfiles = processor.get_num_files(current_files)
-            if nfiles == 2:
-                suffixes = [track + ".fastq.1.gz",
-                            track + ".fastq.2.gz"]
-            else:
-                suffixes = [track + ".fastq.gz"]
-
-            if idx == len(self.processors) - 1:
-                # last iteration, write to output files
-                next_files = [output_prefix + s
-                              for s in suffixes]
-            else:
-                # add a prefix to each file denoting the processor
-                next_files = [processor.prefix + "-" + track + s
-                              for s in suffixes]
-
-                # add scratch temporary directory to next files
-                next_files = [os.path.join(self.tmpdir_fastq, x)
-                              for x in next_files]
+        idx = 0
+        while idx < len(self.processors):
+
+            chain = []
+            if self.stream:
+                # collect consecutive processors that can run as filters
+                while idx < len(self.processors):
+                    processor = self.processors[idx]
+                    cmd_filter = processor.build_filter(
+                        current_files,
+                        output_prefix + track + "-" + processor.prefix)
+                    if cmd_filter is None:
+                        break
+                    chain.append((cmd_filter, self.getOutputFiles(
+                        idx, current_files, output_prefix, track)))
+                    idx += 1
+
+            if chain:
+                cmd_processors.extend(
+                    self.buildChain(current_files, chain))
+                current_files = chain[-1][1]
+                continue
+
+            processor = self.processors[idx]
+            next_files = self.getOutputFiles(
+                idx, current_files, output_prefix, track)
 
             cmd_process = processor.build(
                 current_files,
@@ -282,7 +295,8 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
                         """zcat %(fn)s
                         | cgat fastq2summary
                         --guess-format=illumina-1.8
-                        > %(fn)s.summary""")
+                        > %(fn)s.summary;""" % locals())
+            idx += 1
 
         cmd_process = " checkpoint; ".join(cmd_processors)
         cmd_clean = self.cleanup()
@@ -296,6 +310,69 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
                                           cmd_clean))
         return statement
 
+    def getOutputFiles(self, idx, infiles, output_prefix, track):
+        '''return the output files of processor *idx* when
+        processing *infiles*.
+
+        The output of the last processor goes to files starting with
+        *output_prefix*, all other output to the temporary directory.
+        '''
+
+        processor = self.processors[idx]
+
+        # number of output files created in this step
+        nfiles = processor.get_num_files(infiles)
+        if nfiles == 2:
+            suffixes = [track + ".fastq.1.gz",
+                        track + ".fastq.2.gz"]
+        else:
+            suffixes = [track + ".fastq.gz"]
+
+        if idx == len(self.processors) - 1:
+            # last iteration, write to output files
+            return [output_prefix + s for s in suffixes]
+
+        # add a prefix to each file denoting the processor
+        next_files = [processor.prefix + "-" + track + s
+                      for s in suffixes]
+
+        # add scratch temporary directory to next files
+        return [os.path.join(self.tmpdir_fastq, x) for x in next_files]
+
+    def buildChain(self, infiles, chain):
+        '''return statements running a *chain* of filters on each of
+        *infiles*.
+
+        *chain* is a list of tuples of a filter statement (see
+        :meth:`ProcessTool.build_filter`) and the output files of
+        that step. Only the output files of the last step are
+        written, intermediate data is passed by pipes.
+
+        If :attr:`summarize` is set, the data after each step are
+        passed through :doc:`scripts/cgat_fastq_summary`, which
+        computes the summary on the uncompressed stream as part of
+        the pipe. A failure to compute a summary thus fails the
+        statement. The summaries are saved using the name of the
+        output file of each step.
+        '''
+
+        cmds = []
+        for x, infile in enumerate(infiles):
+            cmd_pipe = ["zcat %s" % infile]
+            for cmd_filter, outfiles in chain:
+                cmd_pipe.append(cmd_filter)
+                if self.summarize:
+                    fn = outfiles[x]
+                    cmd_pipe.append(
+                        """python %%(pipeline_scriptsdir)s/cgat_fastq_summary.py
+                        --output-filename-pattern=%(fn)s.summary
+                        --log=%(fn)s.summary.log""" % locals())
+
+            outfile = chain[-1][1][x]
+            cmds.append(" | ".join(cmd_pipe) + " | gzip > %s;" % outfile)
+
+        return cmds
+
 
 class ProcessTool(object):
     '''defines class attributes for a sequence utility tool
@@ -353,6 +430,30 @@ class ProcessTool(object):
         raise NotImplementedError(
             "build() method needs to be implemented in derived class")
 
+    def build_filter(self, infiles, output_prefix):
+        """build a command line statement running the tool on
+        uncompressed :term:`fastq` data from stdin to stdout.
+
+        Tools that can be run this way are connected by pipes if
+        :attr:`MasterProcessor.stream` is set.
+
+        Arguments
+        ---------
+        infiles : list
+           List of input filenames in :term:`fastq` format. Each
+           file will be processed separately.
+        output_prefix : list
+           Prefix to add to PATH of additional output files created by
+           the tool.
+
+        Returns
+        -------
+        statement : string
+           The command line statement or None if the tool can not
+           be run as a filter.
+        """
+        return None
+
 
 class Trimgalore(ProcessTool):
     """Read processing - run trimgalore"""
@@ -492,25 +593,28 @@ class FastxTrimmer(ProcessTool):
         assert len(infiles) == len(outfiles)
         assert len(infiles) in (1, 2)
 
-        prefix = self.prefix
-        offset = Fastq.getOffset("sanger", raises=False)
-        processing_options = self.processing_options
-
-        assert len(infiles) == len(outfiles)
+        cmd_filter = self.build_filter(infiles, output_prefix)
 
         cmds = []
         for infile, outfile in zip(infiles, outfiles):
 
             cmds.append('''zcat %(infile)s
-            | fastx_trimmer
-            -Q%(offset)s
-            %(processing_options)s
-            2>> %(output_prefix)s.log
+            | %(cmd_filter)s
             | gzip > %(outfile)s
             ;''' % locals())
 
         return " checkpoint; ".join(cmds)
 
+    def build_filter(self, infiles, output_prefix):
+
+        offset = Fastq.getOffset("sanger", raises=False)
+        processing_options = self.processing_options
+
+        return '''fastx_trimmer
+            -Q%(offset)s
+            %(processing_options)s
+            2>> %(output_prefix)s.log''' % locals()
+
 
 class Cutadapt(ProcessTool):
     """Read processing - run cutadapt"""
@@ -576,6 +680,17 @@ class Cutadapt(ProcessTool):
 
         return " checkpoint; ".join(cmds)
 
+    def build_filter(self, infiles, output_prefix):
+
+        # untrimmed reads and paired processing require files
+        if self.untrimmed or (self.process_paired and len(infiles) == 2):
+            return None
+
+        processing_options = self.processing_options
+
+        return '''cutadapt %(processing_options)s -
+                2>> %(output_prefix)s.log''' % locals()
+
 
 class Reconcile(ProcessTool):
     """Read processing - reconcile read names in two :term:`fastq` files.
@@ -677,17 +792,23 @@ class ReverseComplement(ProcessTool):
 
         assert len(infiles) == len(outfiles)
 
+        cmd_filter = self.build_filter(infiles, output_prefix)
+
         cmds = []
         for infile, outfile in zip(infiles, outfiles):
             cmds.append('''zcat %(infile)s
-            | cgat fastq2fastq
-            --method=reverse-complement
-            --log=%(output_prefix)s.log
+            | %(cmd_filter)s
             | gzip > %(outfile)s;
             ''' % locals())
 
         return " checkpoint; ".join(cmds)
 
+    def build_filter(self, infiles, output_prefix):
+
+        return '''cgat fastq2fastq
+            --method=reverse-complement
+            --log=%(output_prefix)s.log''' % locals()
+
 
 class Pandaseq(ProcessTool):
     """Read processing - run pandaseq"""
@@ -45,12 +45,14 @@ import numpy as np
 import os
 import pandas as pd
 import re
+import scipy.sparse
+import scipy.stats
 import shutil
+from multiprocessing.pool import ThreadPool
 
 
 from rpy2.robjects import r as R
 import rpy2.robjects as ro
-import rpy2.rinterface as ri
 
 import CGAT.BamTools as BamTools
 import CGAT.Counts as Counts
@@ -566,41 +568,185 @@ def makeExpressionSummaryPlots(counts_inf, design_inf, logfile):
         counts_log10.heatmap(heatmap_outfile, zscore=True)
 
 
+def readExpressionColumn(infile, column):
+    '''read a single *column* from a quantification table.
+
+    Returns
+    -------
+    ids : numpy.array
+        Identifiers in the first column of the table.
+    values : numpy.array
+        Values in *column* as float32.
+    '''
+    with IOTools.openFile(infile) as inf:
+        id_column = inf.readline().split("\t")[0].strip()
+
+    df = pd.read_csv(infile, sep="\t", index_col=0,
+                     usecols=[id_column, column],
+                     dtype={column: np.float32})
+    return df.index.values.astype(str), df[column].values
+
+
+def _readExpressionColumn(args):
+    '''worker function for :func:`getAlignmentFreeNormExp`.'''
+    return readExpressionColumn(*args)
+
+
+def writeExpressionMatrix(outfile, matrix, rows, columns):
+    '''write an expression *matrix* with identifiers *rows* and
+    sample names *columns*.
+
+    The matrix is written as a compressed :term:`tsv` formatted table
+    to *outfile* and column by column to the compressed numpy archive
+    `outfile`.npz. The archive contains the arrays ``rows`` and
+    ``columns`` with the identifiers and one array ``column_<i>`` for
+    each sample, so that individual samples can be loaded without
+    decompressing the complete matrix, see
+    :func:`readExpressionMatrix`.
+    '''
+    df = pd.DataFrame(matrix, index=rows, columns=columns)
+    df.index.name = "id"
+    df.to_csv(outfile, sep="\t", compression="gzip")
+
+    arrays = dict(("column_%i" % x, np.ascontiguousarray(matrix[:, x]))
+                  for x in range(len(columns)))
+    np.savez_compressed(outfile + ".npz",
+                        rows=np.asarray(rows, dtype=str),
+                        columns=np.asarray(columns, dtype=str),
+                        **arrays)
+
+
+def readExpressionMatrix(infile, columns=None):
+    '''read an expression matrix written by
+    :func:`writeExpressionMatrix` from the numpy archive *infile*.
+
+    Arguments
+    ---------
+    infile : string
+        Filename of the `.npz` archive.
+    columns : list
+        Sample names to read. If not given, all samples are read.
+
+    Returns
+    -------
+    dataframe : :class:`pandas.DataFrame`
+        Expression values with identifiers as index.
+    '''
+    with np.load(infile) as data:
+        all_columns = list(data["columns"])
+        if columns is None:
+            columns = all_columns
+        values = dict((column,
+                       data["column_%i" % all_columns.index(column)])
+                      for column in columns)
+        df = pd.DataFrame(values, index=data["rows"], columns=columns)
+    df.index.name = "id"
+    return df
+
+
 def getAlignmentFreeNormExp(transcript_infiles, basename, column,
-                            transcripts_outf, genes_outf, t2gMap):
-    ''' Extract the normalised expression from the transcript-level
+                            transcripts_outf, genes_outf, t2gMap,
+                            threads=1):
+    '''Extract the normalised expression from the transcript-level
     quantification, merge across multiple samples and output
-    transcript-level and gene-level tables'''
+    transcript-level and gene-level tables
 
-    for n, infile in enumerate(transcript_infiles):
-        # replace filename to use the full results table
-        dirname = os.path.dirname(infile)
-        sample = os.path.basename(dirname)
-        infile = os.path.join(dirname, basename)
+    The expression values of each sample are read into a float32
+    matrix indexed by a transcript dictionary shared by all
+    samples. Transcripts missing in a sample are set to NaN. Gene
+    level values are the sum of the transcript values (NaN counted
+    as 0) of transcripts in *t2gMap*, computed as a product with a
+    sparse gene x transcript matrix.
 
-        tmp_df = pd.read_table(infile, sep="\t", index_col=0)
-        tmp_df.drop([x for x in tmp_df.columns if x != column],
-                    axis=1, inplace=True)
-        tmp_df.columns = [sample]
-        tmp_df.index.name = "id"
+    Both tables are also written in numpy's compressed format, see
+    :func:`writeExpressionMatrix`.
 
-        if n == 0:
-            transcript_df = tmp_df
-        else:
-            transcript_df = transcript_df.merge(
-                tmp_df, how="outer", left_index=True, right_index=True)
+    Arguments
+    ---------
+    transcript_infiles : list
+        Quantification files. The full results table *basename* is
+        read from the same directory, which is also the sample name.
+    basename : string
+        Filename of the full results table.
+    column : string
+        Column to extract.
+    transcripts_outf : string
+        Output filename for transcript level table.
+    genes_outf : string
+        Output filename for gene level table.
+    t2gMap : string
+        Filename of table mapping transcripts to genes.
+    threads : int
+        Number of samples to read in parallel. Samples are read in
+        threads as this function runs within ruffus jobs, which may
+        not start child processes.
+    '''
 
-    transcript_df.to_csv(transcripts_outf, sep="\t", compression="gzip")
+    samples, args = [], []
+    for infile in transcript_infiles:
+        # replace filename to use the full results table
+        dirname = os.path.dirname(infile)
+        samples.append(os.path.basename(dirname))
+        args.append((os.path.join(dirname, basename), column))
+
+    if threads > 1:
+        pool = ThreadPool(threads)
+        results = pool.imap(_readExpressionColumn, args)
+    else:
+        pool = None
+        results = map(_readExpressionColumn, args)
 
-    transcript2gene_df = pd.read_table(t2gMap, sep="\t", index_col=0)
-    transcript_df = pd.merge(transcript_df, transcript2gene_df,
-                             left_index=True, right_index=True,
-                             how="inner")
-    gene_df = pd.DataFrame(transcript_df.groupby('gene_id').sum())
-    gene_df.index.name = 'id'
+    transcript2index = {}
+    matrix = None
+    last_ids, last_index = None, None
+    try:
+        for x, (ids, values) in enumerate(results):
+            # quantifiers output transcripts in the same order for
+            # all samples, so the row indices can usually be re-used
+            if last_ids is None or not np.array_equal(ids, last_ids):
+                for i in ids:
+                    if i not in transcript2index:
+                        transcript2index[i] = len(transcript2index)
+                last_ids = ids
+                last_index = np.array([transcript2index[i] for i in ids],
+                                      dtype=np.int64)
+
+            if matrix is None:
+                matrix = np.empty((len(transcript2index), len(samples)),
+                                  dtype=np.float32)
+                matrix.fill(np.nan)
+            elif len(transcript2index) > matrix.shape[0]:
+                extra = np.empty((len(transcript2index) - matrix.shape[0],
+                                  len(samples)), dtype=np.float32)
+                extra.fill(np.nan)
+                matrix = np.vstack((matrix, extra))
+
+            matrix[last_index, x] = values
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    transcripts = np.array(sorted(transcript2index), dtype=str)
+    matrix = matrix[[transcript2index[t] for t in transcripts]]
+    writeExpressionMatrix(transcripts_outf, matrix, transcripts, samples)
+
+    transcript2gene_df = pd.read_csv(t2gMap, sep="\t", index_col=0)
+    transcript2gene_df = transcript2gene_df[
+        transcript2gene_df.index.isin(transcripts)]
+    genes, gene_index = np.unique(
+        transcript2gene_df["gene_id"].values.astype(str),
+        return_inverse=True)
+    transcript_index = np.searchsorted(
+        transcripts, transcript2gene_df.index.values.astype(str))
+    gene2transcript = scipy.sparse.csr_matrix(
+        (np.ones(len(gene_index), dtype=np.float32),
+         (gene_index, transcript_index)),
+        shape=(len(genes), len(transcripts)))
+
+    gene_matrix = gene2transcript.dot(np.nan_to_num(matrix))
+    writeExpressionMatrix(genes_outf, gene_matrix, genes, samples)
 
-    gene_df.to_csv(
-        genes_outf, compression="gzip", sep="\t")
 
 '''
 # ########## old code ################
@@ -905,7 +1051,56 @@ def quantifyWithStringTie(gtffile, bamfile, outdir):
     P.run()
 
 
-def mergeAndLoadStringTie(infiles, track_regex, outfile):
+def iterateTable(infile):
+    '''iterate over the rows of a :term:`tsv` formatted table.
+
+    Returns
+    -------
+    columns : list
+        Column names from the first line.
+    rows : iterator
+        Iterator over the remaining rows split into fields.
+    '''
+
+    with IOTools.openFile(infile) as inf:
+        columns = inf.readline().rstrip("\r\n").split("\t")
+
+    def _iterate():
+        with IOTools.openFile(infile) as inf:
+            inf.readline()
+            for line in inf:
+                yield line.rstrip("\r\n").split("\t")
+
+    return columns, _iterate()
+
+
+def iterateTables(infiles, track_regex, cat="track"):
+    '''iterate over the rows of several :term:`tsv` formatted tables
+    with the same columns.
+
+    A column *cat* is prepended to each row containing the track name
+    extracted from the filename with *track_regex*.
+
+    Returns
+    -------
+    columns : list
+        Column names.
+    rows : iterator
+        Iterator over rows.
+    '''
+
+    columns, rows = iterateTable(infiles[0])
+
+    def _iterate():
+        for infile in infiles:
+            track = re.search(track_regex, infile).groups()[0]
+            for row in iterateTable(infile)[1]:
+                yield [track] + row
+
+    return [cat] + columns, _iterate()
+
+
+def mergeAndLoadStringTie(infiles, track_regex, outfile, dbhandle=None):
     '''Load stringtie quantitation from multiple tracks into a set
     of database tables. 
 
@@ -923,6 +1118,9 @@ def mergeAndLoadStringTie(infiles, track_regex, outfile):
         regular expression to capture track name out of filenames
     outfile: string
         output file, should end in .load, is used for table prefix
+    dbhandle: object
+        Database handle. If not given, connect to the pipeline
+        database.
 
     Adds the following tables to the database:
         PREFIX_transcript_data
@@ -933,7 +1131,10 @@ def mergeAndLoadStringTie(infiles, track_regex, outfile):
 
     The first three will have a track column indicating which track
     they come from.  The last two are assumed to be identical for each
-    track (this is tested and confirmed) '''
+    track (this is tested and confirmed)
+
+    The files are read as streams and all tables are loaded in a
+    single transaction with :func:`Pipeline.loadTables`. '''
 
     infiles = zip(*infiles)
 
@@ -951,26 +1152,28 @@ def mergeAndLoadStringTie(infiles, track_regex, outfile):
 
     table_prefix = P.snip(outfile, ".load")
 
+    tables = []
     for infile in infiles:
-        
+
         which_files = set([os.path.basename(f) for f in infile])
         assert len(which_files) == 1, "Input file lists not in same order"
         table_suffix = table_suffixes[list(which_files)[0]]
 
         tablename = os.path.basename(table_prefix + "_" + table_suffix)
         indexs = table_indexes[list(which_files)[0]]
-        
+
         if "2" in table_suffix:
-            P.load(infile[0], outfile,
-                   options="-i %s" % indexs,
-                   tablename=tablename)
+            columns, rows = iterateTable(infile[0])
+            tables.append((tablename, columns, rows, [indexs]))
             continue
-            
-        P.concatenateAndLoad(infile, outfile,
-                             regex_filename=track_regex,
-                             tablename=tablename,
-                             options="--quick -i %s" % indexs,
-                             job_memory="12G")
+
+        columns, rows = iterateTables(infile, track_regex)
+        tables.append((tablename, columns, rows, ["track", indexs]))
+
+    if dbhandle is None:
+        dbhandle = P.connect()
+
+    P.loadTables(dbhandle, tables, outfile=outfile)
 
 
 def mergeCufflinksFPKM(infiles, outfile, genesets,
@@ -1232,7 +1435,7 @@ def loadCuffdiff(dbhandle, infile, outfile, min_fpkm=1.0):
 
     This functions parses and loads the results of a cuffdiff differential
     expression analysis.
-    Parsing is performed by the parseCuffdiff function.
+    Parsing is performed by the iterateCuffdiff function.
 
     Multiple tables will be created as cuffdiff outputs information
     on gene, isoform, tss, etc. levels.
@@ -1243,6 +1446,9 @@ def loadCuffdiff(dbhandle, infile, outfile, min_fpkm=1.0):
     `min_fpkm`) are set to status 'NOCALL'. These transcripts might
     nevertheless be significant.
 
+    The result files are read as streams and all tables are loaded in
+    a single transaction with :func:`Pipeline.loadTables`.
+
     Arguments
     ---------
     dbhandle : object
@@ -1269,7 +1475,7 @@ def loadCuffdiff(dbhandle, infile, outfile, min_fpkm=1.0):
     # cuff = R('''readCufflinks(dir = %(indir)s, dbfile=%(indir)s/csvdb)''' )
     # to be continued...
 
-    tmpname = P.getTempFilename(shared=True)
+    tables = []
 
     # ignore promoters and splicing - no fold change column, but  sqrt(JS)
     for fn, level in (("cds_exp.diff.gz", "cds"),
@@ -1281,16 +1487,11 @@ def loadCuffdiff(dbhandle, infile, outfile, min_fpkm=1.0):
 
         tablename = prefix + "_" + level + "_diff"
 
-        infile = os.path.join(indir, fn)
-
-        results = parseCuffdiff(infile, min_fpkm=min_fpkm)
-        Expression.writeExpressionResults(tmpname, results)
-        P.load(tmpname, outfile,
-               tablename=tablename,
-               options="--allow-empty-file "
-               "--add-index=treatment_name "
-               "--add-index=control_name "
-               "--add-index=test_id")
+        tables.append((
+            tablename,
+            Expression.GeneExpressionResult._fields,
+            iterateCuffdiff(os.path.join(indir, fn), min_fpkm=min_fpkm),
+            ["treatment_name", "control_name", "test_id"]))
 
     for fn, level in (("cds.fpkm_tracking.gz", "cds"),
                       ("genes.fpkm_tracking.gz", "gene"),
@@ -1298,14 +1499,20 @@ def loadCuffdiff(dbhandle, infile, outfile, min_fpkm=1.0):
                       ("tss_groups.fpkm_tracking.gz", "tss")):
 
         tablename = prefix + "_" + level + "_levels"
-        infile = os.path.join(indir, fn)
+        columns, rows = iterateTable(os.path.join(indir, fn))
+        # empty file
+        if columns == [""]:
+            continue
+
+        tables.append((tablename, columns, rows,
+                       ["tracking_id", "control_name", "test_id"]))
 
-        P.load(infile, outfile,
-               tablename=tablename,
-               options="--allow-empty-file "
-               "--add-index=tracking_id "
-               "--add-index=control_name "
-               "--add-index=test_id")
+        if level == "isoform":
+            # build convenience table with tracks
+            tracks = [x[:-len("_FPKM")] for x in columns
+                      if x.endswith("_FPKM")]
+            tables.append((prefix, ["track"],
+                           [(x,) for x in tracks], []))
 
     # Jethro - load tables of sample specific cuffdiff fpkm values into csvdb
     # IMS: First read in lookup table for CuffDiff/Pipeline sample name
@@ -1330,48 +1537,42 @@ def loadCuffdiff(dbhandle, infile, outfile, min_fpkm=1.0):
 
         tablename = prefix + "_" + level + "sample_fpkms"
 
-        tmpf = P.getTempFilename(".")
-        inf = IOTools.openFile(os.path.join(indir, fn)).readlines()
-        outf = IOTools.openFile(tmpf, "w")
-
         samples = []
-        genes = {}
-
-        is_first = True
-        for line in inf:
-
-            if is_first:
-                is_first = False
-                continue
-
-            line = line.split()
-            gene_id = line[0]
-            condition = line[1]
-            replicate = line[2]
-            fpkm = line[6]
-            status = line[8]
-
-            sample_id = condition + "_" + replicate
-
-            if sample_id not in samples:
-                samples.append(sample_id)
-
-            # IMS: The following block keeps getting its indenting messed
-            # up. It is not part of the 'if sample_id not in samples' block
-            # please make sure it does not get made part of it
-            if gene_id not in genes:
-                genes[gene_id] = {}
-                genes[gene_id][sample_id] = fpkm
-            else:
-                if sample_id in genes[gene_id]:
-                    raise ValueError(
-                        'sample_id %s appears twice in file for gene_id %s'
-                        % (sample_id, gene_id))
+        genes = collections.OrderedDict()
+
+        with IOTools.openFile(os.path.join(indir, fn)) as inf:
+            # skip header
+            inf.readline()
+            for line in inf:
+
+                line = line.split()
+                gene_id = line[0]
+                condition = line[1]
+                replicate = line[2]
+                fpkm = line[6]
+                status = line[8]
+
+                sample_id = condition + "_" + replicate
+
+                if sample_id not in samples:
+                    samples.append(sample_id)
+
+                # IMS: The following block keeps getting its indenting messed
+                # up. It is not part of the 'if sample_id not in samples' block
+                # please make sure it does not get made part of it
+                if gene_id not in genes:
+                    genes[gene_id] = {}
+                    genes[gene_id][sample_id] = fpkm
                 else:
-                    if status != "OK":
-                        genes[gene_id][sample_id] = status
+                    if sample_id in genes[gene_id]:
+                        raise ValueError(
+                            'sample_id %s appears twice in file for gene_id %s'
+                            % (sample_id, gene_id))
                     else:
-                        genes[gene_id][sample_id] = fpkm
+                        if status != "OK":
+                            genes[gene_id][sample_id] = status
+                        else:
+                            genes[gene_id][sample_id] = fpkm
 
         samples = sorted(samples)
 
@@ -1383,49 +1584,21 @@ def loadCuffdiff(dbhandle, infile, outfile, min_fpkm=1.0):
         if len(samples) == 0:
             continue
 
-        headers = "gene_id\t" + "\t".join([sample_lookup[x] for x in samples])
-        outf.write(headers + "\n")
-
-        for gene in genes.iterkeys():
-            outf.write(gene + "\t")
-            s = 0
-            while x < len(samples) - 1:
-                outf.write(genes[gene][samples[s]] + "\t")
-                s += 1
-
-            # IMS: Please be careful with this line. It keeps getting moved
-            # into the above while block where it does not belong
-            outf.write(genes[gene][samples[len(samples) - 1]] + "\n")
-
-        outf.close()
-
-        P.load(tmpf,
-               outfile,
-               tablename=tablename,
-               options="--allow-empty-file "
-               " --add-index=gene_id")
+        tables.append((
+            tablename,
+            ["gene_id"] + [sample_lookup[x] for x in samples],
+            [[gene] + [values[x] for x in samples]
+             for gene, values in genes.items()],
+            ["gene_id"]))
 
-        os.unlink(tmpf)
+    P.loadTables(dbhandle, tables, outfile=outfile)
 
-    # build convenience table with tracks
-    tablename = prefix + "_isoform_levels"
-    tracks = Database.getColumnNames(dbhandle, tablename)
-    tracks = [x[:-len("_FPKM")] for x in tracks if x.endswith("_FPKM")]
 
-    tmpfile = P.getTempFile(dir=".")
-    tmpfile.write("track\n")
-    tmpfile.write("\n".join(tracks) + "\n")
-    tmpfile.close()
-
-    P.load(tmpfile.name, outfile)
-    os.unlink(tmpfile.name)
-
-
-def parseCuffdiff(infile, min_fpkm=1.0):
+def iterateCuffdiff(infile, min_fpkm=1.0):
     '''parse a cuffdiff .diff output file.
 
-    This method takes cuffdiff output and converts the results into a
-    standardized table.
+    This method takes cuffdiff output and converts each line into a
+    standardized :class:`Expression.GeneExpressionResult`.
 
     Arguments
     ---------
@@ -1442,8 +1615,6 @@ def parseCuffdiff(infile, min_fpkm=1.0):
         "status  value_1 value_2 l2fold  "
         "test_stat p_value q_value significant ")
 
-    results = []
-
     for line in IOTools.openFile(infile):
         if line.startswith("test_id"):
             continue
@@ -1459,7 +1630,7 @@ def parseCuffdiff(infile, min_fpkm=1.0):
         except OverflowError:
             fold = "na"
 
-        results.append(Expression.GeneExpressionResult._make((
+        yield Expression.GeneExpressionResult._make((
             data.test_id,
             data.sample_1,
             data.value_1,
@@ -1473,9 +1644,15 @@ def parseCuffdiff(infile, min_fpkm=1.0):
             fold,
             data.l2fold,
             significant,
-            status)))
+            status))
 
-    return results
+
+def parseCuffdiff(infile, min_fpkm=1.0):
+    '''parse a cuffdiff .diff output file.
+
+    Returns a list of results, see :func:`iterateCuffdiff`.
+    '''
+    return list(iterateCuffdiff(infile, min_fpkm=min_fpkm))
 
 
 def runCuffdiff(bamfiles,
@@ -1587,7 +1764,248 @@ def runCuffdiff(bamfiles,
 Utr = collections.namedtuple("Utr", "old new max status")
 
 
-def buildUTRExtension(infile, outfile):
+def readReadExtension(filename):
+    '''read a read extension table.
+
+    Returns
+    -------
+    genes : numpy.array
+        Gene identifiers.
+    utrs : numpy.array
+        Length of known UTR.
+    observations : numpy.array
+        Matrix of read counts with one row per gene, starting with
+        the terminal exon followed by the bins in the gene territory.
+        Missing values are NaN.
+    '''
+    df = pd.read_csv(filename, sep="\t", index_col=0)
+    return (df.index.values.astype(str),
+            df["utr"].values,
+            df.iloc[:, 2:].values.astype(np.float64))
+
+
+def fitBeta(data):
+    '''return maximum likelihood estimates of the shape parameters of
+    a beta distribution fitted to *data*.
+
+    Values of 0 and 1 are moved inside the unit interval.
+    '''
+    data = np.array(data, dtype=np.float64)
+    data[data == 0] += 0.001
+    data[data == 1] -= 0.001
+    a, b, loc, scale = scipy.stats.beta.fit(data, 0.5, 0.5,
+                                            floc=0, fscale=1)
+    return a, b
+
+
+def estimateUTRModel(utrs, observations, binsize, territory_size):
+    '''estimate transition counts and collect emission values of the
+    UTR model from genes with known UTRs.
+
+    Only genes with a complete territory (no missing values), some
+    reads and an expressed terminal exon are used. Counts are log
+    transformed and scaled by the maximum of each gene.
+
+    Returns
+    -------
+    transitions : numpy.array
+        3x3 matrix of transition probabilities.
+    emissions : list
+        Scaled counts within UTRs, outside UTRs and for peaks in
+        other transcripts.
+    '''
+
+    # take only those with a 'complete' territory
+    complete = ~(np.isnan(observations).any(axis=1) | np.isnan(utrs))
+    # remove those which are completely empty
+    complete &= (np.nan_to_num(observations) != 0).any(axis=1)
+    utrs = utrs[complete].astype(np.int64)
+    lraw = np.log10(observations[complete] + 1)
+    scaled = lraw / lraw.max(axis=1)[:, np.newaxis]
+
+    # only consider genes with expression coverage
+    # note: expression level is logscaled here, 10^1 = 10
+    expressed = lraw[:, 0] >= 0.1
+    utrs, scaled = utrs[expressed], scaled[expressed]
+
+    E.debug("estimation: utrs=%i, vals=%s" % (len(utrs), str(scaled.shape)))
+
+    utr_bins = utrs // binsize
+    nonutr_bins = (territory_size - utrs) // binsize
+
+    # number of transitions between states
+    transitions = np.zeros((3, 3), np.float64)
+    transitions[0][0] = utr_bins.sum()
+    transitions[0][1] = len(utrs)
+    transitions[1][1] = nonutr_bins.sum()
+    # 5% chance of transiting to otherTranscript
+    transitions[1][2] = int(transitions[1][1] * 0.05)
+    # 10% chance of remaining in otherTranscript
+    transitions[2][1] = 900
+    transitions[2][2] = 100
+    transitions /= transitions.sum(axis=1)[:, np.newaxis]
+
+    bins = np.arange(scaled.shape[1])[np.newaxis, :]
+    in_utr = bins < utr_bins[:, np.newaxis]
+
+    # ignore exon and zero counts
+    within_utr = scaled[in_utr & (bins >= 1) & (scaled > 0.1)]
+    outside_utr = scaled[~in_utr & (scaled <= 0.5)]
+    # add only high counts to otherTranscript emissions
+    other_transcript = scaled[~in_utr & (scaled > 0.5)]
+
+    E.info("counting: (n,mean): within utr=%i,%f, "
+           "outside utr=%i,%f, otherTranscript=%i,%f" %
+           (len(within_utr), np.mean(within_utr),
+            len(outside_utr), np.mean(outside_utr),
+            len(other_transcript), np.mean(other_transcript)))
+
+    return transitions, [within_utr, outside_utr, other_transcript]
+
+
+def viterbiBeta(observations, transitions, shape1, shape2, start):
+    '''compute the most likely state sequences for a batch of
+    observation sequences in an HMM with beta distributed emissions.
+
+    Arguments
+    ---------
+    observations : numpy.array
+        Matrix with one observation sequence per row. Shorter
+        sequences are padded with NaN at the end.
+    transitions : numpy.array
+        Matrix of transition probabilities.
+    shape1 : numpy.array
+        First shape parameter of the emission distribution of each state.
+    shape2 : numpy.array
+        Second shape parameter of the emission distribution of each state.
+    start : numpy.array
+        Initial state probabilities.
+
+    Returns
+    -------
+    states : numpy.array
+        Matrix of state indices, -1 for padded positions.
+    '''
+
+    nseqs, length = observations.shape
+    nstates = len(start)
+    valid = ~np.isnan(observations)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_transitions = np.log(transitions)
+        log_emissions = scipy.stats.beta.logpdf(
+            np.nan_to_num(observations)[:, :, np.newaxis],
+            np.asarray(shape1)[np.newaxis, np.newaxis, :],
+            np.asarray(shape2)[np.newaxis, np.newaxis, :])
+        delta = np.log(start)[np.newaxis, :] + log_emissions[:, 0]
+
+    # padded positions keep their state
+    identity = np.arange(nstates)
+    backpointers = np.empty((length, nseqs, nstates), dtype=np.int8)
+    backpointers[0] = identity
+
+    for x in range(1, length):
+        scores = delta[:, :, np.newaxis] + log_transitions[np.newaxis]
+        best = scores.argmax(axis=1)
+        new_delta = np.take_along_axis(
+            scores, best[:, np.newaxis, :], axis=1)[:, 0, :] + \
+            log_emissions[:, x]
+        v = valid[:, x]
+        delta[v] = new_delta[v]
+        best[~v] = identity
+        backpointers[x] = best
+
+    states = np.empty((nseqs, length), dtype=np.int64)
+    state = delta.argmax(axis=1)
+    rows = np.arange(nseqs)
+    for x in range(length - 1, -1, -1):
+        states[:, x] = state
+        state = backpointers[x, rows, state]
+
+    states[~valid] = -1
+    return states
+
+
+def decodeUTRExtension(genes, utrs, observations, transitions,
+                       shape1, shape2, binsize):
+    '''predict UTR extensions of *genes* with the UTR model.
+
+    See :func:`buildUTRExtension`.
+
+    Returns
+    -------
+    utrs : dict
+        Mapping gene identifiers to :class:`Utr` tuples.
+    counter : Counter
+        Counts of prediction outcomes.
+    '''
+
+    counter = E.Counter()
+    new_utrs = {}
+    counter.input += len(genes)
+
+    # do not predict if terminal exon not expressed
+    expressed = ~(observations[:, 0] < 1)
+
+    # remove missing values
+    order = np.argsort(np.isnan(observations), axis=1, kind="mergesort")
+    observations = np.take_along_axis(observations, order, axis=1)
+    lengths = (~np.isnan(observations)).sum(axis=1)
+    with np.errstate(invalid="ignore"):
+        maxima = np.nanmax(np.where(lengths[:, np.newaxis] > 0,
+                                    observations, 0), axis=1)
+
+    observed = expressed & (lengths > 1) & (maxima > 0)
+
+    for x in np.flatnonzero(~expressed):
+        counter.skipped_notexpressed += 1
+        new_utrs[genes[x]] = Utr._make(
+            (utrs[x], None, None, "notexpressed"))
+
+    for x in np.flatnonzero(expressed & ~observed):
+        new_utrs[genes[x]] = Utr._make(
+            (utrs[x], None, None, "no observations"))
+
+    index = np.flatnonzero(observed)
+    if len(index) == 0:
+        return new_utrs, counter
+
+    # normalize and add small epsilon to 0 and 1 values
+    obs = observations[index] / maxima[index, np.newaxis]
+    obs[obs == 0] += 0.001
+    obs[obs == 1] -= 0.001
+
+    states = viterbiBeta(obs, transitions, shape1, shape2,
+                         np.array([1.0, 0.0, 0.0]))
+
+    # first position in state notUTR
+    not_utr = states == 1
+    has_end = not_utr.any(axis=1)
+    first = not_utr.argmax(axis=1)
+
+    for x, gene_index in enumerate(index):
+        gene_id = genes[gene_index]
+        max_utr = binsize * (lengths[gene_index] - 1)
+        if has_end[x]:
+            # subtract 1 for last exon
+            new_utrs[gene_id] = Utr._make(
+                (utrs[gene_index], binsize * (first[x] - 1), max_utr, "ok"))
+            counter.success += 1
+        else:
+            new_utrs[gene_id] = Utr._make(
+                (utrs[gene_index], max_utr, max_utr, "max"))
+            counter.maxutr += 1
+
+    return new_utrs, counter
+
+
+def _decodeUTRExtension(args):
+    '''worker function for :func:`buildUTRExtension`.'''
+    direction = args[0]
+    return (direction,) + decodeUTRExtension(*args[1:])
+
+
+def buildUTRExtension(infile, outfile, threads=1):
     '''build new utrs by building and fitting an HMM
     to reads upstream and downstream of known genes.
 
@@ -1651,12 +2069,24 @@ def buildUTRExtension(infile, outfile):
        * better model, as highly expressed genes should give more
          confident predictions.
 
+    Implementation
+
+    Parameters are estimated with numpy (:func:`estimateUTRModel`,
+    :func:`fitBeta`) and the most likely state sequences of all
+    genes on a contig are computed together
+    (:func:`viterbiBeta`). Contigs of the upstream and downstream
+    territories are decoded in parallel.
+
     Arguments
     ---------
     infile : string
         Output of :func:`buildGeneLevelReadExtension`
     outfile : string
         Output filename
+    threads : int
+        Number of threads to use for decoding. Threads are used as
+        this function may run within ruffus jobs, which may not
+        start child processes.
 
     '''
 
@@ -1679,122 +2109,31 @@ def buildUTRExtension(infile, outfile):
     outdir = os.path.join(PARAMS["exportdir"], "utr_extension")
 
     R('''suppressMessages(library(RColorBrewer))''')
-    R('''suppressMessages(library(MASS))''')
-    R('''suppressMessages(library(HiddenMarkov))''')
 
     # for upstream, downstream
     upstream_utrs, downstream_utrs = {}, {}
 
     all_genes = set()
+    tasks = []
 
-    for filename, new_utrs in zip(infiles, (upstream_utrs, downstream_utrs)):
+    for direction, filename in enumerate(infiles):
 
         E.info("processing %s" % filename)
 
         parts = os.path.basename(filename).split(".")
 
-        data = R(
-            '''data = read.table(gzfile( "%(filename)s"), header=TRUE,
-            fill=TRUE, row.names=1)''' % locals())
+        genes, utrs, observations = readReadExtension(filename)
+        all_genes.update(genes)
 
-        ##########################################
-        ##########################################
-        ##########################################
-        # estimation
-        ##########################################
-        # take only those with a 'complete' territory
-        R('''d = data[-which( apply( data,1,function(x)any(is.na(x)))),]''')
-        # save UTR
-        R('''utrs = d$utr''')
-        # remove length and utr column
-        R('''d = d[-c(1,2)]''')
-        # remove those which are completely empty, logtransform or scale data
-        # and export
-        R('''lraw = log10(
-        d[-which(apply(d, 1, function(x)all(x==0))),] + 1)''')
-
-        utrs = R('''utrs = utrs[-which( apply(d,1,function(x)all(x==0)))]''')
-        scaled = R(
-            '''lscaled = t(scale(t(lraw), center=FALSE,
-            scale=apply(lraw,1,max)))''')
-        exons = R('''lraw[,1]''')
-
-        #######################################################
-        #######################################################
         #######################################################
         # do the estimation:
-        E.debug("estimation: utrs=%i, exons=%i, vals=%i, dim=%s" %
-                (len(utrs), len(exons), len(scaled), R.dim(scaled)))
-        # counts within and outside UTRs
-        within_utr, outside_utr, otherTranscript = [], [], []
-        # number of transitions between utrs
-        transitions = np.zeros((3, 3), np.int)
-
-        for x in xrange(len(utrs)):
-            utr, exon = utrs[x], exons[x]
-
-            # only consider genes with expression coverage
-            # note: expression level is logscaled here, 10^1 = 10
-            if exon < 0.1:
-                continue
-
-            # first row is column names, so x + 1
-            values = list(scaled.rx(x + 1, True))
-
-            utr_bins = utr // binsize
-            nonutr_bins = (territory_size - utr) // binsize
-
-            # build transition matrix
-            transitions[0][0] += utr_bins
-            transitions[0][1] += 1
-            transitions[1][1] += nonutr_bins
-
-            outside_utr.extend([x for x in values[utr_bins:] if x <= 0.5])
-
-            # ignore exon and zero counts
-            within_utr.extend([x for x in values[1:utr_bins] if x > 0.1])
-
-            # add only high counts to otherTranscript emissions
-            otherTranscript.extend([x for x in values[utr_bins:] if x > 0.5])
-
-        # estimation for
-        # 5% chance of transiting to otherTranscript
-        transitions[1][2] = transitions[1][1] * 0.05
-        # 10% chance of remaining in otherTranscript
-        transitions[2][1] = 900
-        transitions[2][2] = 100
-
-        E.info("counting: (n,mean): within utr=%i,%f, "
-               "outside utr=%i,%f, otherTranscript=%i,%f" %
-               (len(within_utr), np.mean(within_utr),
-                len(outside_utr), np.mean(outside_utr),
-                len(otherTranscript), np.mean(otherTranscript)))
-
-        ro.globalenv['transitions'] = R.matrix(transitions, nrow=3, ncol=3)
-        R('''transitions = transitions / rowSums( transitions )''')
-        ro.globalenv['within_utr'] = ro.FloatVector(within_utr[:10000])
-        ro.globalenv['outside_utr'] = ro.FloatVector(outside_utr[:10000])
-        ro.globalenv['otherTranscript'] = ro.FloatVector(
-            otherTranscript[:10000])
+        transitions, emissions = estimateUTRModel(
+            utrs, observations, binsize, territory_size)
 
         # estimate beta distribution parameters
-        R('''doFit = function( data ) {
-                   data[data == 0] = data[data == 0] + 0.001
-                   data[data == 1] = data[data == 1] - 0.001
-                   f = fitdistr( data, dbeta, list( shape1=0.5, shape2=0.5 ) )
-                   return (f) }''')
-
-        fit_within_utr = R(
-            '''fit_within_utr = suppressMessages(doFit( within_utr))''')
-        fit_outside_utr = R(
-            '''fit_outside_utr = suppressMessages(doFit( outside_utr))''')
-        fit_other = R(
-            '''fit_otherTranscript = suppressMessages(
-            doFit(otherTranscript))''')
-
-        within_a, within_b = list(fit_within_utr.rx("estimate"))[0]
-        outside_a, outside_b = list(fit_outside_utr.rx("estimate"))[0]
-        other_a, other_b = list(fit_other.rx("estimate"))[0]
+        fits = [fitBeta(x[:10000]) for x in emissions]
+        (within_a, within_b), (outside_a, outside_b), (other_a, other_b) = \
+            fits
 
         E.info("beta estimates: within_utr=%f,%f outside=%f,%f, other=%f,%f" %
                (within_a, within_b, outside_a, outside_b, other_a, other_b))
@@ -1805,103 +2144,48 @@ def buildUTRExtension(infile, outfile):
 
         R('''par(mfrow=c(3,1))''')
         R('''x=seq(0,1,0.02)''')
-        R('''hist( within_utr, 50, col=rgb( 0,0,1,0.2) )''')
-        R('''par(new=TRUE)''')
-        R('''plot(x, dbeta(x, fit_within_utr$estimate['shape1'],
-        fit_within_utr$estimate['shape2']), type='l', col='blue')''')
-
-        R('''hist( outside_utr, 50, col=rgb( 1,0,0,0.2 ) )''')
-        R('''par(new=TRUE)''')
-        R('''plot( x, dbeta( x, fit_outside_utr$estimate['shape1'],
-        fit_outside_utr$estimate['shape2']), type='l', col='red')''')
-
-        R('''hist( otherTranscript, 50, col=rgb( 0,1,0,0.2 ) )''')
-        R('''par(new=TRUE)''')
-        R('''plot( x, dbeta( x, fit_otherTranscript$estimate['shape1'],
-        fit_otherTranscript$estimate['shape2']), type='l', col='green')''')
+        for values, (a, b), colour in zip(emissions, fits,
+                                          ("0,0,1", "1,0,0", "0,1,0")):
+            ro.globalenv['values'] = ro.FloatVector(values[:10000])
+            R('''hist( values, 50, col=rgb( %(colour)s,0.2) )''' %
+              locals())
+            R('''par(new=TRUE)''')
+            R('''plot(x, dbeta(x, %(a)f, %(b)f), type='l',
+            col=rgb(%(colour)s))''' % locals())
         R['dev.off']()
 
-        #####################################################
-        #####################################################
         #####################################################
         # build hmm
-        # state 1 = UTR
-        # state 2 = notUTR
-        # state 3 = other transcript
-        p = R('''betaparams = list( shape1=c(fit_within_utr$estimate['shape1'],
-        fit_outside_utr$estimate['shape1'],
-        fit_otherTranscript$estimate['shape1']),
-        shape2=c(fit_within_utr$estimate['shape2'],
-        fit_outside_utr$estimate['shape2'],
-        fit_otherTranscript$estimate['shape2'])) ''')
-        R('''hmm = dthmm(NULL, transitions, c(1,0,0), "beta", betaparams )''')
-
-        E.info("fitting starts")
-        #####################################################
-        #####################################################
-        #####################################################
-        # fit to every sequence
-        genes = R('''rownames(data)''')
-        all_genes.update(set(genes))
-        utrs = R('''data$utr''')
-        exons = R('''data$exon''')
-        nseqs = len(utrs)
-
-        counter = E.Counter()
-
-        for idx in xrange(len(utrs)):
-
-            gene_id = genes[idx]
-
-            old_utr = utrs[idx]
-
-            if idx % 100 == 0:
-                E.debug("processing gene %i/%i" % (idx, len(utrs)))
-
-            counter.input += 1
-
-            # do not predict if terminal exon not expressed
-            if exons[idx] < 1:
-                counter.skipped_notexpressed += 1
-                new_utrs[gene_id] = Utr._make(
-                    (old_utr, None, None, "notexpressed"))
-                continue
-
-            R('''obs = data[%i,][-c(1,2)]''' % (idx + 1))
-            # remove na
-            obs = R('''obs = obs[!is.na(obs)]''')
-            if len(obs) <= 1 or max(obs) == 0:
-                new_utrs[gene_id] = Utr._make(
-                    (old_utr, None, None, "no observations"))
-                continue
-
-            # normalize
-            R('''obs = obs / max(obs)''')
-            # add small epsilon to 0 and 1 values
-            R('''obs[obs==0] = obs[obs==0] + 0.001 ''')
-            R('''obs[obs==1] = obs[obs==1] - 0.001 ''')
-            R('''hmm$x = obs''')
-
-            states = None
-            try:
-                states = list(R('''states = Viterbi( hmm )'''))
-            except ri.RRuntimeError, msg:
-                counter.skipped_error += 1
-                new_utrs[gene_id] = Utr._make((old_utr, None, None, "fail"))
-                continue
-
-            max_utr = binsize * (len(states) - 1)
+        # state 0 = UTR
+        # state 1 = notUTR
+        # state 2 = other transcript
+        shape1 = np.array([x[0] for x in fits])
+        shape2 = np.array([x[1] for x in fits])
+
+        # decode all genes on a contig together
+        contigs = np.array([geneinfos.get(x, ("",))[0] for x in genes])
+        for contig in np.unique(contigs):
+            index = np.flatnonzero(contigs == contig)
+            tasks.append((direction, genes[index], utrs[index],
+                          observations[index], transitions,
+                          shape1, shape2, binsize))
+
+    E.info("fitting starts")
+
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(_decodeUTRExtension, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = list(map(_decodeUTRExtension, tasks))
 
-            # subtract 1 for last exon
-            try:
-                new_utr = binsize * (states.index(2) - 1)
-                new_utrs[gene_id] = Utr._make(
-                    (old_utr, new_utr, max_utr, "ok"))
-                counter.success += 1
-            except ValueError:
-                new_utrs[gene_id] = Utr._make(
-                    (old_utr, max_utr, max_utr, "max"))
-                counter.maxutr += 1
+    counter = E.Counter()
+    for direction, new_utrs, c in results:
+        (upstream_utrs, downstream_utrs)[direction].update(new_utrs)
+        counter += c
 
     E.info("fitting: %s" % str(counter))
 
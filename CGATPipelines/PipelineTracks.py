@@ -225,6 +225,17 @@ The above code makes sure that the file dependencies are
 observed. Thus, if ``heart-stimulated-R1.fastq.gz`` changes, only
 ``heart-stimulated-agg.out`` will be re-computed.
 
+Caching tracks
+++++++++++++++
+
+Pipelines define their tracks at module level, so tracks are
+discovered every time a pipeline is imported. Tracks that are
+expensive to discover, for example the samples in a :term:`vcf`
+file, can be cached with :meth:`Tracks.loadCached`. The cache is
+stored in the file :file:`.tracks.cache` in the working directory
+and is keyed by the names, modification times and sizes of the files
+the tracks were derived from.
+
 Tracks and aggregates can be used within a task. The following code
 will collect all replicates for the experiment
 ``liver-stimulated-agg``
@@ -242,6 +253,8 @@ Reference
 import re
 import collections
 import copy
+import hashlib
+import json
 import os
 
 # '-' as separator
@@ -255,6 +268,9 @@ TABLE_SEPARATOR = "_"
 
 AGGREGATE_PLACEHOLDER = "agg"
 
+# file in working directory to cache track names
+TRACKS_CACHE = ".tracks.cache"
+
 
 def to_aggregate(x):
     if x:
@@ -528,6 +544,67 @@ class Aggregate:
         return iter(self.track2groups.items())
 
 
+def getCachedTrackNames(label, filenames, loader, cachefile=TRACKS_CACHE):
+    '''return track names derived from *filenames*, using a cache.
+
+    The cache is keyed by the names, modification times and sizes of
+    *filenames*. If the cache is out of date, the track names are
+    obtained by calling *loader* and saved in the cache under *label*.
+
+    Arguments
+    ---------
+    label : string
+        Identifier of the tracks in the cache.
+    filenames : list
+        Files from which the tracks are derived.
+    loader : function
+        Function returning a list of track names.
+    cachefile : string
+        Filename of the cache.
+
+    Returns
+    -------
+    names : list
+        List of track names.
+    '''
+
+    key = hashlib.md5()
+    for fn in sorted(filenames):
+        try:
+            st = os.stat(fn)
+            key.update(("%s\t%r\t%i\n" % (
+                os.path.abspath(fn), st.st_mtime, st.st_size)).encode())
+        except OSError:
+            key.update(("%s\tmissing\n" % os.path.abspath(fn)).encode())
+    key = key.hexdigest()
+
+    cache = {}
+    if os.path.exists(cachefile):
+        try:
+            with open(cachefile) as inf:
+                cache = json.load(inf)
+        except (IOError, ValueError):
+            cache = {}
+
+    if label in cache and cache[label]["key"] == key:
+        return cache[label]["tracks"]
+
+    names = list(loader())
+    cache[label] = {"key": key, "tracks": names}
+
+    # write to a temporary file first as several processes
+    # might update the cache at the same time
+    tmpfile = "%s.%i" % (cachefile, os.getpid())
+    try:
+        with open(tmpfile, "w") as outf:
+            json.dump(cache, outf)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError):
+        pass
+
+    return names
+
+
 class Tracks:
 
     '''a collection of tracks.'''
@@ -542,6 +619,19 @@ class Tracks:
         self.factory = factory
         self.tracks = []
 
+    def loadCached(self, loader, filenames, label=None):
+        '''load tracks by calling *loader*, a function returning a
+        list of track names.
+
+        The track names are cached under *label* and *loader* is only
+        called if any of *filenames* has changed, see
+        :func:`getCachedTrackNames`.
+        '''
+        names = getCachedTrackNames(label or loader.__name__,
+                                    filenames, loader)
+        self.tracks = [self.factory(filename=x) for x in names]
+        return self
+
     def loadFromDirectory(self, files, pattern, exclude=None):
         '''load tracks from a list of files, applying pattern.
 
@@ -13,6 +13,10 @@ The functions :func:`getRepeatsFromUCSC`, :func:`getRefseqFromUCSC` and
 :func:`getCpGIslandsFromUCSC` import various data sets and save them
 in standard genomic file formats.
 
+The function :func:`buildMapableRegions` converts a UCSC mapability
+track in :term:`bigwig` format into a :term:`bed` file of mapable
+regions.
+
 UCSC track hubs
 ---------------
 
@@ -28,13 +32,17 @@ Reference
 # for UCSC import
 import os
 import collections
+import multiprocessing
+import numpy
 import MySQLdb
+from bx.bbi.bigwig_file import BigWigFile
 import CGAT.Experiment as E
 import CGAT.GTF as GTF
 import CGAT.IOTools as IOTools
 
 
 import CGATPipelines.Pipeline as P
+from CGATPipelines.Pipeline import cluster_runnable
 
 
 def connectToUCSC(host="genome-mysql.cse.ucsc.edu",
@@ -412,3 +420,132 @@ def writeTrackFile(outfile, tracks):
         for key, value in trackdata:
             outfile.write(" ".join((key, value)) + "\n")
         outfile.write("\n")
+
+
+def getMapableRegions(infile, contig, size,
+                      min_score=0.5,
+                      max_distance=0,
+                      window_size=10000000):
+    '''return mapable regions on a contig in a :term:`bigwig` file.
+
+    Values are read window-wise as arrays. Runs of positions with a
+    score of at least `min_score` are located by the boundaries of a
+    boolean mask. Positions without data count as un-mapable. Regions
+    that are less than `max_distance` apart are merged.
+
+    Arguments
+    ---------
+    infile : string
+        Filename in :term:`bigwig` format with mapability scores.
+    contig : string
+        Contig to examine.
+    size : int
+        Size of contig.
+    min_score : float
+        Minimum mapability score for a position to be mapable.
+    max_distance : int
+        Merge regions separated by less than `max_distance` bases.
+    window_size : int
+        Number of positions to read from `infile` at a time.
+
+    Returns
+    -------
+    starts : numpy.array
+        Start coordinates of mapable regions.
+    ends : numpy.array
+        End coordinates of mapable regions.
+    '''
+
+    bw = BigWigFile(file=open(infile, "rb"))
+
+    starts, ends = [], []
+    for window_start in range(0, size, window_size):
+        window_end = min(size, window_start + window_size)
+        values = bw.get_as_array(contig, window_start, window_end)
+        if values is None:
+            continue
+
+        # comparisons with NaN (no data) are False
+        with numpy.errstate(invalid="ignore"):
+            mapable = (values >= min_score).astype(numpy.int8)
+
+        edges = numpy.diff(numpy.concatenate(([0], mapable, [0])))
+        starts.append(numpy.flatnonzero(edges == 1) + window_start)
+        ends.append(numpy.flatnonzero(edges == -1) + window_start)
+
+    if not starts:
+        return numpy.array([], dtype=numpy.int64), \
+            numpy.array([], dtype=numpy.int64)
+
+    starts = numpy.concatenate(starts)
+    ends = numpy.concatenate(ends)
+
+    # merge neighbouring regions. Regions split at window boundaries
+    # have a gap of 0 and are always merged.
+    keep = (starts[1:] - ends[:-1]) >= max(1, max_distance)
+    starts = starts[numpy.concatenate(([True], keep))]
+    ends = ends[numpy.concatenate((keep, [True]))]
+
+    return starts, ends
+
+
+def _getMapableRegions(args):
+    '''helper function for :func:`buildMapableRegions` to
+    unpack arguments in a worker process.'''
+    infile, contig, size, min_score, max_distance = args
+    return (contig,) + getMapableRegions(infile, contig, size,
+                                         min_score=min_score,
+                                         max_distance=max_distance)
+
+
+@cluster_runnable
+def buildMapableRegions(infile, outfile, contigs,
+                        min_score=0.5,
+                        max_distance=0,
+                        threads=1):
+    '''build a :term:`bed` file with mapable regions from a
+    :term:`bigwig` file with mapability scores.
+
+    Contigs are processed in parallel by a pool of `threads` worker
+    processes. Regions are output in the order of `contigs`. As
+    child processes can not be started from within a ruffus job,
+    call this function with ``submit=True`` and `job_threads` set
+    to `threads` from a pipeline.
+
+    Arguments
+    ---------
+    infile : string
+        Filename in :term:`bigwig` format with mapability scores.
+    outfile : string
+        Output filename in :term:`bed` format.
+    contigs : dict
+        Dictionary of contig sizes.
+    min_score : float
+        Minimum mapability score for a position to be mapable.
+    max_distance : int
+        Merge regions separated by less than `max_distance` bases.
+    threads : int
+        Number of worker processes.
+    '''
+
+    args = [(infile, contig, size, min_score, max_distance)
+            for contig, size in contigs.items()]
+
+    if threads > 1:
+        pool = multiprocessing.Pool(processes=threads)
+        results = pool.imap(_getMapableRegions, args)
+    else:
+        pool = None
+        results = map(_getMapableRegions, args)
+
+    try:
+        with IOTools.openFile(outfile, "w") as outf:
+            for contig, starts, ends in results:
+                E.debug("%s: %i mapable regions" % (contig, len(starts)))
+                outf.write("".join(
+                    ["%s\t%i\t%i\n" % (contig, start, end)
+                     for start, end in zip(starts, ends)]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -571,7 +571,6 @@ import pandas as pd
 from ruffus import follows, transform, merge, mkdir, files, jobs_limit,\
     suffix, regex, add_inputs
 
-from bx.bbi.bigwig_file import BigWigFile
 import sqlite3
 import CGAT.Experiment as E
 import CGATPipelines.Pipeline as P
@@ -1862,12 +1861,19 @@ def buildMapableRegions(infiles, outfile):
       of the ENCODE project, in the framework of the GEM (GEnome
       Multitool) project.
 
+    Contigs are processed in parallel in a job submitted to the
+    cluster, see :func:`PipelineUCSC.buildMapableRegions`.
+
     Arguments
     ---------
     infiles : list
        Filenames in :term:`bigwig` format with mapable data.
     outfile : string
        Output filename in :term:`bed` format with mapable regions.
+    ucsc_min_mappability : float
+       see :term:`PARAMS`
+    mapability_threads : int
+       see :term:`PARAMS`
 
     '''
 
@@ -1879,55 +1885,15 @@ def buildMapableRegions(infiles, outfile):
 
     E.info("creating mapable regions bed files for kmer size of %i" % kmersize)
 
-    max_distance = kmersize // 2
-
-    f = open(infile)
-    bw = BigWigFile(file=f)
-
-    def _iter_mapable_regions(bw, contig, size):
-
-        min_score = PARAMS["ucsc_min_mappability"]
-
-        # there is no iterator access, results are returned as list
-        # thus proceed window-wise in 10Mb windows
-        window_size = 10000000
-        last_start, start = None, None
-
-        for window_start in range(0, size, window_size):
-            values = bw.get(contig, window_start, window_start + window_size)
-            if values is None:
-                continue
-
-            for this_start, this_end, value in values:
-                if value < min_score:
-                    if start:
-                        yield start, this_start
-                    start = None
-                else:
-                    if start is None:
-                        start = this_start
-
-        if start is not None:
-            yield start, this_end
-
-    outf = IOTools.openFile(outfile, "w")
-
-    for contig, size in contigs.items():
-
-        last_start, last_end = None, None
-        for start, end in _iter_mapable_regions(bw, contig, size):
-            if last_start is None:
-                last_start, last_end = start, end
-            if start - last_end >= max_distance:
-                outf.write("%s\t%i\t%i\n" % (contig, last_start, last_end))
-                last_start = start
-
-            last_end = end
-
-        if last_start is not None:
-            outf.write("%s\t%i\t%i\n" % (contig, last_start, last_end))
-
-    outf.close()
+    PipelineUCSC.buildMapableRegions(
+        infile=infile,
+        outfile=outfile,
+        contigs=contigs,
+        min_score=PARAMS["ucsc_min_mappability"],
+        max_distance=kmersize // 2,
+        threads=PARAMS["mapability_threads"],
+        submit=True,
+        job_threads=PARAMS["mapability_threads"])
 
 
 @transform(buildMapableRegions, suffix(".bed.gz"),
@@ -1050,8 +1050,9 @@ def makeAnnotationsTables(infiles, outfile):
 HAPMAP = "%s/*txt.gz" % PARAMS['hapmap_loc']
 
 
-@merge(HAPMAP, ["snpdict.json",
-                "randomsnps.tsv"])
+@merge(HAPMAP, ["snpfreqs.npy",
+                "randomsnps.tsv",
+                "ancestries.tsv"])
 def makeRandomSNPSet(infiles, outfiles):
     '''
     Generates a random set of SNPs to use to characterise the ancestry
@@ -1060,19 +1061,12 @@ def makeRandomSNPSet(infiles, outfiles):
     1. Finds all SNPs which have a known genotype frequency for all 11
        hapmap ancestries
     2. Picks a random 50000 of these SNPs
-    3. Stores a list of these SNPs as randomsnps.tsv
-    4. Builds a dictionary of dictionaries of dictionaries where:
-           At Level 1 each key is a HapMap ancestry ID
-               each of these keys leads to another dictionary - level 2.
-           At Level 2 each key is a dbSNP SNP ID
-               each of these keys leads to another dictionary - level 3.
-           At Level 3 each key is a genotype:
-               the values of these keys are the genotype frequency of this
-               genotype at this SNP in this ancestry.
-       e.g. snpdict['ASW']['rs000000001']['CT'] -->
-            frequency of the CT genotype at the rs0000001 SNP in the
-            ASW population
-    5.  Stores this dictionary in json format as randomsnps.json
+    3. Stores a list of these SNPs as randomsnps.tsv and the list of
+       ancestries as ancestries.tsv
+    4. Builds a SNP x ancestry x genotype matrix of genotype frequencies
+       and stores it in numpy format as snpfreqs.npy
+
+    See :func:`PipelineExomeAncestry.MakeSNPFreqDict`.
     '''
     rs = PARAMS['general_randomseed']
     PipelineExomeAncestry.MakeSNPFreqDict(infiles, outfiles, rs, submit=True)
@@ -1134,8 +1128,8 @@ def calculateAncestry(infiles, outfiles):
     each other - to show which of the 11 ancestries is most probable.
     '''
     calledsnps = infiles[1]
-    snpdict = infiles[2][0]
-    PipelineExomeAncestry.CalculateAncestry(infiles[0], calledsnps, snpdict,
+    snpfreqs = infiles[2]
+    PipelineExomeAncestry.CalculateAncestry(infiles[0], calledsnps, snpfreqs,
                                             outfiles, submit=True)
 
 
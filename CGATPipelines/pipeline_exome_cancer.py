@@ -1146,11 +1146,22 @@ def loadNCG(outfile):
 
 @merge(filterMutect,
        ["variants/mutational_signature.tsv",
-        "variants/mutational_signature_table.tsv"])
+        "variants/mutational_signature_table.tsv",
+        "variants/mutational_signature_context.tsv"])
 def mutationalSignature(infiles, outfiles):
+    '''count substitutions per sample, on their own and in their
+    trinucleotide context.'''
+
+    genome = "%s/%s.fa" % (PARAMS["bwa_index_dir"],
+                           PARAMS["genome"])
 
     PipelineExome.compileMutationalSignature(
-        infiles, outfiles)
+        infiles=infiles,
+        outfiles=outfiles,
+        genome=genome,
+        threads=PARAMS["signature_threads"],
+        submit=True,
+        job_threads=PARAMS["signature_threads"])
 
 
 @transform(mutationalSignature,
@@ -1158,8 +1169,10 @@ def mutationalSignature(infiles, outfiles):
            ".load")
 def loadMutationalSignature(infiles, outfile):
     outfile2 = re.sub(".load", "_table.load", outfile)
+    outfile3 = re.sub(".load", "_context.load", outfile)
     P.load(infiles[0], outfile)
     P.load(infiles[1], outfile2)
+    P.load(infiles[2], outfile3)
 
 
 #########################################################################
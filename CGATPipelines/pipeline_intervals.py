@@ -171,7 +171,6 @@ import re
 import glob
 import os
 import sqlite3
-import pysam
 import numpy
 import xml.etree.ElementTree
 
@@ -406,6 +405,10 @@ def loadIntervals(infile, outfile):
        nprobes: number of reads in interval
        peakcenter: position with maximum number of reads in interval
        avgval: average coverage within interval
+
+    Reads are counted for all intervals at once with
+    :func:`PipelinePeakcalling.countPeaksInIntervals`, processing
+    contigs in parallel (``peakstats_threads``).
     '''
 
     tmpfile = P.getTempFile(".")
@@ -433,12 +436,9 @@ def loadIntervals(infile, outfile):
     else:
         E.info("%s: no bamfiles associated" % (track))
 
-    # open all bamfiles
-    samfiles = [pysam.Samfile(fn, "rb") for fn in bamfiles]
-
     c = E.Counter()
 
-    # count tags
+    beds = []
     for bed in Bed.iterator(IOTools.openFile(infile, "r")):
 
         c.input += 1
@@ -446,6 +446,28 @@ def loadIntervals(infile, outfile):
         if "name" not in bed:
             bed.name = c.input
 
+        beds.append(bed)
+
+    # count tags in all intervals at once
+    if bamfiles and beds:
+        stats = PipelinePeakcalling.countPeaksInIntervals(
+            [bed.contig for bed in beds],
+            [bed.start for bed in beds],
+            [bed.end for bed in beds],
+            bamfiles,
+            offsets,
+            threads=PARAMS["peakstats_threads"])
+    else:
+        stats = ([1] * len(beds),
+                 [bed.start + (bed.end - bed.start) // 2 for bed in beds],
+                 [bed.end - bed.start for bed in beds],
+                 [1] * len(beds),
+                 [1] * len(beds),
+                 [1] * len(beds))
+
+    for bed, npeaks, peakcenter, length, avgval, peakval, nprobes in zip(
+            beds, *stats):
+
         # The fifth field of a bed file can be used to supply a
         # score. Our iterator returns the optional fields as a "fields
         # array". The first of these is the interval name, and the
@@ -460,25 +482,8 @@ def loadIntervals(infile, outfile):
         else:
             score = 1
 
-        if samfiles:
-            npeaks, peakcenter, length, avgval, peakval, nprobes = \
-                PipelinePeakcalling.countPeaks(
-                    bed.contig,
-                    bed.start,
-                    bed.end,
-                    samfiles,
-                    offsets)
-            if nprobes == 0:
-                c.skipped_reads += 1
-
-        else:
-            npeaks, peakcenter, length, avgval, peakval, nprobes = \
-                (1,
-                 bed.start + (bed.end - bed.start) // 2,
-                 bed.end - bed.start,
-                 1,
-                 1,
-                 1)
+        if bamfiles and nprobes == 0:
+            c.skipped_reads += 1
 
         c.output += 1
         tmpfile.write("\t".join(map(
@@ -2520,33 +2520,35 @@ def buildBigWig(infile, outfile):
     outfile : str
        Output filename in :term:`bigwig` format
 
-    annotations_interface_contigs : str
+    bigwig_engine : str
        :term:`PARAMS`
-       Input filename in :term:`bed` format
-
-    '''
-
-    if SPLICED_MAPPING:
-        # use bedtools for RNASEQ data
-
-        # scale by Million reads mapped
-        reads_mapped = BamTools.getNumberOfAlignments(infile)
-        scale = 1000000.0 / float(reads_mapped)
-        tmpfile = P.getTempFilename()
-        contig_sizes = PARAMS["annotations_interface_contigs"]
-        job_memory = "3G"
-        statement = '''bedtools genomecov
-        -ibam %(infile)s
-        -g %(contig_sizes)s
-        -bg
-        -split
-        -scale %(scale)f
-        > %(tmpfile)s;
-        checkpoint;
-        bedGraphToBigWig %(tmpfile)s %(contig_sizes)s %(outfile)s;
-        checkpoint;
-        rm -f %(tmpfile)s
-        '''
+       ``native`` computes coverage with
+       :func:`PipelineMappingQC.buildBigWigFromBam`, ``bam2wiggle``
+       uses :doc:`cgat:scripts/bam2wiggle` with ``bigwig_options``.
+       ``bigwig_options`` are ignored by the native engine.
+
+    '''
+
+    if PARAMS["bigwig_engine"] == "native" or SPLICED_MAPPING:
+        if PARAMS["bigwig_options"]:
+            E.warn("bigwig_options '%s' are ignored when computing "
+                   "coverage with the native engine" %
+                   PARAMS["bigwig_options"])
+        if SPLICED_MAPPING:
+            # scale RNASEQ coverage by million reads mapped
+            reads_mapped = BamTools.getNumberOfAlignments(infile)
+            scale = 1000000.0 / float(reads_mapped)
+        else:
+            scale = 1.0
+
+        PipelineMappingQC.buildBigWigFromBam(
+            infile, outfile,
+            scale=scale,
+            split=SPLICED_MAPPING,
+            threads=PARAMS["bigwig_threads"],
+            submit=True,
+            job_threads=PARAMS["bigwig_threads"],
+            job_memory=PARAMS["bigwig_memory"])
     else:
         # wigToBigWig observed to use 16G
         job_memory = "16G"
@@ -2556,7 +2558,7 @@ def buildBigWig(infile, outfile):
         %(infile)s
         %(outfile)s
         > %(outfile)s.log'''
-    P.run()
+        P.run()
 
 
 @merge(buildBigWig,
@@ -2565,7 +2567,8 @@ def loadBigWigStats(infiles, outfile):
     '''merge and load bigwig summary for all wiggle files.
 
     Summarise and merge bigwig files for all samples and load into a
-    table called bigwig_stats
+    table called bigwig_stats. If ``bigwig_contig_stats`` is set,
+    per-contig summaries are loaded into bigwig_stats_per_contig.
 
     Parameters
     ----------
@@ -2575,29 +2578,10 @@ def loadBigWigStats(infiles, outfile):
         Output filename, the table name is derived from `outfile`.
     '''
 
-    data = " ".join(
-        ['<( bigWigInfo %s | perl -p -e "s/:/\\t/; s/ //g; s/,//g")' %
-         x for x in infiles])
-    headers = ",".join([P.snip(os.path.basename(x), ".bw")
-                        for x in infiles])
-
-    load_statement = P.build_load_statement(
-        P.toTable(outfile),
-        options="--add-index=track")
-
-    statement = '''cgat combine_tables
-    --header-names=%(headers)s
-    --skip-titles
-    --missing-value=0
-    --ignore-empty
-    %(data)s
-    | perl -p -e "s/bin/track/"
-    | cgat table2table --transpose
-    | %(load_statement)s
-    > %(outfile)s
-    '''
-
-    P.run()
+    PipelineMappingQC.loadBigWigStats(
+        infiles, outfile,
+        contigs=PARAMS["bigwig_contig_stats"],
+        threads=PARAMS["bigwig_threads"])
 
 
 @transform(MAPPINGTARGETS,
@@ -373,9 +373,9 @@ def exportMotifDiscoverySequences(infile, outfile):
     dbhandle = connect()
 
     p = P.substituteParameters(**locals())
-    nseq = PipelineMotifs.writeSequencesForIntervals(
+    nseq = PipelineMotifs.writeSequenceSetsForIntervals(
         track,
-        outfile,
+        {"foreground": outfile},
         dbhandle,
         full=False,
         masker=P.asList(
@@ -390,7 +390,7 @@ def exportMotifDiscoverySequences(infile, outfile):
             "motifs_min_sequences"],
         num_sequences=p[
             "motifs_num_sequences"],
-        order=p['motifs_score'])
+        order=p['motifs_score'])["foreground"]
 
     if nseq == 0:
         E.warn("%s: no sequences - meme skipped" % outfile)
@@ -472,8 +472,9 @@ def loadMemeSummary(infiles, outfile):
     os.unlink(outf.name)
 
 
-def suggestMotifDiscoveryForeground():
-    '''output bed files for motif discovery.
+def suggestMotifDiscoverySequences():
+    '''output foreground and background sequence files for motif
+    discovery.
     '''
 
     npeaks = [x.strip() for x in str(PARAMS["memechip_npeaks"]).split(",")]
@@ -489,40 +490,28 @@ def suggestMotifDiscoveryForeground():
             background = os.path.join(
                 "discovery.dir", ".".join(
                     [track, n, w, masker, "background", "fasta"]))
-            yield (track + "_intervals.load", foreground,
-                   int(n), int(w), masker)
-
-
-def suggestMotifDiscoveryBackground():
-    '''output bed files for motif discovery.
-    '''
-
-    npeaks = [x.strip() for x in str(PARAMS["memechip_npeaks"]).split(",")]
-    widths = [x.strip() for x in str(PARAMS["memechip_widths"]).split(",")]
-    maskers = [x.strip() for x in str(PARAMS["memechip_maskers"]).split(",")]
-
-    for infile in TRACKS_BEDFILES:
-        track = P.snip(os.path.basename(infile), ".bed.gz")
-        for n, w, masker in itertools.product(npeaks, widths, maskers):
-            background = os.path.join(
-                "discovery.dir", ".".join([track, n, w, masker,
-                                           "background", "fasta"]))
-            yield (track + "_intervals.load", background,
+            yield (track + "_intervals.load", [foreground, background],
                    int(n), int(w), masker)
 
 
 @follows(loadIntervals, mkdir("discovery.dir"))
-@files(suggestMotifDiscoveryForeground)
-def buildDiscoverySequences(infile, outfile, npeaks, width, masker):
-    '''get the peak sequences, masking or not specificed in the ini file.
+@files(suggestMotifDiscoverySequences)
+def buildDiscoverySequences(infile, outfiles, npeaks, width, masker):
+    '''get the peak sequences and the sequences left and right of
+    each peak as background, masking or not specificed in the ini
+    file.
+
+    Both sets are built from a single pass over the intervals.
     '''
 
     track = P.snip(infile, "_intervals.load")
     dbhandle = connect()
 
-    nseq = PipelineMotifs.writeSequencesForIntervals(
+    foreground, background = outfiles
+    nseqs = PipelineMotifs.writeSequenceSetsForIntervals(
         track,
-        outfile,
+        {"foreground": foreground,
+         "leftright": background},
         dbhandle,
         full=False,
         masker=[masker],
@@ -533,44 +522,20 @@ def buildDiscoverySequences(infile, outfile, npeaks, width, masker):
         num_sequences=npeaks,
         order='peakval')
 
-    if nseq == 0:
-        E.warn("%s: no sequences in foreground" % outfile)
-        P.touch(outfile)
+    if nseqs["foreground"] == 0:
+        E.warn("%s: no sequences in foreground" % foreground)
+        P.touch(foreground)
 
+    if nseqs["leftright"] == 0:
+        E.warn("%s: no sequences in background" % background)
 
-@follows(loadIntervals, mkdir("discovery.dir"))
-@files(suggestMotifDiscoveryBackground)
-def buildBackgroundSequences(infile, outfile, npeaks, width, masker):
-    '''get the peak sequences, masking or not specificed in the ini file.
-    '''
 
-    track = P.snip(infile, "_intervals.load")
-    dbhandle = connect()
-
-    nseq = PipelineMotifs.writeSequencesForIntervals(
-        track,
-        outfile,
-        dbhandle,
-        full=False,
-        masker=[masker],
-        halfwidth=width,
-        maxsize=int(
-            PARAMS["motifs_max_size"]),
-        proportion=None,
-        num_sequences=npeaks,
-        order='peakval',
-        shift="leftright")
-
-    if nseq == 0:
-        E.warn("%s: no sequences in background" % outfile_background)
-        # P.touch( outfile )
-
-
-@transform(buildBackgroundSequences,
-           suffix(".fasta"),
-           ".markov")
-def buildMemeBackgroundFiles(infile, outfile):
+@transform(buildDiscoverySequences,
+           regex("(.*).foreground.fasta"),
+           r"\1.background.markov")
+def buildMemeBackgroundFiles(infiles, outfile):
     '''prepare the meme background model'''
+    infile = infiles[1]
     statement = '''fasta-get-markov -m 2 %(infile)s  > %(outfile)s''' % locals()
     P.run()
 
@@ -606,9 +571,10 @@ def makeMemeMotifs(infile, outfile):
 
 
 @follows(mkdir("memechip.dir"))
-@collate((buildDiscoverySequences, buildMemeBackgroundFiles),
-         regex("discovery.dir/(.*).(foreground.fasta|background.markov)"),
-         r"memechip.dir/\1.memechip")
+@transform(buildMemeBackgroundFiles,
+           regex("discovery.dir/(.*).background.markov"),
+           add_inputs(r"discovery.dir/\1.foreground.fasta"),
+           r"memechip.dir/\1.memechip")
 def runMemeChip(infiles, outfile):
 
     background_markov, foreground_fasta = infiles
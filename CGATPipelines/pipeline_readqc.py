@@ -267,7 +267,8 @@ if PARAMS.get("preprocessors", None):
             save=PARAMS["save"],
             summarize=PARAMS["summarize"],
             threads=PARAMS["threads"],
-            qual_format=PARAMS['qual_format'])
+            qual_format=PARAMS['qual_format'],
+            stream=PARAMS["stream"])
 
         for tool in P.asList(PARAMS["preprocessors"]):
 
@@ -1476,7 +1476,8 @@ def getSleuthNormExp(infiles, outfiles, quantifier):
 
     PipelineRnaseq.getAlignmentFreeNormExp(
         transcript_infiles, basename, column,
-        transcripts_outf, genes_outf, t2gMap)
+        transcripts_outf, genes_outf, t2gMap,
+        threads=PARAMS["sleuth_merge_threads"])
 
 # Define the task for differential expression and normalisation
 DETARGETS = []
@@ -120,7 +120,6 @@ import itertools
 import CGAT.CSV as CSV
 import re
 import math
-import collections
 import numpy
 import sqlite3
 import CGAT.GTF as GTF
@@ -132,6 +131,7 @@ import CGAT.FastaIterator as FastaIterator
 import CGATPipelines.PipelineEnrichment as PEnrichment
 import CGATPipelines.PipelineUCSC as PipelineUCSC
 import scipy.stats
+import scipy.sparse
 import CGAT.Stats as Stats
 import pysam
 
@@ -180,32 +180,44 @@ SEPARATOR = "|"
 class TracksVCF (PipelineTracks.Tracks):
 
     def load(self, filename, exclude=None):
-        '''load tracks from a vcf file.'''
-        tracks = []
-        v = pysam.VCF()
-        v.setversion(40)
+        '''load tracks from a vcf file.
 
-        if not os.path.exists(filename):
-            self.tracks = tracks
-            return self
-        v.connect(filename)
+        The sample names are cached, so that the vcf file is only
+        read if it has changed, see
+        :func:`PipelineTracks.getCachedTrackNames`.
+        '''
+
+        def _load():
+            tracks = []
+            v = pysam.VCF()
+            v.setversion(40)
 
-        if exclude:
-            to_exclude = [re.compile(x) for x in exclude]
+            if not os.path.exists(filename):
+                return tracks
+            v.connect(filename)
 
-        for sample in v.getsamples():
             if exclude:
-                for x in to_exclude:
-                    if x.search(sample):
-                        skip = True
-                        break
-                if skip:
-                    continue
+                to_exclude = [re.compile(x) for x in exclude]
+
+            for sample in v.getsamples():
+                if exclude:
+                    skip = False
+                    for x in to_exclude:
+                        if x.search(sample):
+                            skip = True
+                            break
+                    if skip:
+                        continue
+
+                tracks.append(sample)
+
+            return tracks
 
-            tracks.append(self.factory(sample))
+        return self.loadCached(
+            _load,
+            filenames=[filename],
+            label="vcf:%s:%s" % (filename, ",".join(exclude or [])))
 
-        self.tracks = tracks
-        return self
 
 TRACKS = TracksVCF(PipelineTracks.Sample).load("variants.vcf.gz")
 
@@ -2377,49 +2389,44 @@ def buildSharedSNPMatrix(infiles, outfiles):
     dbhandle = connect()
     cc = dbhandle.cursor()
 
-    segregating_sites = cc.execute(
-        'SELECT COUNT( DISTINCT locus_id) FROM polyphen_map').fetchone()[0]
-
-    statement = '''SELECT DISTINCT locus_id, track FROM polyphen_map ORDER BY locus_id'''
-    cc.execute(statement)
-
-    matrix = collections.defaultdict(int)
-    for k, vals in itertools.groupby(cc, key=lambda x: x[0]):
-        tracks = [x[1] for x in list(vals)]
-        for t1 in tracks:
-            matrix[(t1, t1)] += 1
-        if len(tracks) > 1:
-            for t1, t2 in itertools.combinations(tracks, 2):
-                matrix[(t1, t2)] += 1
-                matrix[(t2, t1)] += 1
-
-    all_tracks = set([x[0] for x in list(matrix.keys())] + [x[1]
-                                                            for x in list(matrix.keys())])
+    rows = cc.execute(
+        '''SELECT DISTINCT locus_id, track FROM polyphen_map''').fetchall()
+    if rows:
+        loci, tracks = list(zip(*rows))
+    else:
+        # no SNPs, output empty matrices
+        loci, tracks = [], []
+
+    # build a sparse locus x track incidence matrix
+    all_loci, locus_idx = numpy.unique(loci, return_inverse=True)
+    all_tracks, track_idx = numpy.unique(tracks, return_inverse=True)
+    incidence = scipy.sparse.coo_matrix(
+        (numpy.ones(len(locus_idx), dtype=numpy.int32),
+         (locus_idx, track_idx)),
+        shape=(len(all_loci), len(all_tracks))).tocsc()
+
+    segregating_sites = len(all_loci)
+
+    # number of loci shared between each pair of tracks. The diagonal
+    # contains the number of loci per track.
+    matrix = incidence.T.dot(incidence).toarray()
+    diagonal = numpy.diag(matrix)
+
+    def _write(outfile, matrix, fmt):
+        with open(outfile, "w") as outf:
+            outf.write("track\t%s\n" % "\t".join(all_tracks))
+            for track, row in zip(all_tracks, matrix):
+                outf.write("%s\t%s\n" % (
+                    track, "\t".join([fmt % x for x in row])))
 
     # output matrix with shared SNPs.
-    outf = open(outfiles[0], "w")
-    outf.write("track\t%s\n" % "\t".join(all_tracks))
-    for track1 in all_tracks:
-        outf.write("%s" % track1)
-        for track2 in all_tracks:
-            outf.write("\t%i" % matrix[(track1, track2)])
-        outf.write("\n")
-    outf.close()
+    _write(outfiles[0], matrix, "%i")
 
     # output matrix with shared segregating sites as
     # distance matrix
-    outf = open(outfiles[1], "w")
-    outf.write("track\t%s\n" % "\t".join(all_tracks))
-    for track1 in all_tracks:
-        outf.write("%s" % track1)
-        for track2 in all_tracks:
-            if track1 == track2:
-                outf.write("\t%i" % 0)
-            else:
-                outf.write("\t%i" %
-                           (segregating_sites - matrix[(track1, track2)]))
-        outf.write("\n")
-    outf.close()
+    segregation = segregating_sites - matrix
+    numpy.fill_diagonal(segregation, 0)
+    _write(outfiles[1], segregation, "%i")
 
     # output matrix as percent identity matrix
     # percent identity is given as
@@ -2427,31 +2434,14 @@ def buildSharedSNPMatrix(infiles, outfiles):
     # simplifies to:
     # segsites - matrix[i,i] -matrix[j,j] +
     # divided by the total number of segregating sites
-    outf = open(outfiles[2], "w")
-    outf.write("track\t%s\n" % "\t".join(all_tracks))
-    pids = {}
-    for track1 in all_tracks:
-        outf.write("%s" % track1)
-        for track2 in all_tracks:
-            a = segregating_sites - \
-                (matrix[(track1, track1)] + matrix[(track2, track2)] -
-                 2 * matrix[(track1, track2)])
-            pid = 100.0 * a / segregating_sites
-            outf.write("\t%6.4f" % pid)
-            pids[(track1, track2)] = pid
-        outf.write("\n")
-    outf.close()
+    a = segregating_sites - \
+        (diagonal[:, numpy.newaxis] + diagonal[numpy.newaxis, :] -
+         2 * matrix)
+    pids = 100.0 * a / segregating_sites
+    _write(outfiles[2], pids, "%6.4f")
 
     # distance matrix
-    outf = open(outfiles[3], "w")
-    outf.write("track\t%s\n" % "\t".join(all_tracks))
-    for track1 in all_tracks:
-        outf.write("%s" % track1)
-        for track2 in all_tracks:
-            val = 100.0 - pids[(track1, track2)]
-            outf.write("\t%6.4f" % val)
-        outf.write("\n")
-    outf.close()
+    _write(outfiles[3], 100.0 - pids, "%6.4f")
 
     outfile_distance, outfile_tree = outfiles[3], outfiles[4]
 
@@ -2782,34 +2772,48 @@ def buildGeneMatrix(tracks, analysis, statement, outfile):
     A gene matrix is an n x m matrix for n genes and m gene lists.
     Each column contains a 1 if a gene is present in a gene list,
     otherwise it is 0.
+
+    The gene lists for all tracks and analyses are collected with
+    compound queries into a sparse matrix. The matrix is written in
+    tab-separated format to `outfile` and in compressed sparse format
+    to `outfile`.npz.
     '''
 
     dbhandle = connect()
     cc = dbhandle.cursor()
 
     all_genes = [x[0] for x in cc.execute(
-        '''SELECT DISTINCT gene_id FROM annotations.gene_info''' % locals() )]
+        '''SELECT DISTINCT gene_id FROM annotations.gene_info''')]
 
     gene2row = dict([(x[1], x[0]) for x in enumerate(all_genes)])
-    matrix = numpy.zeros(
-        (len(all_genes), len(analysis) * len(tracks)), numpy.int)
-
-    col = 0
-    for track in tracks:
-
-        for label, field_where in analysis:
-            genes = [x[0] for x in cc.execute(statement % locals())]
-            for gene_id in genes:
-                matrix[gene2row[gene_id]][col] = 1
-            col += 1
 
-    outf = open(outfile, "w")
-    outf.write("gene_id\t%s\n" % "\t".join("%s_%s" %
-                                           (x, y[0]) for x, y in itertools.product(tracks, analysis)))
-    for gene_id in all_genes:
-        outf.write("%s\t%s\n" %
-                   (gene_id, "\t".join(map(str, matrix[gene2row[gene_id]]))))
-    outf.close()
+    columns, queries = [], []
+    for col, (track, (label, field_where)) in enumerate(
+            itertools.product(tracks, analysis)):
+        columns.append("%s_%s" % (track, label))
+        queries.append("SELECT %i AS col, gene_id FROM (%s)" %
+                       (col, statement % locals()))
+
+    # sqlite limits the number of terms in a compound select
+    rows, cols = [], []
+    for x in range(0, len(queries), 250):
+        for col, gene_id in cc.execute(
+                " UNION ALL ".join(queries[x:x + 250])):
+            rows.append(gene2row[gene_id])
+            cols.append(col)
+
+    matrix = scipy.sparse.coo_matrix(
+        (numpy.ones(len(rows), dtype=numpy.int8), (rows, cols)),
+        shape=(len(all_genes), len(columns))).tocsr()
+    # remove duplicate entries
+    matrix.data[:] = 1
+
+    scipy.sparse.save_npz(outfile + ".npz", matrix)
+
+    with open(outfile, "w") as outf:
+        outf.write("gene_id\t%s\n" % "\t".join(columns))
+        for gene_id, row in zip(all_genes, matrix.toarray()):
+            outf.write("%s\t%s\n" % (gene_id, "\t".join(map(str, row))))
 
 ####################################################################
 
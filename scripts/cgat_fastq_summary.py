@@ -0,0 +1,212 @@
+'''cgat_fastq_summary.py - summarize a fastq stream while passing it on
+======================================================================
+
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Copy :term:`fastq` formatted data from stdin to stdout unchanged and
+compute summary statistics of the reads on the way. The script is
+used by :class:`PipelinePreprocess.MasterProcessor` to summarize the
+output of each step of a chain of processing tools that are
+connected by pipes, without writing intermediate files or starting
+a separate summary process for each step.
+
+The summary is written to the file given by
+``--output-filename-pattern`` and contains the same columns as the
+output of :doc:`cgat:scripts/fastq2summary`:
+
++----------------+-----------------------------------------------------------+
+|*Column*        |*Content*                                                  |
++----------------+-----------------------------------------------------------+
+|reads           |total reads in file                                        |
++----------------+-----------------------------------------------------------+
+|bases           |total bases in file                                        |
++----------------+-----------------------------------------------------------+
+|mean_length     |mean read length                                           |
++----------------+-----------------------------------------------------------+
+|median_length   |median read length                                         |
++----------------+-----------------------------------------------------------+
+|mean_quality    |mean read quality                                          |
++----------------+-----------------------------------------------------------+
+|median_quality  |median read quality                                        |
++----------------+-----------------------------------------------------------+
+|nfailed         |number of bases below quality threshold                    |
++----------------+-----------------------------------------------------------+
+
+Read lengths and mean read qualities are counted in dictionaries, so
+that memory usage does not depend on the number of reads.
+
+Usage
+-----
+
+Example::
+
+   zcat in.fastq.gz
+   | python cgat_fastq_summary.py --output-filename-pattern=out.summary
+                                  --log=out.summary.log
+   | gzip > out.fastq.gz
+
+As the fastq data are written to stdout, a log file should be given.
+
+Type::
+
+   python cgat_fastq_summary.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import sys
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+
+def getMedian(counts):
+    '''return the median of values in a dictionary mapping values
+    to their counts.'''
+
+    total = sum(counts.values())
+    if total == 0:
+        return float("nan")
+
+    # positions of the middle element(s) in the sorted values
+    lower, upper = (total - 1) // 2, total // 2
+    values, seen = [], 0
+    for value in sorted(counts):
+        seen += counts[value]
+        while len(values) < 2 and seen > (lower, upper)[len(values)]:
+            values.append(value)
+        if len(values) == 2:
+            break
+    return (values[0] + values[1]) / 2.0
+
+
+def summarizeFastq(infile, outfile, offset=33, min_quality=10):
+    '''copy fastq records from *infile* to *outfile* and return
+    summary statistics.
+
+    Arguments
+    ---------
+    infile : File
+        Binary input stream in :term:`fastq` format.
+    outfile : File
+        Binary output stream.
+    offset : int
+        Offset of quality scores.
+    min_quality : int
+        Bases with quality scores below this threshold are counted
+        as failed.
+
+    Returns
+    -------
+    summary : tuple
+        Number of reads, number of bases, mean length, median length,
+        mean quality, median quality and number of failed bases.
+    '''
+
+    # characters of quality scores at or above the threshold. Deleting
+    # them from a quality string leaves the failed bases.
+    passed = bytes(bytearray(range(offset + min_quality, 256)))
+
+    lengths = collections.defaultdict(int)
+    qualities = collections.defaultdict(int)
+    nreads, nbases, nfailed = 0, 0, 0
+
+    while True:
+        header = infile.readline()
+        if not header:
+            break
+        sequence = infile.readline()
+        separator = infile.readline()
+        quality = infile.readline()
+        if not quality:
+            raise ValueError("incomplete fastq record at read %i" %
+                             (nreads + 1))
+        outfile.write(header + sequence + separator + quality)
+
+        quality = quality.rstrip(b"\r\n")
+        length = len(quality)
+        nreads += 1
+        nbases += length
+        lengths[length] += 1
+        if length > 0:
+            qualities[float(sum(bytearray(quality))) / length - offset] += 1
+        nfailed += len(quality.translate(None, passed))
+
+    if nreads > 0:
+        mean_length = float(nbases) / nreads
+        mean_quality = sum([x * y for x, y in qualities.items()]) / \
+            sum(qualities.values())
+    else:
+        mean_length, mean_quality = float("nan"), float("nan")
+
+    return (nreads, nbases,
+            round(mean_length, 2),
+            round(getMedian(lengths), 2),
+            round(mean_quality, 2),
+            round(getMedian(qualities), 2),
+            nfailed)
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option(
+        "--quality-offset", dest="quality_offset", type="int",
+        help="offset of quality scores [%default]")
+
+    parser.add_option(
+        "--quality-threshold", dest="quality_threshold", type="int",
+        help="bases with quality scores below this threshold "
+        "are counted as failed [%default]")
+
+    parser.set_defaults(
+        quality_offset=33,
+        quality_threshold=10)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv, add_output_options=True)
+
+    if not options.output_filename_pattern:
+        raise ValueError("please specify --output-filename-pattern")
+
+    outfile = getattr(options.stdout, "buffer", options.stdout)
+    summary = summarizeFastq(
+        getattr(options.stdin, "buffer", options.stdin),
+        outfile,
+        offset=options.quality_offset,
+        min_quality=options.quality_threshold)
+    outfile.flush()
+
+    with IOTools.openFile(options.output_filename_pattern, "w") as outf:
+        outf.write("reads\tbases\tmean_length\tmedian_length\t"
+                   "mean_quality\tmedian_quality\tnfailed\n")
+        outf.write("%i\t%i\t%s\t%s\t%s\t%s\t%i\n" % summary)
+
+    E.info("reads=%i, bases=%i, failed=%i" %
+           (summary[0], summary[1], summary[6]))
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
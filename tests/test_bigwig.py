@@ -0,0 +1,119 @@
+'''test_bigwig - test bigwig conversion in PipelineMappingQC
+===========================================================
+
+:Author: Andreas Heger
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Build a :term:`bigwig` file from a small :term:`bam` file with
+:func:`PipelineMappingQC.buildBigWigFromBam` and read it back with
+:func:`PipelineMappingQC.readBigWigSummary` and, if available,
+pyBigWig.
+
+This script is best run within nosetests::
+
+   nosetests tests/test_bigwig.py
+
+'''
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pysam
+from nose.tools import ok_, assert_equal, assert_almost_equal
+from nose.plugins.skip import SkipTest
+
+import CGATPipelines.PipelineMappingQC as PipelineMappingQC
+
+CONTIGS = (("chr1", 10000), ("chr2", 5000))
+
+# reads as tuples of (contig, start, cigar, is_reverse)
+READS = (("chr1", 100, "50M", False),
+         ("chr1", 120, "50M", True),
+         ("chr1", 9950, "50M", False),
+         ("chr2", 0, "20M100N30M", False),
+         ("chr2", 4000, "50M", True))
+
+
+def buildBam(filename):
+    '''write READS to a sorted and indexed bam file and return
+    the expected coverage per contig.'''
+
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": contig, "LN": length}
+                     for contig, length in CONTIGS]}
+    contig2id = dict((contig, x) for x, (contig, _) in enumerate(CONTIGS))
+
+    expected = dict((contig, np.zeros(length, dtype=np.float32))
+                    for contig, length in CONTIGS)
+
+    with pysam.AlignmentFile(filename, "wb", header=header) as outf:
+        for x, (contig, start, cigar, is_reverse) in enumerate(READS):
+            read = pysam.AlignedSegment()
+            read.query_name = "read%i" % x
+            read.reference_id = contig2id[contig]
+            read.reference_start = start
+            read.cigarstring = cigar
+            read.query_sequence = "A" * read.query_length
+            read.query_qualities = pysam.qualitystring_to_array(
+                "I" * read.query_length)
+            read.mapping_quality = 20
+            read.is_reverse = is_reverse
+            outf.write(read)
+            # unspliced coverage counts the complete span of a read
+            expected[contig][read.reference_start:read.reference_end] += 1
+
+    pysam.index(filename)
+    return expected
+
+
+def test_bigwig_roundtrip():
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        bamfile = os.path.join(tmpdir, "test.bam")
+        bigwigfile = os.path.join(tmpdir, "test.bw")
+        expected = buildBam(bamfile)
+
+        PipelineMappingQC.buildBigWigFromBam(bamfile, bigwigfile)
+        ok_(os.path.exists(bigwigfile))
+
+        values = np.concatenate([expected[contig] for contig, _ in CONTIGS])
+        covered = values[values > 0]
+
+        summary, contigs = PipelineMappingQC.readBigWigSummary(
+            bigwigfile, contigs=True)
+        assert_equal(summary["chromCount"], len(CONTIGS))
+        assert_equal(summary["basesCovered"], len(covered))
+        assert_almost_equal(summary["mean"], covered.mean(), places=5)
+        assert_equal(summary["min"], covered.min())
+        assert_equal(summary["max"], covered.max())
+
+        contig2summary = dict((x[0], x) for x in contigs)
+        for contig, length in CONTIGS:
+            assert_equal(contig2summary[contig][1], length)
+            assert_equal(contig2summary[contig][2],
+                         (expected[contig] > 0).sum())
+
+        try:
+            import pyBigWig
+        except ImportError:
+            raise SkipTest("pyBigWig not available")
+
+        bw = pyBigWig.open(bigwigfile)
+        try:
+            for contig, length in CONTIGS:
+                ok_(np.array_equal(
+                    np.nan_to_num(bw.values(contig, 0, length)),
+                    expected[contig]),
+                    "coverage mismatch on %s" % contig)
+        finally:
+            bw.close()
+    finally:
+        shutil.rmtree(tmpdir)